@@ -4,11 +4,12 @@ from tkinter import ttk
 from tkinter import filedialog
 from tkinter import messagebox
 from pathlib import Path
+import argparse
 from UI.UIconsts import UIConsts
 from UI.PipelineFrame import *
-import photogrammetryScripts as phscripts
 from util.util import getPaletteOptions
 from util.Configurator import Configurator
+from util.Cancellation import CancellationToken
 import util.PipelineLogging
 
 
@@ -41,16 +42,42 @@ class BuildFormItems(FormItemsInterface):
         return {"valid":valid,"message":msg}
     
 class BuildFrame(PipelineFrameBase):
-    
+
+    def stop_building(self):
+        """Stops the build started from this frame: cancels its job if it went through the build queue, or its token if it is
+        running here."""
+        if self.jobid is not None:
+            from tasks.BuildQueue import BuildQueue
+            BuildQueue().cancel(self.jobid)
+            self.jobid = None
+        if self.token is not None:
+            self.token.cancel("Build stopped from the UI.")
+
     def task(self,args:BuildFormItems):
         try:
             self.disable_enable_all(True)
+            self.token = CancellationToken()
+            self.jobid = None
+            self.stopbutton.configure(state="normal")
             Configurator.getConfig().setProperty("photogrammetry","palette", args.pal_name.get())
-            phscripts.build_model(jobname = args.proj_name.get(),
-                                inputdir = args.image_path.get(),
-                                outputdir = args.proj_base.get(),
-                                mask_option = UIConsts.MASKOPTIONS[args.mask_option.get()],
-                                snapshot=True)
+            from tasks.BuildQueue import BuildQueue, BuildQueueRunner, useBuildQueue
+            if useBuildQueue():
+                self.jobid = BuildQueue().submit(args.proj_name.get(),
+                                    args.image_path.get(),
+                                    args.proj_base.get(),
+                                    UIConsts.MASKOPTIONS[args.mask_option.get()].value,
+                                    args.pal_name.get())
+                BuildQueueRunner.ensureBackgroundRunner()
+            else:
+                #the same build the build queue runs, in this process, so that the stop button can cancel it partway through.
+                import photogrammetryPipeline
+                photogrammetryPipeline.build_model_cmd(argparse.Namespace(sourcedir=args.image_path.get(),
+                                                                          projectdir=args.proj_base.get(),
+                                                                          projectname=args.proj_name.get(),
+                                                                          maskoption=UIConsts.MASKOPTIONS[args.mask_option.get()].value,
+                                                                          palette=args.pal_name.get(),
+                                                                          resume=True),
+                                                       self.token)
 
         except Exception as e:
             messagebox.showerror("Build Exception",e)
@@ -62,6 +89,8 @@ class BuildFrame(PipelineFrameBase):
     def __init__(self,container):
 
         super().__init__(container)
+        self.token = None
+        self.jobid = None
         self.svars = BuildFormItems()
         maskoptionvals = [*UIConsts.MASKOPTIONS.keys()]
         palettevals = getPaletteOptions()
@@ -82,6 +111,8 @@ class BuildFrame(PipelineFrameBase):
         paletteoption.current(0)
         paletteoption.grid(column=0,row=11)
         ttk.Button(self,text="Build",command=lambda:self.execute(self.svars)).grid(column=0, row=12)
+        self.stopbutton = ttk.Button(self,text="Stop",command=lambda:self.stop_building())
+        self.stopbutton.grid(column=1, row=12)
 
 
         
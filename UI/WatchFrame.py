@@ -7,7 +7,6 @@ from UI.UIconsts import UIConsts
 from util.util import MaskingOptions, delete_manifests_images
 from util.Configurator import Configurator
 from util.InstrumentationStatistics import InstrumentationStatistics
-import photogrammetryScripts as phscripts
 from UI.PipelineFrame import FormItemsInterface,PipelineFrameBase
 
 
@@ -59,7 +58,8 @@ class WatchFrame(PipelineFrameBase):
             self.state = "running"
             mask_option = UIConsts.MASKOPTIONS[args.masking_option.get()]
             Configurator.getConfig().setProperty("processing","ListenerDefaultMasking", MaskingOptions.numToFriendlyString(mask_option))
-            self.watcher = phscripts.Watcher(args.input_dir.get(), False) 
+            from photogrammetryWatchers import Watcher
+            self.watcher = Watcher(args.input_dir.get(), False) 
             self.stopbutton.configure(state="normal")
             self.watcher.run()
         except Exception as e:
@@ -8,11 +8,14 @@ from queue import Queue
 from util.Configurator import Configurator
 from util.PipelineLogging import getLogger as getGlobalLogger
 from util.util import * 
-from util.InstrumentationStatistics import InstrumentationStatistics
 from util.MetashapeFileHandleSingleton import MetashapeFileSingleton
 from processing.image_processing import convertToGrayscaleAdjustBrightness
 from tasks.MetashapeTasks import *
 from tasks.MetashapeTasksSpecial import *
+from tasks.TaskScheduler import executeTasks, getConfiguredLimits
+from tasks.BaseTask import ResourceClass
+from util.MemoryBudget import MemoryBudget, estimateImageBytes
+from concurrent.futures import ThreadPoolExecutor
 
 def convertProxyImage(image:str,outputname:str,channels:int,brightness:float=1.0,gray:bool=False):
     #im not sure that the images that we want to generate a grayscale orthophoto have to be grayscale at this point, but let's give it a go 
@@ -54,6 +57,7 @@ def setupReferences(chunks:dict,basedir:Path)->dict:
     referencepath = Path(basedir,"references")
     if not referencepath.exists():
         os.mkdir(referencepath)
+    conversions = {}
     for k,v in chunks.items():
         referencefiles = multibanded_types[k].get("pointcloud_reference",k)
         c = multibanded_types[k].get("graychannel","b")
@@ -68,9 +72,18 @@ def setupReferences(chunks:dict,basedir:Path)->dict:
             for reference in refs:
                 referenceimage = Path(reference)
                 output = Path(referencepath,f"{k}_{fbk}_ref_{referenceimage.stem}{referenceimage.suffix}")
-                if not output.exists():
-                    convertToGrayscaleAdjustBrightness(referenceimage,output,gray,channel,False,brightness)
+                if not output.exists() and output not in conversions:
+                    conversions[output] = (referenceimage,gray,channel,brightness)
                 fbv["references"].append(output)
+    #each reference is a whole picture plus three copies of it in memory, so they're converted in parallel only as far as the
+    #memory budget allows.
+    budget = MemoryBudget.getBudget()
+    def convertReference(output):
+        referenceimage, gray, channel, brightness = conversions[output]
+        with budget.reserve(estimateImageBytes(referenceimage,"reference"),"reference"):
+            convertToGrayscaleAdjustBrightness(referenceimage,output,gray,channel,False,brightness)
+    with ThreadPoolExecutor(max_workers=max(1,getConfiguredLimits().get(ResourceClass.CPU_POOL,1))) as pool:
+        list(pool.map(convertReference,conversions))
     return chunks
 
 
@@ -106,32 +119,13 @@ def sortFilesIntoBandsByName(filepath)->dict:
    
     return chunks
 
-def executeTasklist(taskqueue:Queue):
+def executeTasklist(taskqueue:Queue, reportpath:Path=None):
     
     getGlobalLogger(__name__).info("Executing Tasklist.")
-    succeeded = True
-    finished = False
-    phase = "setup"
-    while(not finished):
-        task = taskqueue.get()
-        succeeded,code = task.setup()
-        if succeeded:
-            phase = "execute"
-            succeeded, code =task.execute()
-            if succeeded:
-                phase = "exit"
-                succeeded,code = task.exit()
-        if not succeeded:
-            getGlobalLogger(__name__).error("Phase %s for Task %s failed with error %s",phase, str(task),ErrorCodes.numToFriendlyString(code))
-            break
-        if taskqueue.empty():
-            finished = True
-            getGlobalLogger(__name__).info("Finished the tasklist, ending.")
-        
-
-    InstrumentationStatistics.getStatistics().logReport()
-    InstrumentationStatistics.destroyStatistics()
-    MetashapeFileSingleton.destroyDoc() #gets created by metashape tasks "align photos."
+    succeeded, _, _ = executeTasks(taskqueue, reportpath=reportpath)
+    if succeeded:
+        getGlobalLogger(__name__).info("Finished the tasklist, ending.")
+    return succeeded
 
 def setupTasksPhaseOne(chunks:dict,sourcedir,projectname,projectdir):
     tasks = Queue()
@@ -270,7 +264,7 @@ def build_multibanded_cmd(args):
     chunks = sortFilesIntoBandsByName(sourcedir)
     chunks = setupReferences(chunks, projdir)
     tasks = setupTasksPhaseOne(chunks, sourcedir,projectname,projdir)
-    executeTasklist(tasks)
+    executeTasklist(tasks, Path(projdir,f"{projectname}_runreport.json"))
     convertOrthomosaicsToGray(projectname,chunks,Path(projdir,"output"))
         
 if __name__=="__main__":
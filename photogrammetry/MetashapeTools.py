@@ -39,7 +39,7 @@ def load_masks(chunk,maskpath:str,projectdir:str):
         get_logger().warning("Mask path %s doesn't exist or wasn't passed corectly. Failing loading masks.",maskpath)
         return
     maskpath = os.path.join(projectdir,maskpath)
-    files = os.listdir(maskpath)
+    files = [f for f in os.listdir(maskpath) if not f.startswith(".")] #skip the fingerprints recorded next to the masks.
     if len(files)>0:
         get_logger().info("Loading masks from %s", maskpath)
         ext = os.path.splitext(files[0])[1] #get the ext
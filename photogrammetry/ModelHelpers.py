@@ -288,7 +288,7 @@ def detect_markers(chunk, markertype:str):
     # update markers
     chunk.refineMarkers()
 
-def optimize_cameras(chunk, final_optimization=False):
+def optimize_cameras(chunk, final_optimization=False, token=None):
     """Runs the optimize cameras function in metashape.
     
     Parameters:
@@ -296,6 +296,7 @@ def optimize_cameras(chunk, final_optimization=False):
     chunk: the chunk with the cameras to optimize.
     final_optimization: A different set of camera parameters are used the final time this is called in the error reduction cycle. 
     Pass in true if you would like that.
+    token: an optional CancellationToken. If it is cancelled, the optimization is aborted with OperationCancelled.
     """
     
     #runs the optimize camera function, setting a handfull of the statistical fitting options to true only if the parameter is true,
@@ -313,9 +314,10 @@ def optimize_cameras(chunk, final_optimization=False):
                           fit_p2=True,
                           fit_p3=final_optimization,
                           adaptive_fitting=False,
-                          tiepoint_covariance=False)
+                          tiepoint_covariance=False,
+                          progress=token.progressCallback() if token is not None else None)
 
-def refine_sparse_cloud(doc,chunk,error_thresholds:dict):
+def refine_sparse_cloud(doc,chunk,error_thresholds:dict,token=None):
     """Performs the error reduction/optimization algorithm as described by Neffra Matthews and Noble,Tommy. "In the Round Tutorial", 2018. 
     
     Parameters:
@@ -323,11 +325,13 @@ def refine_sparse_cloud(doc,chunk,error_thresholds:dict):
     doc: The metashape document...this is so we can save between various stages.
     chunk: the chunk on which we are currently operating.
     config: the config.json subdictionary under the key "photogrammetry"
+    token: an optional CancellationToken, checked between every step and during each camera optimization. If it is cancelled,
+    OperationCancelled is raised and nothing after the last doc.save() is kept.
 
     """
     LOGGER.info("Refining sparse cloud on chunk %s", chunk)
     #copied from the script RefineSparseCloud.py     
-    optimize_cameras(chunk,False)
+    optimize_cameras(chunk,False,token)
     doc.save()
     #get number of points before refinement:
     
@@ -335,15 +339,17 @@ def refine_sparse_cloud(doc,chunk,error_thresholds:dict):
     remove_above_error_threshold(chunk,
                               Metashape.TiePoints.Filter.ReconstructionUncertainty,
                               error_thresholds["reconstruction_uncertainty"],
-                              error_thresholds["reconstruction_uncertainty_max_selection"])
-    optimize_cameras(chunk,False)
+                              error_thresholds["reconstruction_uncertainty_max_selection"],
+                              token)
+    optimize_cameras(chunk,False,token)
     doc.save()
     #Remove points with a projection accuracy error aabove threshold.
     remove_above_error_threshold(chunk,
                             Metashape.TiePoints.Filter.ProjectionAccuracy,
                             error_thresholds["projection_accuracy"],
-                            error_thresholds["projection_accuracy_max_selection"])
-    optimize_cameras(chunk,False)
+                            error_thresholds["projection_accuracy_max_selection"],
+                            token)
+    optimize_cameras(chunk,False,token)
     doc.save()
     #remove points with a reprojection error of above threshold, only removing a set percentage of overall points at a time.
     num_points = len(chunk.tie_points.points)
@@ -353,13 +359,14 @@ def refine_sparse_cloud(doc,chunk,error_thresholds:dict):
         reachedgoal = remove_above_error_threshold(chunk,
                                     Metashape.TiePoints.Filter.ReprojectionError,
                                     error_thresholds["reprojection_error"],
-                                    error_thresholds["reprojection_max_selection_per_iteration"])
-        optimize_cameras(chunk,False)
+                                    error_thresholds["reprojection_max_selection_per_iteration"],
+                                    token)
+        optimize_cameras(chunk,False,token)
         num_points = len(chunk.tie_points.points)
-    optimize_cameras(chunk,True)
+    optimize_cameras(chunk,True,token)
     doc.save()
 
-def remove_above_error_threshold(chunk, filtertype,max_error,max_points):
+def remove_above_error_threshold(chunk, filtertype,max_error,max_points,token=None):
     """ This attempts to select and remove all points above a given error threshold in max_error, up to a maximum percentage of acceptable points to remove, max_points. 
     It returns true if it succeeds in removing all points with error higher than the threshold without first reaching the maximum selection.
    
@@ -369,9 +376,12 @@ def remove_above_error_threshold(chunk, filtertype,max_error,max_points):
     filtertype: the filtertype in the Metashape.TiePoints.Filter enumeration.
     max_error: the max error value for the filter type as specified in config.json.
     max_points: the max amount of points that should be selected at a time to reduce error, as specified in config.json.
+    token: an optional CancellationToken. If it is cancelled, OperationCancelled is raised before any points are removed.
     
     returns true or false depending on whether the max error was reached without first reaching the maximum points selected.
     """
+    if token is not None:
+        token.raiseIfCancelled()
     removed_above_threshold=False
     tiepoints = chunk.tie_points
     num_points = len(tiepoints.points)
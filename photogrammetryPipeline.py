@@ -1,21 +1,32 @@
 from pathlib import Path
 from os import listdir
 import argparse
-from tasks.ConversionTasks import ConvertToJPG
-from tasks.MaskingTasks import MaskAI,MaskDroplet,MaskThreshold
-from tasks.MetashapeTasks import *
-from tasks.BlenderTasks import BlenderSnapshotTask
-from processing import image_processing
+import threading
+from tasks.TaskRegistry import createTask
+from tasks.TaskScheduler import executeTasks
+from tasks.TaskJournal import TaskJournal
+from tasks.DistributedTasks import useWorkQueue, distribute
 
-from util.InstrumentationStatistics import InstrumentationStatistics, Statistic_Event_Types
-from util.MetashapeFileHandleSingleton import MetashapeFileSingleton
 from util.PipelineLogging import getLogger as getGlobalLogger
 from util.Configurator import Configurator
-from util.util import MaskingOptions
+from util.Cancellation import CancellationToken
+from util.util import AlignmentTypes
+from util import util
 from queue import Queue
 
-_HALT = False
-_STOP_ON_COMPLETED = True
+#the palettes that can be picked by number with --palette.
+PALETTES = ["none","small_axes_palette","large_axes_palette","protractor","protractor2","CHI"]
+#the cancellation tokens of the builds running in this process. Each build gets its own, so stopping one doesn't stop the next.
+_RUNNING = set()
+_RUNNING_LOCK = threading.Lock()
+
+def halt(reason:str="Stop requested."):
+    """Stops every build running in this process. Tasks that are partway through stop within about a second, and the builds can
+    be picked up again with --resume. To stop just one build, cancel the token it was started with."""
+    with _RUNNING_LOCK:
+        tokens = list(_RUNNING)
+    for token in tokens:
+        token.cancel(reason)
 
 def buildMetashapeTasks()->Queue:
     metashapetasks = Queue()
@@ -24,6 +35,7 @@ def buildTaskQueue(tasklist:list)->Queue:
     """given a list full of tasks and their parameters,
       this will construct a queue of events to execute to accomplish the tasks. The list should be in the format:
        [{"name":"taskname","kwargs":{dictionary of arguments the task expects}}]
+      Task names are looked up in tasks.TaskRegistry, which imports each task's module the first time it's needed.
 
     Parameters:
     -----------
@@ -31,79 +43,82 @@ def buildTaskQueue(tasklist:list)->Queue:
     """
     taskqueue = Queue()
     for task in tasklist:
-        temptask = None
-        sname = task["name"]
-        sargs = task["kwargs"]
-        if sname == "Masking":
-            if sargs["maskoption"]== MaskingOptions.MASK_AI.value:
-                temptask = MaskAI(sargs)
-            elif sargs["maskoption"]==MaskingOptions.MASK_THRESHOLDING.value:
-                temptask =  MaskThreshold(sargs)
-            elif sargs["maskoption"]==MaskingOptions.MASK_CONTEXT_AWARE_DROPLET.value:
-                temptask = MaskDroplet(sargs)
-        elif sname =="ConvertJPG":
-            temptask = ConvertToJPG(sargs)
-        elif sname =="Metashape_DetectMarkers":
-            temptask = MetashapeTask_DetectMarkers(sargs)
-        elif sname=="Metashape_Align":
-            temptask = MetashapeTask_AlignPhotos(sargs)
-        elif sname == "Metashape_ErrorReduction":
-            temptask = MetashapeTask_ErrorReduction(sargs)
-        elif sname == "Metashape_BuildModel":
-            temptask = MetashapeTask_BuildModel(sargs)
-        elif sname=="Metashape_FindScales":
-            temptask = MetashapeTask_AddScales(sargs)
-        elif sname=="Metashape_AlignChunks":
-            temptask = MetashapeTask_AlignChunks(sargs)
-        elif sname == "Metashape_BuildTextures":
-            temptask = MetashapeTask_BuildTextures(sargs)
-        elif sname == "Metashape_Reorient":
-            temptask = MetashapeTask_Reorient(sargs)
-        elif sname == "Metashape_ExportModel":
-            temptask = MetashapeTask_ExportModel(sargs)
-        elif sname == "Blender_Snapshot":
-            temptask = BlenderSnapshotTask(sargs)
+        temptask = createTask(task["name"],task["kwargs"])
         if temptask:
             taskqueue.put(temptask)
+        else:
+            getGlobalLogger(__name__).warning("No task is registered for %s, skipping it.",task["name"])
     return taskqueue
 
-def executeTaskQueue(taskqueue:Queue):
+def executeTaskQueue(taskqueue:Queue, journal:TaskJournal=None, resume:bool=False, reportpath:Path=None,
+                     token:CancellationToken=None):
     """Executes a series of tasks in a task queue.It checks to see if the setup phase of each task passes,'
-        runs the execute phase, and then runs the cleanup code in exit.
+        runs the execute phase, and then runs the cleanup code in exit. Tasks that don't depend on each other's
+        inputs and outputs are run concurrently by the task scheduler.
 
     Parameters:
     -----------
     args: taskqueue -- a queue full of objects that should be subclassed off of tasks::basetask.
+    journal -- an optional TaskJournal in which to record each task.
+    resume -- if true, skip tasks that the journal says already completed with the same inputs.
+    reportpath -- an optional json file in which to write how long each phase of each task took.
+    token -- the CancellationToken that stops this run. A new one is made if it isn't given.
+
+    returns: success, code
     """
-    global _STOP_ON_COMPLETED
-    succeeded = True
-    while succeeded and not _HALT:
-        task = taskqueue.get()
-        succeeded &= task.setup()
-        if succeeded:
-            succeeded &= task.execute()
-            succeeded &= task.exit()
-        if taskqueue.empty() and _STOP_ON_COMPLETED:
-            break
-    InstrumentationStatistics.getStatistics().logReport()
-    InstrumentationStatistics.destroyStatistics()
-    MetashapeFileSingleton.destroyDoc()
-    _STOP_ON_COMPLETED = True
+    token = token if token is not None else CancellationToken()
+    with _RUNNING_LOCK:
+        _RUNNING.add(token)
+    try:
+        succeeded, code, _ = executeTasks(taskqueue, journal, resume, reportpath, token=token)
+    finally:
+        with _RUNNING_LOCK:
+            _RUNNING.discard(token)
+    return succeeded, code
+
 def build_conversion_masking_taskqueue(inputdir:Path, maskoption, maskpath):
-    conversions=[]
-    futurejpgs=[]
+    """Builds one batch conversion task for the pictures in a folder and, if masking was asked for, one batch masking task
+    for the jpgs that the conversion will produce. If the work queue is turned on, both are shared out through it."""
+    sources = {}
     extns = [".NEF",".TIF",".JPG",".CR2"]
-    for fn in [Path(f) for f in listdir(inputdir)]:
+    for fn in sorted(Path(f) for f in listdir(inputdir)):
         sfx = fn.suffix.upper()
-        if sfx in extns: 
-            conversions.append({"name":"ConvertJPG","kwargs":{"input":Path(inputdir,fn),"output":inputdir}})
-            futurejpg = Path(inputdir,f"{fn.stem}.jpg")
-            if not int(maskoption)==0:
-                futurejpgs.append({"name":"Masking","kwargs":{"input":futurejpg,
+        #a jpg next to a raw or tif of the same name was made by an earlier conversion, so convert the original instead.
+        if sfx in extns and (fn.stem not in sources or sources[fn.stem].suffix.upper()==".JPG"):
+            sources[fn.stem] = fn
+    conversions = [Path(inputdir,fn) for fn in sources.values()]
+    futurejpgs = [Path(inputdir,f"{stem}.jpg") for stem in sources.keys()]
+    tasks = []
+    if conversions:
+        tasks.append({"name":"ConvertJPG","kwargs":{"input":conversions,"output":inputdir}})
+        if not int(maskoption)==0:
+            tasks.append({"name":"Masking","kwargs":{"input":futurejpgs,
                                         "output":maskpath,
-                                        "maskoption":int(maskoption)}},)
-    return conversions+futurejpgs
-def build_model_cmd(args):
+                                        "maskoption":int(maskoption)}})
+    if useWorkQueue():
+        tasks = [distribute(t) for t in tasks]
+    return tasks
+def build_preprocessing_tasklist(inputdir, projectdir, maskoption)->list:
+    """Builds the conversion and masking part of a build's task list, for the main pictures and for any multibanded
+    folders in the project directory. This is the part of a build that doesn't need metashape, so the build queue runs it for
+    waiting jobs while other jobs are in metashape. The list has to match what build_model_cmd queues, so that the task
+    journal lets the build skip it.
+
+    returns: a list of tasks in the format buildTaskQueue expects.
+    """
+    maskdir = Configurator.getConfig().getProperty('photogrammetry','mask_path')
+    tasks = build_conversion_masking_taskqueue(inputdir,maskoption,Path(projectdir,maskdir))
+    for band in Configurator.getConfig().getProperty("photogrammetry","multibanded"):
+        if Path(projectdir,band["path"]).is_dir():
+            tasks+= build_conversion_masking_taskqueue(Path(projectdir,band["path"]),
+                                                       maskoption,Path(projectdir,f"{band['name']}_{maskdir}"))
+    return tasks
+
+def resolve_palette(palette:str)->str:
+    """Turns the --palette argument, either an index into PALETTES or the name of a palette in MarkerPalettes.json, into a name."""
+    return PALETTES[int(palette)] if str(palette).isdigit() else palette
+
+def build_model_cmd(args, token:CancellationToken=None):
     """Wrapper script for building masks from contents of a folder using a photoshop droplet.
     Parameters:
     -----------
@@ -111,32 +126,30 @@ def build_model_cmd(args):
     sourcedir: the directory of pictures that need to be masked in TIF format.
     outputdir: the directory where the masks need to get copied when the masking is done.
     maskoption: the integer method to use for building masks. (see command line help.)
+    resume: if true, tasks recorded as complete in the project's task journal are skipped if their inputs haven't changed.
+    token: an optional CancellationToken the caller can cancel to stop the build.
     Note: intermediary files  such as jpgs made from the RAW or tif files will be placed in the same directory as those tif files /
     all models will be built from JPGs saed at 95/100 quality.
     """ 
     inputdir = args.sourcedir
     projectdir = args.projectdir
     projectname = args.projectname
-    possiblepalettes = ["none","small_axes_palette","large_axes_palette","protractor","protractor2","CHI"]
     exporttype = Configurator.getConfig().getProperty("photogrammetry","export_as")
-    Configurator.getConfig().setProperty("photogrammetry","palette", possiblepalettes[int(args.palette)])
+    Configurator.getConfig().setProperty("photogrammetry","palette", resolve_palette(args.palette))
     maskoption = args.maskoption
     outputfolder = Configurator.getConfig().getProperty("photogrammetry","output_path")
-    tasks = []
+    tasks = build_preprocessing_tasklist(inputdir,projectdir,maskoption)
     projects = [{"name":"main",
                  "desc":"visible light",
                  "path":inputdir}]
-    tasks+= build_conversion_masking_taskqueue(inputdir,maskoption,Path(projectdir,Configurator.getConfig().getProperty('photogrammetry','mask_path')))
     for band in Configurator.getConfig().getProperty("photogrammetry","multibanded"):
-        print(band)
         if Path(projectdir,band["path"]).is_dir():
             projects.append(band)
-            tasks+= build_conversion_masking_taskqueue(Path(projectdir,band["path"]),
-                                                       maskoption,Path(projectdir,f"{band['name']}_{Configurator.getConfig().getProperty('photogrammetry','mask_path')}"))
     
     for project in projects:
         
-        outputfilename =  Path(projectdir,outputfolder,f"{util.get_export_filename(f"{projectname}_{project['name']}".replace(" ",""),exporttype)}{exporttype}")
+        exportname = util.get_export_filename(f"{projectname}_{project['name']}".replace(" ",""),exporttype)
+        outputfilename =  Path(projectdir,outputfolder,f"{exportname}{exporttype}")
         maskpath =Path(projectdir,Configurator.getConfig().getProperty('photogrammetry','mask_path'))
         projectinput = inputdir
         if project['name'] != "main":
@@ -194,9 +207,10 @@ def build_model_cmd(args):
                                                 "scale":True,
                                                 }}]
     sm = buildTaskQueue(tasks)
-    executeTaskQueue(sm)
+    journal = TaskJournal(Path(projectdir,f"{projectname}_journal.json"))
+    return executeTaskQueue(sm, journal, getattr(args,"resume",False), Path(projectdir,f"{projectname}_runreport.json"), token)
 
-def build_masks_cmd(args):
+def build_masks_cmd(args, token:CancellationToken=None):
     """Wrapper script for building masks from contents of a folder.
     Parameters:
     -----------
@@ -216,9 +230,56 @@ def build_masks_cmd(args):
         {"name":"Masking","kwargs":{"input":intermediary,"output":output,"maskoption":int(maskoption)}}
         ]
     sm= buildTaskQueue(tasks)
-    executeTaskQueue(sm)
+    return executeTaskQueue(sm, token=token)
     #image_processing.build_masks(input,output,int(args.maskoption))
 
+def build_multibanded_cmd(args):
+    """Builds a multibanded model. See multibanded_build.py."""
+    import multibanded_build
+    multibanded_build.build_multibanded_cmd(args)
+
+def queue_list_cmd(args):
+    """Prints the build queue in the order the builds will run."""
+    from tasks.BuildQueue import BuildQueue
+    queue = BuildQueue()
+    jobs = queue.getJobs(args.all)
+    if not jobs:
+        print(f"The build queue at {queue.path} is empty.")
+    for job in jobs:
+        print(f"{job['id']:>5}  {job['status']:<13} priority {job['priority']:<4} {job['projectname']:<30} {job['submitted']}  {job['message']}")
+
+def queue_submit_cmd(args):
+    from tasks.BuildQueue import BuildQueue
+    jobid = BuildQueue().submit(args.projectname,args.sourcedir,args.projectdir,int(args.maskoption),
+                                resolve_palette(args.palette),args.priority)
+    print(f"Queued build {jobid}.")
+
+def queue_priority_cmd(args):
+    from tasks.BuildQueue import BuildQueue
+    BuildQueue().setPriority(args.jobid,args.priority)
+
+def queue_front_cmd(args):
+    from tasks.BuildQueue import BuildQueue
+    BuildQueue().moveToFront(args.jobid)
+
+def queue_cancel_cmd(args):
+    from tasks.BuildQueue import BuildQueue
+    if not BuildQueue().cancel(args.jobid):
+        print(f"Build {args.jobid} already finished.")
+
+def queue_clear_cmd(args):
+    from tasks.BuildQueue import BuildQueue
+    print(f"Removed {BuildQueue().clearFinished()} builds.")
+
+def queue_run_cmd(args):
+    """Runs the build queue in this process until it's empty, or until ctrl+c if --forever is given."""
+    from tasks.BuildQueue import BuildQueueRunner
+    runner = BuildQueueRunner()
+    try:
+        runner.run(untilempty=not args.forever)
+    except KeyboardInterrupt:
+        runner.stop()
+
 if __name__=="__main__":
     _LOGGER = getGlobalLogger(__name__)
     _CONFIG = Configurator.getConfig()
@@ -252,16 +313,19 @@ if __name__=="__main__":
                                     4 = Grayscale Thresholding, \n \
                                     5 = AI \n",
                             default=0)
-    buildparser.add_argument("--palette", type=str, choices=["0","1","2","3","4","5"],
+    buildparser.add_argument("--palette", type=str,
                              help = "What kind of palette are you using for measurement and orientation? \
                              0= No Palette \n \
                              1= Small Axes Palette \n \
                              2= Large Axes Palette \n \
                              3= Labelled Protractor \n \
                             4= Acute Protractor \n \
-                            5=CHI Markers",
+                            5=CHI Markers \n \
+                            or the name of any palette in util/MarkerPalettes.json",
                             
                              default=0)
+    buildparser.add_argument("--resume", action="store_true",
+                             help="Skip tasks that the project's task journal says already completed, as long as their inputs haven't changed.")
     multibandparser.add_argument("sourcedir", help="Location of raw files")
     multibandparser.add_argument("projectdir",help="location to store masks")   
     multibandparser.add_argument("projectname", help="The name of the project to build.")
@@ -274,6 +338,34 @@ if __name__=="__main__":
                                     4 = Grayscale Thresholding, \n \
                                     5 = AI \n",
                             default=0)
+    queueparser = subparsers.add_parser("queue", help="Inspect, reorder and run the queue of builds shared by the watcher and the UI.")
+    queuesub = queueparser.add_subparsers(help="Queue command help")
+    queuelist = queuesub.add_parser("list", help="List queued builds in the order they will run.")
+    queuelist.add_argument("--all", action="store_true", help="Include finished, failed and cancelled builds.")
+    queuelist.set_defaults(func=queue_list_cmd)
+    queuesubmit = queuesub.add_parser("submit", help="Add a build to the queue.")
+    queuesubmit.add_argument("sourcedir", help="Location of raw files")
+    queuesubmit.add_argument("projectdir",help="location to build the project in")
+    queuesubmit.add_argument("projectname", help="The name of the project to build.")
+    queuesubmit.add_argument("--maskoption", type = str, choices=["0","1","2","3","4","5"], default=0, help="How to build masks, as for build.")
+    queuesubmit.add_argument("--palette", type=str, default="0", help="The palette, as for build.")
+    queuesubmit.add_argument("--priority", type=int, default=0, help="Builds with a higher priority run first.")
+    queuesubmit.set_defaults(func=queue_submit_cmd)
+    queuepriority = queuesub.add_parser("priority", help="Change the priority of a queued build.")
+    queuepriority.add_argument("jobid", type=int)
+    queuepriority.add_argument("priority", type=int)
+    queuepriority.set_defaults(func=queue_priority_cmd)
+    queuefront = queuesub.add_parser("front", help="Make a queued build the next one to run.")
+    queuefront.add_argument("jobid", type=int)
+    queuefront.set_defaults(func=queue_front_cmd)
+    queuecancel = queuesub.add_parser("cancel", help="Cancel a queued build, stopping it if it's running.")
+    queuecancel.add_argument("jobid", type=int)
+    queuecancel.set_defaults(func=queue_cancel_cmd)
+    queueclear = queuesub.add_parser("clear", help="Remove finished, failed and cancelled builds from the queue.")
+    queueclear.set_defaults(func=queue_clear_cmd)
+    queuerun = queuesub.add_parser("run", help="Run the builds in the queue.")
+    queuerun.add_argument("--forever", action="store_true", help="Keep waiting for new builds when the queue is empty.")
+    queuerun.set_defaults(func=queue_run_cmd)
     multibandparser.set_defaults(func=build_multibanded_cmd)
     buildparser.set_defaults(func = build_model_cmd)
     maskparser.set_defaults(func=build_masks_cmd)
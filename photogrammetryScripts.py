@@ -1,32 +1,35 @@
-
-
-
 import os.path, json, argparse
-import time
+import threading
 from pathlib import Path
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
-from util.util import MaskingOptions, copy_file_to_dest, should_prune, get_export_filename
+from util.util import MaskingOptions, stage_files_to_dest, get_export_filename
 from util.PipelineLogging import getLogger as getGlobalLogger
 from util.Configurator import Configurator
 from util.InstrumentationStatistics import InstrumentationStatistics as statistics
 from util.InstrumentationStatistics import Statistic_Event_Types
-from processing import image_processing
+#processing.image_processing loads rawpy, lensfunpy and cv2, so it is imported inside the functions that need it.
 from transfer import transferscripts
 
 from postprocessing import MeshlabHelpers
-from util.buildManifest import Manifest
+from util.Cancellation import CancellationToken
+from util.MemoryBudget import MemoryBudget, estimateImageBytes
+from util.PrunePlan import PrunePlan
+#the watchers are in photogrammetryWatchers, which loads watchdog, so the commands that run them import it when they start.
 
 def get_logger():
     return getGlobalLogger(__name__)
 #Global Variables
-#because the callback methods are static for the watchers, we need a place to store the manifest of the files they are transfering.
+#because the callback methods are static for the watchers in photogrammetryWatchers, we need a place to store the manifest of the files they are transfering.
 MANIFEST = None
 #This is the config file. I'm storing it in a global variable so I don't have to pass it or load it from disk constantly.
 _CONFIG = {}
 #prune is a boolean on whether the listener should prune pictures from the ortery or not. Probably ought to come up with
 # a non global var way of doing this.
 PRUNE = False
+#the cancellation token of the running watcher, so the static handler callbacks can stop waiting on files when the watcher stops.
+STOP_TOKEN = None
+#the recipient's ManifestVerifier, which checks pictures against the sender's streamed .jsonl manifest as they arrive, so that
+#verifyManifest can use its results.
+VERIFIER = None
 #logger is a logger. all methods to go to the console in the ui should use this so that we can filter the normal metashape and debugging messages from things like 
 #instrumentation.
 
@@ -41,12 +44,25 @@ def process_images(args):
     args: an argument object passed by the command line that has attributes inputimage (str) and outputdir (str)
       
     """
+    from processing import image_processing
     image_processing.process_image(args.inputimage,args.outputdir,_CONFIG["processing"])
 
 
+def _listNames(directory)->set:
+    """Lists a folder once, which is much cheaper over SMB than asking whether each file exists.
+
+    returns: the set of file names in directory, normalized for case where the platform ignores case, or an empty set if it doesn't exist.
+    """
+    try:
+        with os.scandir(directory) as it:
+            return {os.path.normcase(e.name) for e in it if e.is_file()}
+    except OSError:
+        return set()
+
 def verifyManifest( manifest:dict, basedir):
     """Goes through a dictionary taken from a manifest file on disk and checks to see that all of
     the RAW files are there, all the mask files have been made, and all of the tifs have been made.
+    Each folder is listed once, and the tifs and masks that are missing are made in parallel, as far as the memory budget allows.
     
     Parameters"
     ---------------
@@ -55,6 +71,10 @@ def verifyManifest( manifest:dict, basedir):
     
     returns: succeeded, full_manifest, where succeeded is true if all the masks and tifs and raw files expected were found, and 
     manifest contains each of these files and their full paths in the format {"raw":[],"tif":[],"masks":[]}"""
+    from processing import image_processing
+    from concurrent.futures import ThreadPoolExecutor
+    from tasks.TaskScheduler import getConfiguredLimits
+    from tasks.BaseTask import ResourceClass
     #check to see if all the masks and tifs have been made for this manifest.
     config = Configurator.getConfig()
     scratchdir = config.getProperty("watcher","temp_scratch")
@@ -63,184 +83,79 @@ def verifyManifest( manifest:dict, basedir):
     files = manifest[project]["files"]
     destformat = config.getProperty("processing","Destination_Type").upper()
     fullmanifest = {"source":[],"masks":[],"processed":[]}
+    processedpath = os.path.join(scratchdir,"processed")
     maskpath = os.path.join(scratchdir,"Masks")
     maskext=config.getProperty("photogrammetry","mask_ext")
-    isMasked = manifest[project]["maskmode"] !=0
+    #build_model_from_manifest has already turned maskmode into a MaskingOptions.
+    isMasked = MaskingOptions(manifest[project]["maskmode"]) != MaskingOptions.NOMASKS
+    #pictures the verifier has already checked against the streamed manifest don't need to be checked again.
+    verified = VERIFIER.getResults(project) if VERIFIER is not None else {}
+    sources = _listNames(basedir)
+    processed = _listNames(processedpath)
+    masks = _listNames(maskpath) if isMasked else set()
+    #masks made on the sender are trusted as they are, unless the streamed manifest said they didn't arrive intact.
+    masksubdir = config.getProperty("photogrammetry","mask_path")
+    sendermasks = set()
+    if isMasked and manifest[project].get("stages",{}).get("mask"):
+        damaged = {os.path.normcase(k.split("/")[-1]) for k,ok in verified.items() if ok is False and k.startswith(f"{masksubdir}/")}
+        sendermasks = _listNames(os.path.join(basedir,masksubdir))-damaged
+    repairs = [] #(source, processed file, convert?, mask?)
     for f in files:
         basename_with_ext = os.path.split(f)[1]
         basename = os.path.splitext(basename_with_ext)[0]
-        if not os.path.exists(os.path.join(basedir,basename_with_ext)):
+        if verified.get(basename_with_ext) is False:
+            get_logger().warning("%s did not match the streamed manifest. Manifest verification will fail.",basename_with_ext)
+            foundallfiles = False
+            continue
+        if basename_with_ext not in verified and os.path.normcase(basename_with_ext) not in sources:
             get_logger().warning("Did not find Original file: %s in %s. Manifest verification will fail.",basename_with_ext,basedir)
-            foundallfiles &= False
-        elif foundallfiles:
-            #check to see if the processed version of the original image exists in the expected location, and if so, inventory it.
-            fullmanifest["source"].append(os.path.join(basedir,basename_with_ext))
-            processedpath = os.path.join(scratchdir,"processed")
-            if not os.path.exists(os.path.join(processedpath,f"{basename}{destformat}")):
-                get_logger().info("Did not find %s  file for %s in %s. Attempting to convert or transfer.",destformat,basename_with_ext,processedpath)
-                image_processing.process_image(os.path.join(basedir,basename_with_ext),processedpath,destformat)                   
-
-            processedfile = os.path.join(processedpath,f"{basename}{destformat}")
-            fullmanifest["processed"].append(processedfile)
-            foundallfiles &= os.path.exists(processedfile)
-            if isMasked:
-                if not os.path.exists(os.path.join(maskpath,f"{basename}{maskext}")):
-                    get_logger().info("Warning: did not find mask for %s in %s. Attempting to make one.", basename_with_ext,maskpath)
-                    image_processing.build_masks(processedfile,
-                                                 maskpath,
-                                                 manifest[project]["maskmode"])
-                maskfile = os.path.join(maskpath,f"{basename}{maskext}")
-                fullmanifest["masks"].append(maskfile)
-                foundallfiles &= os.path.exists(maskfile)
-    return foundallfiles,fullmanifest
-
-class WatcherSenderHandler(FileSystemEventHandler):
-    """Listen in the specified directory for cr2 files. It extends Watchdog.FilesystemEventHandler"""
-    @staticmethod
-    def on_any_event(event):
-        """Event handler for any file system event. When an event of the type file created happens, if a CR2 file is created, the files will be processed and converted to TIF
-        if a manifest file is created, a model will be built based on the manifest's files.
-        Parameters:
-        -------------------
-        event: a watchdog.event from the watchdog library.
-        """
-
-        ext = os.path.splitext(event.src_path)[1].upper()
-        if event.event_type=="created" and ext in[".CR2",".JPG",".TIF"]:
-            fn = os.path.splitext(event.src_path)[0]
-            if not fn.endswith('rj'):#Ortery makes two files, one ending in rj, when it imports to the temp folder.
-                if not should_prune(event.src_path):
-                    last_size = -1
-                    current_size = os.path.getsize(event.src_path)
-                    while True:
-                        time.sleep(1)
-                        last_size = current_size
-                        current_size = os.path.getsize(event.src_path)
-                        get_logger().debug("%s :%s for %s",last_size,current_size,event.src_path)
-                        if current_size==last_size:
-                            break
-                    if current_size >0:    
-                        netdrive = Configurator.getConfig().getProperty("watcher","networkdrive")
-                        transferscripts.transferToNetworkDirectory(netdrive, [event.src_path])
-                        fn = Path(event.src_path).name
-                        global MANIFEST
-                        MANIFEST.addFile(fn)
-                        get_logger().info("Added file to manifest: %s",fn)
-
-
-class WatcherRecipientHandler(FileSystemEventHandler):
-    """This is the handler class for the watcher. It handles any filesystem event that happens while the watcher is running.
-    It extends Watchdog.FilesystemEventHandler."""
-    @staticmethod
-    def process_incomming_file(eventpath):
-        config = Configurator.getConfig()
-        if eventpath.endswith("_manifest.txt"):
-            build_model_from_manifest(eventpath)
-        else:
-            scratchdir = config.getProperty("watcher","temp_scratch")
-            maskpath = os.path.join(scratchdir,config.getProperty("photogrammetry","mask_path"))
-            desttype =config.getProperty("processing","Destination_Type")
-            imagetypes = [".CR2",".JPG",".TIF"]
-            eventpathext = os.path.splitext(eventpath)[1].upper()
-            processedpath = os.path.join(scratchdir,"processed")
-            basename_with_ext = os.path.split(eventpath)[1]
-            basename = os.path.splitext(basename_with_ext)[0]
-            
-            if eventpathext in imagetypes and eventpathext != desttype.upper():
-                image_processing.process_image(eventpath,processedpath,desttype)
-            elif eventpathext ==desttype.upper():
-                copy_file_to_dest([eventpath],processedpath, False)
+            foundallfiles = False
+            continue
+        sourcefile = os.path.join(basedir,basename_with_ext)
+        processedfile = os.path.join(processedpath,f"{basename}{destformat}")
+        fullmanifest["source"].append(sourcefile)
+        fullmanifest["processed"].append(processedfile)
+        convert = os.path.normcase(f"{basename}{destformat}") not in processed
+        if convert:
+            get_logger().info("Did not find %s  file for %s in %s. Attempting to convert or transfer.",destformat,basename_with_ext,processedpath)
+        mask = False
+        if isMasked:
+            maskname = os.path.normcase(f"{basename}{maskext}")
+            if maskname not in masks and maskname in sendermasks:
+                fullmanifest["masks"].append(os.path.join(basedir,masksubdir,f"{basename}{maskext}"))
             else:
-                print("Unrecognized filetype: {eventpathext}")
-                return
-            defmask = config.getProperty("processing","ListenerDefaultMasking")
-            mode = MaskingOptions.friendlyToEnum(defmask)
-            if mode !=  MaskingOptions.NOMASKS.value:
-                image_processing.build_masks(os.path.join(processedpath,f"{basename}{desttype}"),maskpath,mode)
-
-
-    @staticmethod
-    def on_any_event(event):
-        """Event handler for any file system event. When an event of the type file created happens, if a CR2 file is created, the files will be processed and converted to TIF
-        if a manifest file is created, a model will be built based on the manifest's files.
-        Parameters:
-        -------------------
-        event: a watchdog.event from the watchdog library.
-        """
-        if event.event_type=="created":
-            ext = os.path.splitext(event.src_path)
-            if len(ext) <2:
-                return
-            extlist = [".jpg",".cr2",".tif",".txt",".json"]
-            if ext[1].lower() in extlist:
-                last_size = -1
-                current_size = os.path.getsize(event.src_path)
-                while True:
-                    time.sleep(1)
-                    last_size = current_size
-                    current_size = os.path.getsize(event.src_path)
-                    print(f"{last_size} :{current_size} for {event.src_path}")
-                    
-                    if current_size==last_size:
-                        break
-                if current_size != 0:
-                    WatcherRecipientHandler.process_incomming_file(event.src_path)
-
-class Watcher:
-    """These classes are part of a filesystem watcher which watches for the 
-    appearance of a manifest file in the desired directory, then builds a model with the pictures
-    
-    Methods:
-    ------------------------
-    __init__(self,directory):initializes the class to watch a particular directory, configurabe in config.json.
-    run(): makes a watcherHandler object and waits for it to intercept filesystem events.
-    """
-    def __init__(self,  watchdir:str, isSender = False, projectname=""):
-        self.observer = Observer()
-        self.watched_dir = watchdir
-        self.isSender = isSender
-        self.projectname = projectname
-        self.maskmode = 0
-        self.stoprequest = False
-
-    def run(self):
-        """Manages the threads for the watcher scripts. Basically schedules threads to listen for changes to a folder on the filesystem
-        and sleeps until there is either an exception or the user presses the F key. Note that this non-blocking user input check is 
-        Windows Only and will have to be fixed to make this script mac/linux compatible. When the user hits the F key, if they are running
-        the listen_and_send scripts, it will send a manifest of the files that were transfered."""
-
-        if not self.isSender:
-            handler = WatcherRecipientHandler()
-            
-        else:
-            global MANIFEST
-            MANIFEST = Manifest(self.projectname, self.maskmode)
-            handler = WatcherSenderHandler()
+                fullmanifest["masks"].append(os.path.join(maskpath,f"{basename}{maskext}"))
+                mask = maskname not in masks
+            if mask:
+                get_logger().info("Warning: did not find mask for %s in %s. Attempting to make one.", basename_with_ext,maskpath)
+        if convert or mask:
+            repairs.append((sourcefile,processedfile,convert,mask))
+    if not foundallfiles:
+        return foundallfiles,fullmanifest
+    if repairs:
+        budget = MemoryBudget.getBudget()
+        def repair(job):
+            sourcefile, processedfile, convert, mask = job
+            operation = "raw_convert" if sourcefile.upper().endswith(".CR2") else "tif_convert"
+            try:
+                with budget.reserve(estimateImageBytes(sourcefile,operation),operation,STOP_TOKEN):
+                    if convert:
+                        image_processing.process_image(sourcefile,processedpath,destformat)
+                    if mask:
+                        image_processing.build_masks(processedfile,maskpath,manifest[project]["maskmode"])
+            except Exception as e:
+                get_logger().error("Could not make the missing files for %s: %s",sourcefile,e)
+        with ThreadPoolExecutor(max_workers=max(1,min(len(repairs),getConfiguredLimits().get(ResourceClass.CPU_POOL,1)))) as pool:
+            list(pool.map(repair,repairs))
+        #list the folders again to see that the repairs made everything they should have.
+        processed = _listNames(processedpath)
+        masks = _listNames(maskpath) if isMasked else set()
+        for f in fullmanifest["processed"]:
+            foundallfiles &= os.path.normcase(os.path.basename(f)) in processed
+        for f in fullmanifest["masks"]:
+            foundallfiles &= os.path.normcase(os.path.basename(f)) in masks or os.path.dirname(f) != maskpath
+    return foundallfiles,fullmanifest
 
-        self.observer.schedule(handler,self.watched_dir,recursive=True)
-        self.observer.start()
-        try:
-            get_logger().info("Waiting for pictures to process.")
-            listening=True
-            print("Type F to Finish.")           
-            while listening :
-                time.sleep(1)
-                if self.stoprequest:
-                    listening=False
-                    self.observer.stop()
-                    self.stoprequest=False
-        except Exception as e:
-            get_logger().error("Halting threads due to exception %s",e)
-            self.observer.stop()
-        finally:
-            get_logger().info("Watcher stopping.")
-            self.observer.join()
-        if  self.isSender and MANIFEST:
-           
-            manifestpath=MANIFEST.finalize(".").resolve()
-            get_logger().info("Sending manifest %s",manifestpath)
-            netdrive = Configurator.getConfig().getProperty("watcher","networkdrive")
-            transferscripts.transferToNetworkDirectory(netdrive,[manifestpath])
 
 def listen_and_send(args):
     """Listens for incoming cr2 files and sends them to the network drive to be converted to tifs and then processed"
@@ -257,11 +172,79 @@ def listen_and_send(args):
     masktype = int(args.maskoption) if args.maskoption else 0
     if not os.path.exists(inputdir):
         print(f"Cannot listen on a directory that does not exist: {inputdir}")
-    watcher = Watcher(inputdir,isSender=True, projectname = args.projectname)
+    if getattr(args,"daemon",False):
+        from watcherDaemon import AsyncWatcher
+        watcher = AsyncWatcher(inputdir,isSender=True, projectname = args.projectname)
+    else:
+        from photogrammetryWatchers import Watcher
+        watcher = Watcher(inputdir,isSender=True, projectname = args.projectname)
     watcher.maskmode = masktype
 
     watcher.run()
         
+def parse_session_spec(spec:str)->dict:
+    """Reads a capture from the command line, written projectname[:subdir[:maskmode]].
+
+    returns: a dictionary with the keys projectname, subdir and maskmode.
+    """
+    parts = spec.split(":")
+    if not parts[0] or len(parts) > 3:
+        raise ValueError(f"A capture is written projectname[:subdir[:maskmode]], not {spec}")
+    return {"projectname":parts[0],
+            "subdir":parts[1] if len(parts) > 1 and parts[1] else parts[0],
+            "maskmode":int(parts[2]) if len(parts) > 2 and parts[2] else 0}
+
+def add_session(sender, session:dict):
+    """Adds a capture described by parse_session_spec, or by an entry of a sessions file, to a MultiSessionSender. An entry can
+    give its own pics_per_revolution and pics_per_cam for a rig that isn't set up like config.json->ortery."""
+    pruneplan = None
+    if "pics_per_cam" in session:
+        config = Configurator.getConfig()
+        pruneplan = PrunePlan(session.get("pics_per_revolution",config.getProperty("ortery","pics_per_revolution")),
+                              session["pics_per_cam"])
+    sender.addSession(session["projectname"],session.get("subdir"),int(session.get("maskmode",0)),pruneplan)
+
+def multi_send_cmd(args):
+    """Sends several captures at once from subfolders of the listen folder, each to its own folder on the network drive with its
+    own manifest. While it runs, typing "add projectname[:subdir[:maskmode]]" starts another capture, "finish projectname"
+    finishes one, and "F" finishes them all.
+
+    Parameters:
+    --------------------------
+    args: Argument object from the command line with the following attributes: sessions: captures written
+    projectname[:subdir[:maskmode]]. sessionfile: an optional json file with a list of captures, each a dictionary with the keys
+    projectname and optionally subdir, maskmode, pics_per_revolution and pics_per_cam. inputdir: an optional listen folder.
+    """
+    from photogrammetryWatchers import MultiSessionSender
+    sender = MultiSessionSender(args.inputdir)
+    sessions = [parse_session_spec(s) for s in args.sessions]
+    if args.sessionfile:
+        with open(args.sessionfile,'r',encoding="utf-8") as f:
+            sessions += json.load(f)
+    for session in sessions:
+        add_session(sender,session)
+    def readcommands():
+        while not sender.token.isCancelled():
+            try:
+                line = input().strip()
+            except EOFError:
+                return
+            command, _, arg = line.partition(" ")
+            try:
+                if command.upper() == "F":
+                    sender.stop()
+                elif command == "add":
+                    add_session(sender,parse_session_spec(arg.strip()))
+                elif command == "finish":
+                    print(f"Sent manifest {sender.finishSession(arg.strip())}")
+                elif command:
+                    print('Type "add projectname[:subdir[:maskmode]]", "finish projectname" or F to finish them all.')
+            except (ValueError, KeyError) as e:
+                print(e)
+    print('Type "add projectname[:subdir[:maskmode]]", "finish projectname" or F to finish them all.')
+    threading.Thread(target=readcommands,daemon=True).start()
+    sender.run()
+
 def watch_and_process_cmd(args):
     """function that controls the watcher script which initializes a build when pictures and a manifest are added to a specified directory.
     Parameters:
@@ -269,6 +252,7 @@ def watch_and_process_cmd(args):
     args: Argument object handed from the command line which has the following attributes:
     inputdir: a directory to listen on. If this is not specified in the command line, the watcher->listen directory 
     will be used from config.json.
+    daemon: if set, run the asyncio watcher from watcherDaemon instead.
     """
     inputdir = args.inputdir if args.inputdir else Configurator.getConfig().getProperty("watcher","listen_directory")
     scratchdir = Configurator.getConfig().getProperty("watcher","temp_scratch")
@@ -277,9 +261,55 @@ def watch_and_process_cmd(args):
     if not inputdir:
         print("Input Directory needed if not provided in config.json. (Check Watcher:Listen_Directory)")
         return
-    watcher = Watcher(inputdir,isSender=False)
+    if getattr(args,"daemon",False):
+        from watcherDaemon import AsyncWatcher
+        watcher = AsyncWatcher(inputdir,isSender=False)
+    else:
+        from photogrammetryWatchers import Watcher
+        watcher = Watcher(inputdir,isSender=False)
     watcher.run()
 
+def work_queue_cmd(args):
+    """Turns this PC into a worker that helps whichever machine is building with conversion and masking. It claims work items
+    from the shared work queue, runs them here and writes the results back to the network share, until Ctrl+C.
+    Parameters:
+    ---------------
+    args: Argument object handed from the command line which has the following attributes:
+    queuedir: the shared queue directory. If this is not specified in the command line, workqueue->queue_dir from config.json is used.
+    once: if set, stop as soon as the queue is empty.
+    """
+    from tasks.WorkQueue import DirectoryWorkQueue, getQueueDir, runWorker
+    queuedir = args.queuedir if args.queuedir else getQueueDir()
+    if not queuedir:
+        print("Queue directory needed if not provided in config.json. (Check workqueue:queue_dir)")
+        return
+    token = CancellationToken()
+    try:
+        completed = runWorker(DirectoryWorkQueue(queuedir),token,once=args.once)
+    except KeyboardInterrupt:
+        token.cancel("Worker stopped from the keyboard.")
+        return
+    get_logger().info("Worker finished %d work items.",completed)
+
+def prune_plan_cmd(args):
+    """Prints the prune plan for the ortery settings in config.json, one line per camera, and optionally which pictures in a folder
+    it would prune.
+    Parameters:
+    ---------------
+    args: Argument object handed from the command line which has the following attributes:
+    imagedir: an optional folder of pictures to preview the plan on.
+    """
+    from util.PrunePlan import PrunePlan
+    plan = PrunePlan.getPlan()
+    print(plan.describe())
+    print(f"{sum(plan.keep)} of {len(plan.keep)} pictures kept.")
+    if args.imagedir:
+        files = sorted((f for f in Path(args.imagedir).iterdir() if PrunePlan.getFrameNumber(f) is not None),key=PrunePlan.getFrameNumber)
+        pruned = [f.name for f in files if plan.shouldPrune(f)]
+        print(f"Would prune {len(pruned)} of {len(files)} pictures in {args.imagedir}:")
+        for f in pruned:
+            print(f"  {f}")
+
 def build_snapshot(projname,basefolder):
     cfg=Configurator.getConfig()
     fn  = get_export_filename(projname,"obj")
@@ -291,12 +321,13 @@ def build_snapshot(projname,basefolder):
                                 cfg.getProperty("postprocessing","rot_z"),True)
 
 #This script contains the full automation flow and is triggered by the watcher
-def build_model_from_manifest(manifestfile:str):
+def build_model_from_manifest(manifestfile:str, token:CancellationToken=None):
     """Builds a model from the files listed in a text file manifest.
 
     Parameters:
     -----------
     manifest: A path to a text file manifest with a comma seperated list of paths to image files.
+    token: an optional CancellationToken that stops the build when it is cancelled, such as the watcher's.
     """
     config = Configurator.getConfig()
     filestoprocess=[]
@@ -322,12 +353,28 @@ def build_model_from_manifest(manifestfile:str):
         if not os.path.exists(project_folder):
             os.mkdir(project_folder)
         masks = os.path.join(project_folder,config.getProperty("photogrammetry","mask_path"))
-        copy_file_to_dest(filestoprocess["masks"],masks, True)
+        #the scratch folder is usually on the same disk as the project folder, in which case this only renames files.
+        stage_files_to_dest(filestoprocess["masks"],masks, True)
         processed= os.path.join(project_folder,"processed")
-        copy_file_to_dest(filestoprocess["processed"],processed, True)
+        stage_files_to_dest(filestoprocess["processed"],processed, True)
         source = os.path.join(project_folder,"source")
-        copy_file_to_dest(filestoprocess["source"],source, True)
-        build_model(projname,processed,project_folder,masktype,snapshot=True)
+        stage_files_to_dest(filestoprocess["source"],source, True)
+        from tasks.BuildQueue import BuildQueue, BuildQueueRunner, useBuildQueue
+        if useBuildQueue():
+            #queue the build rather than running it on the watcher thread, so builds from manifests that arrive together
+            #take turns in metashape.
+            BuildQueue().submit(projname,processed,project_folder,masktype.value,
+                                config.getProperty("photogrammetry","palette"),
+                                manifest[projname].get("priority",0))
+            BuildQueueRunner.ensureBackgroundRunner()
+        else:
+            #the same build the build queue runs, on the watcher's token, so that stopping the watcher stops the build.
+            import photogrammetryPipeline
+            photogrammetryPipeline.build_model_cmd(argparse.Namespace(sourcedir=processed,projectdir=project_folder,projectname=projname,
+                                                                      maskoption=masktype.value,
+                                                                      palette=config.getProperty("photogrammetry","palette"),
+                                                                      resume=True),
+                                                   token)
 
                     
 def build_model(jobname,inputdir,outputdir,mask_option=MaskingOptions.NOMASKS,snapshot=False):
@@ -341,6 +388,7 @@ def build_model(jobname,inputdir,outputdir,mask_option=MaskingOptions.NOMASKS,sn
     config: the full contents of config.json.
     nomasks: boolean value determining whether to build masks or not.
     """
+    from processing import image_processing
     config = Configurator.getConfig()
     try:
         from photogrammetry import MetashapeTools
@@ -448,6 +496,7 @@ def build_masks_cmd(args):
     inputdir: the directory of pictures that need to be masked in TIF format.
     output: the directory where the masks need to get copied when the masking is done.
     """
+    from processing import image_processing
     input = args.inputdir
     output = args.outputdir
     image_processing.build_masks(input,output,int(args.maskoption))
@@ -460,6 +509,7 @@ def convert_raw_to_format_cmd(args):
     inputdir (a directory of images to convert)
     outputdir (a place to put the converted images.)
     """
+    from processing import image_processing
     inputdir = args.imagedirectory
     outputdir = args.outputdirectory
     if not os.path.exists(outputdir):
@@ -524,8 +574,14 @@ if __name__=="__main__":
 
     watcherparser = subparsers.add_parser("watch", help="Watch for incoming files in the directory configured in JSON and build a model out of them.")
     watcherparser.add_argument("--inputdir", help="Optional input directory to watch. The watcher will watch config:watcher:listen_directory by default.", default="")
+    watcherparser.add_argument("--daemon", action="store_true", help="Run the watcher on an asyncio event loop, which handles many more files in flight with fewer threads.")
     watcherparser.set_defaults(func=watch_and_process_cmd)      
 
+    workerparser = subparsers.add_parser("worker", help="Help a build machine by running conversion and masking work from the shared work queue.")
+    workerparser.add_argument("--queuedir", help="Optional queue directory. The worker will use config:workqueue:queue_dir by default.", default="")
+    workerparser.add_argument("--once", action="store_true", help="Stop when the queue is empty instead of waiting for more work.")
+    workerparser.set_defaults(func=work_queue_cmd)
+
     listensendparser = subparsers.add_parser("listenandsend", help="listen for new cr2 files in the specified subdirectory and send them to the network drive, recording them in a manifest.")
     listensendparser.add_argument("projectname", help="Optional input directory to watch. The watcher will watch config:watcher:listen_directory by default.", default="")
     listensendparser.add_argument("--inputdir", help="Optional input directory to watch. The watcher will watch config:watcher:listen_directory by default.", default="")
@@ -537,8 +593,19 @@ if __name__=="__main__":
                                     4 = Grayscale Thresholding",
                             default=0)
     listensendparser.add_argument("--prune", action="store_true", help="If this was taken on the ortery, and you would like to prune certain rounds down to a desired # of pics, pass in this flag and configure the 'pics_per_cam' under ortery in config.json.")
+    listensendparser.add_argument("--daemon", action="store_true", help="Run the sender on an asyncio event loop, which handles many more files in flight with fewer threads.")
     listensendparser.set_defaults(func=listen_and_send)    
 
+    multisendparser = subparsers.add_parser("multisend", help="send several captures at once, each from its own subfolder of the listen folder to its own folder on the network drive, with its own manifest.")
+    multisendparser.add_argument("sessions", nargs="*", help="Captures to send, written projectname[:subdir[:maskmode]]. The subfolder defaults to the project name.", default=[])
+    multisendparser.add_argument("--sessionfile", help="Optional json file with a list of captures, each with projectname and optionally subdir, maskmode, pics_per_revolution and pics_per_cam.", default="")
+    multisendparser.add_argument("--inputdir", help="Optional listen folder. config:watcher:listen_and_send by default.", default="")
+    multisendparser.set_defaults(func=multi_send_cmd)
+
+    pruneparser = subparsers.add_parser("pruneplan", help="Show which pictures of each ortery camera will be kept and which pruned, according to ortery in config.json.")
+    pruneparser.add_argument("--imagedir", help="Optional folder of pictures. If given, lists which of them would be pruned.", default="")
+    pruneparser.set_defaults(func=prune_plan_cmd)
+
    
     modelbyshapeparser = subparsers.add_parser("splitshapes", help="Splits a finished model into cube-shaped sub-components based on shapes pre-drawn by the user in metashape.")
     modelbyshapeparser.add_argument("inputdir",help="Directory of project")
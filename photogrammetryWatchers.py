@@ -0,0 +1,733 @@
+"""The filesystem watchers behind the watch, listenandsend and multisend commands of photogrammetryScripts: the recipient, which
+develops, masks and builds what arrives on the network drive, and the sender, which sends what the capture software writes. They
+are built on watchdog, so they live apart from photogrammetryScripts, and the commands and the UI import them when they start one."""
+
+import os.path, json
+import threading
+import time
+from pathlib import Path
+from queue import Empty
+from concurrent.futures import ThreadPoolExecutor
+from watchdog.observers import Observer
+from watchdog.events import FileSystemEventHandler
+import photogrammetryScripts as scripts
+from util.util import MaskingOptions, copy_file_to_dest, should_prune
+from util.PipelineLogging import getLogger as getGlobalLogger
+from util.Configurator import Configurator
+from transfer import transferscripts
+from util.buildManifest import Manifest, StreamingManifest
+from util.Cancellation import CancellationToken
+from util.FileStabilityTracker import FileStabilityTracker
+from util.MemoryBudget import MemoryBudget, estimateImageBytes
+from util.ProcessingLanes import ProcessingLanes
+from util.ManifestVerifier import ManifestVerifier
+from util.ProcessedStore import ProcessedStore, getStorePath
+from util.EventFilter import EventFilter
+from util.PrunePlan import PrunePlan
+from transfer.TransferQueue import TransferQueue, getTransferPriority
+
+def get_logger():
+    return getGlobalLogger(__name__)
+
+#the folders on the network drive that files sent alongside the pictures go into. The recipient doesn't process them itself.
+RAW_SUBDIR = "raw"
+
+def getSenderStages()->dict:
+    """Reads which processing stages the sender runs on each picture before sending it, from config.json->stages.
+
+    returns: a dictionary with the keys convert and mask, true if the sender converts pictures to the destination type and masks
+    them, mask_mode, the MaskingOptions value it masks with, and send_raw, true if the raw file is sent as well. Masking on the
+    sender implies converting on the sender.
+    """
+    config = Configurator.getConfig()
+    mask = bool(config.getPropertyOrDefault("stages","mask_on_sender",False))
+    return {"convert":mask or bool(config.getPropertyOrDefault("stages","convert_on_sender",False)),
+            "mask":mask,
+            "mask_mode":int(config.getPropertyOrDefault("stages","sender_mask_mode",MaskingOptions.MASK_THRESHOLDING.value)),
+            "send_raw":bool(config.getPropertyOrDefault("stages","send_raw",True))}
+
+class WatcherSenderHandler(FileSystemEventHandler):
+    """Listen in the specified directory for cr2 files. It extends Watchdog.FilesystemEventHandler. New pictures are handed to a
+    FileStabilityTracker, and once they have finished being written, to the watcher's TransferQueue.
+
+    The capture computer is mostly idle while the Ortery turns, so it can be set to convert, and mask, each picture itself (see
+    getSenderStages). Then the converted picture is sent in place of the raw file, its mask goes into the mask folder on the network
+    drive, and the raw file, if it is sent at all, goes into the raw folder, so the recipient only has to copy them into place.
+
+    Parameters:
+    -------------------
+    tracker: the FileStabilityTracker of the running watcher.
+    transfers: the TransferQueue of the running watcher.
+    stages: the stages to run before sending, from getSenderStages.
+    eventfilter: an optional EventFilter that drops events for the pipeline's own files and repeated events.
+    pruneplan: an optional PrunePlan of the capture. Defaults to the plan for config.json->ortery.
+    lane: the lane of the TransferQueue to send into, for a capture sharing the queue with others.
+    scratchdir: where the sender's own stages write. Defaults to the sender folder of watcher->temp_scratch.
+    """
+    def __init__(self, tracker:FileStabilityTracker, transfers:TransferQueue=None, stages:dict=None, eventfilter:EventFilter=None,
+                 pruneplan:PrunePlan=None, lane:str=None, scratchdir:str=None):
+        super().__init__()
+        self.tracker = tracker
+        self.eventfilter = eventfilter
+        self.transfers = transfers
+        self.stages = stages if stages is not None else {"convert":False,"mask":False,"send_raw":True}
+        self.pruneplan = pruneplan
+        self.lane = lane
+        self.scratchdir = scratchdir if scratchdir else WatcherSenderHandler.getScratchDir()
+
+    @staticmethod
+    def getScratchDir()->str:
+        return os.path.join(Configurator.getConfig().getProperty("watcher","temp_scratch"),"sender")
+
+    def send(self, path:str):
+        """Runs the configured stages on a picture that has finished being written and queues what they make to be sent. Called on
+        the watcher's stage workers if there are stages to run, otherwise straight from the stability tracker."""
+        for args in self.prepare(path):
+            self.transfers.submit(*args,lane=self.lane)
+
+    def prepare(self, path:str)->list:
+        """Runs the configured stages on a picture.
+
+        returns: a list of what to send for the picture, each as the arguments to TransferQueue.submit: (path, priority, subdir, source)
+        """
+        if not self.stages["convert"]:
+            return [(path,getTransferPriority(path),"",None)]
+        from processing import image_processing
+        config = Configurator.getConfig()
+        scratchdir = self.scratchdir
+        desttype = config.getProperty("processing","Destination_Type")
+        maskdir = config.getProperty("photogrammetry","mask_path")
+        basename = Path(path).stem
+        priority = getTransferPriority(path)
+        processedfile = os.path.join(scratchdir,"processed",f"{basename}{desttype}")
+        operation = "raw_convert" if path.upper().endswith(".CR2") else "tif_convert"
+        with MemoryBudget.getBudget().reserve(estimateImageBytes(path,operation),operation,self.tracker.token):
+            if not path.upper().endswith(desttype.upper()):
+                image_processing.process_image(path,os.path.join(scratchdir,"processed"),desttype)
+            else:
+                processedfile = path
+            if self.stages["mask"]:
+                image_processing.build_masks(processedfile,os.path.join(scratchdir,maskdir),MaskingOptions(self.stages["mask_mode"]))
+        #the mask goes first, so that it is there by the time the recipient starts on the picture.
+        tosend = []
+        if self.stages["mask"]:
+            maskfile = os.path.join(scratchdir,maskdir,f"{basename}{config.getProperty('photogrammetry','mask_ext')}")
+            if os.path.exists(maskfile):
+                tosend.append((maskfile,priority+(0,),maskdir,Path(processedfile).name))
+            else:
+                get_logger().warning("Could not make a mask for %s on the sender. The recipient will make it.",path)
+        tosend.append((processedfile,priority+(1,),"",None))
+        if self.stages["send_raw"] and processedfile != path:
+            tosend.append((path,priority+(2,),RAW_SUBDIR,Path(processedfile).name))
+        return tosend
+
+    @staticmethod
+    def wants(path:str, pruneplan:PrunePlan=None)->bool:
+        ext = os.path.splitext(path)[1].upper()
+        fn = os.path.splitext(path)[0]
+        if ext not in [".CR2",".JPG",".TIF"] or fn.endswith('rj'):
+            #Ortery makes two files, one ending in rj, when it imports to the temp folder.
+            return False
+        return not (pruneplan.shouldPrune(path) if pruneplan is not None else should_prune(path))
+
+    def on_any_event(self, event):
+        """Event handler for any file system event. When a picture is created, or moved into the folder, it is tracked until it
+        has finished being written. Close-write events, where the platform sends them, let the tracker skip waiting for the file to settle.
+        Parameters:
+        -------------------
+        event: a watchdog.event from the watchdog library.
+        """
+        if event.is_directory:
+            return
+        if event.event_type in ["created","moved"]:
+            path = event.dest_path if event.event_type=="moved" else event.src_path
+            if WatcherSenderHandler.wants(path,self.pruneplan) and (self.eventfilter is None or self.eventfilter.accept(path)):
+                self.tracker.track(path)
+        elif event.event_type=="closed":
+            self.tracker.closed(event.src_path)
+
+    @staticmethod
+    def transferred(result:dict):
+        """Called by the transfer queue when a picture has been copied to the network drive, or failed to be. Adds copied pictures to
+        the manifest."""
+        WatcherSenderHandler.record_transfer(scripts.MANIFEST,result)
+
+    @staticmethod
+    def record_transfer(manifest:Manifest, result:dict):
+        """Adds a file that was copied to the network drive to a manifest, and deletes it if the sender made it itself.
+
+        Parameters:
+        -------------------
+        manifest: the manifest of the capture the file belongs to.
+        result: the TransferEngine result of the copy.
+        """
+        fn = Path(result["file"]).name
+        if not result["ok"]:
+            get_logger().error("Could not send %s: %s",fn,result.get("error"))
+            return
+        if result.get("subdir"):
+            manifest.addDerivedFile(f"{result['subdir']}/{fn}",result.get("source"),result.get("checksum"),result.get("size"))
+        else:
+            manifest.addFile(fn,result.get("checksum"),result.get("size"))
+        get_logger().info("Added file to manifest: %s",fn)
+        #what the sender made itself is only kept until it has been sent.
+        senderscratch = os.path.normcase(os.path.abspath(WatcherSenderHandler.getScratchDir()))
+        if os.path.normcase(os.path.abspath(result["file"])).startswith(senderscratch+os.sep):
+            os.remove(result["file"])
+
+
+class WatcherRecipientHandler(FileSystemEventHandler):
+    """This is the handler class for the watcher. It handles any filesystem event that happens while the watcher is running.
+    It extends Watchdog.FilesystemEventHandler."""
+    @staticmethod
+    def is_manifest(eventpath)->bool:
+        return str(eventpath).endswith("_manifest.txt")
+
+    @staticmethod
+    def process_incomming_file(eventpath):
+        if WatcherRecipientHandler.is_manifest(eventpath):
+            scripts.build_model_from_manifest(eventpath,scripts.STOP_TOKEN)
+        else:
+            WatcherRecipientHandler.process_image_file(eventpath)
+
+    @staticmethod
+    def process_image_file(eventpath):
+        """Develops a picture that has arrived into the scratch folder and masks it. Called by the watcher's image workers, several
+        at a time, so each picture reserves its memory from the MemoryBudget first."""
+        operation = "raw_convert" if eventpath.upper().endswith(".CR2") else "tif_convert"
+        with MemoryBudget.getBudget().reserve(estimateImageBytes(eventpath,operation),operation,scripts.STOP_TOKEN):
+            processedfile = WatcherRecipientHandler.convert_image_file(eventpath)
+            if processedfile is None:
+                return
+            if WatcherRecipientHandler.copy_sender_mask(eventpath):
+                return
+            mode = WatcherRecipientHandler.get_mask_mode()
+            if mode !=  MaskingOptions.NOMASKS.value:
+                WatcherRecipientHandler.mask_image_file(processedfile,mode)
+
+    @staticmethod
+    def convert_image_file(eventpath)->str:
+        """Develops a picture into the processed folder of the scratch folder, or copies it there if it is already the destination type.
+
+        returns: the path of the processed picture, or None if the picture isn't a type the watcher knows.
+        """
+        from processing import image_processing
+        config = Configurator.getConfig()
+        desttype =config.getProperty("processing","Destination_Type")
+        imagetypes = [".CR2",".JPG",".TIF"]
+        eventpathext = os.path.splitext(eventpath)[1].upper()
+        processedpath = os.path.join(config.getProperty("watcher","temp_scratch"),"processed")
+        basename = os.path.splitext(os.path.split(eventpath)[1])[0]
+        if eventpathext in imagetypes and eventpathext != desttype.upper():
+            image_processing.process_image(eventpath,processedpath,desttype)
+        elif eventpathext ==desttype.upper():
+            copy_file_to_dest([eventpath],processedpath, False)
+        else:
+            print(f"Unrecognized filetype: {eventpathext}")
+            return None
+        return os.path.join(processedpath,f"{basename}{desttype}")
+
+    @staticmethod
+    def copy_sender_mask(eventpath)->bool:
+        """If the sender masked the picture, its mask is already on the network drive, so it is copied into the scratch folder.
+
+        returns: true if there was a mask from the sender.
+        """
+        config = Configurator.getConfig()
+        maskdir = config.getProperty("photogrammetry","mask_path")
+        basename = os.path.splitext(os.path.split(eventpath)[1])[0]
+        sendermask = os.path.join(os.path.dirname(eventpath),maskdir,f"{basename}{config.getProperty('photogrammetry','mask_ext')}")
+        if not os.path.exists(sendermask):
+            return False
+        copy_file_to_dest([sendermask],os.path.join(config.getProperty("watcher","temp_scratch"),maskdir), False)
+        return True
+
+    @staticmethod
+    def get_mask_mode():
+        return MaskingOptions.friendlyToEnum(Configurator.getConfig().getProperty("processing","ListenerDefaultMasking"))
+
+    @staticmethod
+    def mask_image_file(processedfile, mode):
+        from processing import image_processing
+        config = Configurator.getConfig()
+        maskpath = os.path.join(config.getProperty("watcher","temp_scratch"),config.getProperty("photogrammetry","mask_path"))
+        image_processing.build_masks(processedfile,maskpath,mode)
+
+
+    def __init__(self, tracker:FileStabilityTracker, verifier:ManifestVerifier=None, eventfilter:EventFilter=None):
+        super().__init__()
+        self.tracker = tracker
+        self.verifier = verifier
+        self.eventfilter = eventfilter
+
+    @staticmethod
+    def wants(path:str)->bool:
+        #masks and raw files the sender sent alongside converted pictures are picked up with their pictures.
+        if Path(path).parent.name in [RAW_SUBDIR,Configurator.getConfig().getProperty("photogrammetry","mask_path")]:
+            return False
+        return os.path.splitext(path)[1].lower() in [".jpg",".cr2",".tif",".txt",".json"]
+
+    def on_any_event(self, event):
+        """Event handler for any file system event. When a picture or manifest is created, or moved into the folder, it is tracked
+        until it has finished being written, and then process_incomming_file is called for it. Close-write events, where the platform
+        sends them, let the tracker skip waiting for the file to settle. A streamed .jsonl manifest is never finished until the capture
+        is, so it goes straight to the verifier instead. Events for the pipeline's own output and repeated events for a file are
+        dropped by the event filter.
+        Parameters:
+        -------------------
+        event: a watchdog.event from the watchdog library.
+        """
+        if event.is_directory:
+            return
+        if self.verifier is not None and event.event_type in ["created","modified","moved"]:
+            path = event.dest_path if event.event_type=="moved" else event.src_path
+            if ManifestVerifier.isStreamManifest(path):
+                self.verifier.watch(path)
+                return
+        if event.event_type in ["created","moved"]:
+            path = event.dest_path if event.event_type=="moved" else event.src_path
+            if WatcherRecipientHandler.wants(path) and (self.eventfilter is None or self.eventfilter.accept(path)):
+                self.tracker.track(path)
+        elif event.event_type=="closed":
+            self.tracker.closed(event.src_path)
+
+class Watcher:
+    """These classes are part of a filesystem watcher which watches for the 
+    appearance of a manifest file in the desired directory, then builds a model with the pictures
+    
+    Methods:
+    ------------------------
+    __init__(self,directory):initializes the class to watch a particular directory, configurabe in config.json.
+    run(): makes a watcherHandler object and waits for it to intercept filesystem events.
+    stop(): asks the watcher to stop. Setting stoprequest to True does the same; it reads back False once the watcher has stopped.
+    """
+    def __init__(self,  watchdir:str, isSender = False, projectname=""):
+        self.observer = Observer()
+        self.watched_dir = watchdir
+        self.isSender = isSender
+        self.projectname = projectname
+        self.maskmode = 0
+        self.token = CancellationToken()
+        self._stopped = False
+        self.store = None
+
+    @property
+    def stoprequest(self)->bool:
+        return self.token.isCancelled() and not self._stopped
+
+    @stoprequest.setter
+    def stoprequest(self, value:bool):
+        if value:
+            self.stop()
+
+    def stop(self):
+        self.token.cancel("Watcher stopped.")
+
+    def _processImage(self, path):
+        WatcherRecipientHandler.process_image_file(path)
+        self.store.record(path,"image")
+
+    def _build(self, path):
+        scripts.build_model_from_manifest(path,self.token)
+        #a build cut short by stopping the watcher is picked up again, with --resume, the next time it starts.
+        if not self.token.isCancelled():
+            self.store.record(path,"build")
+
+    def _reconcile(self, tracker:FileStabilityTracker)->int:
+        """Finds the files in the watched folder that arrived while the watcher wasn't running, or whose processing was cut short,
+        and hands them to the tracker as if they had just arrived. Files in the processed file store are skipped, as are pictures
+        whose processed version is already in the scratch folder, and manifests whose pictures have all been moved away by a
+        finished build. Pictures are handed on before manifests, so that builds wait for them. The folders a MultiSessionSender
+        sends each capture into are reconciled along with the watched folder.
+
+        returns: the number of files handed on.
+        """
+        config = Configurator.getConfig()
+        processedpath = os.path.join(config.getProperty("watcher","temp_scratch"),"processed")
+        desttype = config.getProperty("processing","Destination_Type")
+        maskdir = config.getProperty("photogrammetry","mask_path")
+        pictures = []
+        manifests = []
+        entries = []
+        folders = [self.watched_dir]
+        while folders:
+            folder = folders.pop()
+            try:
+                with os.scandir(folder) as it:
+                    for e in it:
+                        if e.is_file() and WatcherRecipientHandler.wants(e.path):
+                            entries.append(e)
+                        elif folder == self.watched_dir and e.is_dir() and e.name not in [RAW_SUBDIR,maskdir]:
+                            folders.append(e.path)
+            except OSError as e:
+                get_logger().error("Could not reconcile %s: %s",folder,e)
+                if folder == self.watched_dir:
+                    return 0
+        for e in entries:
+            if self.store.isProcessed(e.path):
+                continue
+            if WatcherRecipientHandler.is_manifest(e.path):
+                manifests.append(e.path)
+            elif os.path.splitext(e.name)[1].upper() in [".CR2",".JPG",".TIF"]:
+                if os.path.exists(os.path.join(processedpath,f"{os.path.splitext(e.name)[0]}{desttype}")):
+                    self.store.record(e.path,"image")
+                else:
+                    pictures.append(e.path)
+        for manifest in list(manifests):
+            try:
+                with open(manifest,'r',encoding="utf-8") as f:
+                    m = json.load(f)
+                files = m[next(iter(m))]["files"]
+            except (OSError, ValueError, KeyError, StopIteration):
+                continue
+            if files and not any(os.path.exists(os.path.join(os.path.dirname(manifest),os.path.basename(f))) for f in files):
+                self.store.record(manifest,"build")
+                manifests.remove(manifest)
+        for path in pictures+manifests:
+            tracker.track(path)
+        if pictures or manifests:
+            get_logger().info("Reconciling %s: queued %d pictures and %d manifests that were missed.",self.watched_dir,
+                              len(pictures),len(manifests))
+        return len(pictures)+len(manifests)
+
+    def _handleReady(self, tracker:FileStabilityTracker, onready):
+        while not tracker.token.isCancelled():
+            try:
+                path = tracker.ready.get(timeout=0.5)
+            except Empty:
+                continue
+            try:
+                onready(path)
+            except Exception as e:
+                get_logger().error("Could not handle %s: %s",path,e)
+            finally:
+                #the path is the lanes' or the transfer queue's to count now.
+                tracker.ready.task_done()
+
+    def _drain(self, tracker:FileStabilityTracker, transfers:TransferQueue, lanes:ProcessingLanes=None):
+        """Lets the sender finish the pictures that were still being written, converted or copied when the user finished the capture,
+        so that they make it into the manifest. Gives up after transfer->drain_timeout_s."""
+        timeout = float(Configurator.getConfig().getPropertyOrDefault("transfer","drain_timeout_s",600))
+        deadline = time.monotonic()+timeout
+        get_logger().info("Finishing %d transfers before sending the manifest.",transfers.getDepth()+tracker.getPendingCount())
+        while tracker.getPendingCount() > 0 or (lanes is not None and lanes.getBacklog() > 0):
+            if time.monotonic() > deadline:
+                break
+            time.sleep(0.1)
+        if not transfers.waitUntilEmpty(max(0.0,deadline-time.monotonic())):
+            get_logger().warning("Gave up waiting for %d transfers.",transfers.getDepth())
+
+    def run(self):
+        """Manages the threads for the watcher scripts. Basically schedules threads to listen for changes to a folder on the filesystem
+        and sleeps until there is either an exception or the user presses the F key. Note that this non-blocking user input check is 
+        Windows Only and will have to be fixed to make this script mac/linux compatible. When the user hits the F key, if they are running
+        the listen_and_send scripts, the transfers still in progress are finished and then a manifest of the files that were
+        transfered is sent."""
+
+        config = Configurator.getConfig()
+        settle = float(config.getPropertyOrDefault("watcher","settle_seconds",0.5))
+        lanes = None
+        transfers = None
+        verifier = None
+        streaming = bool(config.getPropertyOrDefault("watcher","streaming_manifest",True))
+        if not self.isSender:
+            tracker = FileStabilityTracker(settle=settle,token=self.token)
+            self.store = ProcessedStore(getStorePath())
+            lanes = ProcessingLanes(self._processImage,self._build,
+                                    WatcherRecipientHandler.is_manifest,
+                                    int(config.getPropertyOrDefault("watcher","image_workers",2)),
+                                    int(config.getPropertyOrDefault("watcher","image_queue_size",64)),self.token)
+            lanes.start()
+            if streaming:
+                #pictures that check out against the streamed manifest are queued as soon as their record arrives. The lanes
+                #ignore the second submit when the tracker reports the same picture.
+                verifier = ManifestVerifier(lanes.submit,bool(config.getPropertyOrDefault("transfer","checksum",True)),
+                                            token=self.token)
+                verifier.start()
+            scripts.VERIFIER = verifier
+            handler = WatcherRecipientHandler(tracker,verifier,EventFilter.fromConfig())
+            onready = lanes.submit
+        else:
+            netdrive = config.getProperty("watcher","networkdrive")
+            stages = getSenderStages()
+            if streaming:
+                scripts.MANIFEST = StreamingManifest(self.projectname, self.maskmode, netdrive, stages)
+            else:
+                scripts.MANIFEST = Manifest(self.projectname, self.maskmode, stages)
+            #the sender's pictures keep moving after the user finishes, until they have all been sent, so they get their own token.
+            sendtoken = CancellationToken()
+            tracker = FileStabilityTracker(settle=settle,token=sendtoken)
+            transfers = TransferQueue(netdrive,WatcherSenderHandler.transferred,token=sendtoken)
+            transfers.start()
+            handler = WatcherSenderHandler(tracker,transfers,stages,EventFilter.fromConfig())
+            if stages["convert"]:
+                #converting and masking on the capture computer runs on its own workers, one by default, so that it never
+                #competes with the capture software for more than a core.
+                lanes = ProcessingLanes(handler.send,None,lambda p: False,
+                                        int(config.getPropertyOrDefault("stages","sender_workers",1)),
+                                        int(config.getPropertyOrDefault("watcher","image_queue_size",64)),sendtoken)
+                lanes.start()
+                onready = lanes.submit
+            else:
+                onready = handler.send
+
+        scripts.STOP_TOKEN = self.token
+        #files are handed on from their own thread, so a full image lane never holds up the observer or the tracker.
+        consumer = threading.Thread(target=self._handleReady,args=(tracker,onready),daemon=True)
+        tracker.start()
+        consumer.start()
+        self.observer.schedule(handler,self.watched_dir,recursive=True)
+        self.observer.start()
+        finished = False
+        #the recipient catches up on files that arrived while it was down, once the observer is running so nothing new is missed,
+        #and again every watcher->reconcile_interval_s in case an event was dropped.
+        reconcileinterval = float(config.getPropertyOrDefault("watcher","reconcile_interval_s",300))
+        nextreconcile = time.monotonic() if self.store is not None else None
+        try:
+            get_logger().info("Waiting for pictures to process.")
+            print("Type F to Finish.")           
+            #wait in one second steps so that ctrl+c still works on windows, where an untimed wait can't be interrupted.
+            while True:
+                if nextreconcile is not None and time.monotonic() >= nextreconcile:
+                    self._reconcile(tracker)
+                    nextreconcile = time.monotonic()+reconcileinterval if reconcileinterval > 0 else None
+                if self.token.wait(1):
+                    break
+            self.observer.stop()
+            finished = True
+        except KeyboardInterrupt:
+            self.stop()
+            self.observer.stop()
+        except Exception as e:
+            get_logger().error("Halting threads due to exception %s",e)
+            self.observer.stop()
+        finally:
+            get_logger().info("Watcher stopping.")
+            self.observer.join()
+            if transfers is not None and finished:
+                self._drain(tracker,transfers,lanes)
+            tracker.stop()
+            consumer.join()
+            if verifier is not None:
+                verifier.stop()
+            if lanes is not None:
+                lanes.stop()
+            if transfers is not None:
+                transfers.stop()
+            self._stopped = True
+        if  self.isSender and scripts.MANIFEST:
+           
+            manifestpath=scripts.MANIFEST.finalize(".").resolve()
+            get_logger().info("Sending manifest %s",manifestpath)
+            netdrive = Configurator.getConfig().getProperty("watcher","networkdrive")
+            transferscripts.transferToNetworkDirectory(netdrive,[manifestpath])
+
+class SenderSession():
+    """One capture being sent by a MultiSessionSender: the pictures written to one subfolder of the capture computer's listen
+    folder, which go to their own folder on the network drive, with their own manifest and prune plan, through a lane of the
+    sender's shared TransferQueue.
+
+    Parameters:
+    -----------
+    projectname: the name of the project. It names the folder on the network drive and the manifest.
+    watchdir: the folder the capture software writes this capture's pictures to.
+    transfers: the sender's shared TransferQueue.
+    maskmode: the masking mode for the build.
+    pruneplan: an optional PrunePlan for the capture, if its rig isn't set up like config.json->ortery.
+    stages: the stages to run before sending, from getSenderStages.
+    stagepool: the sender's shared executor for the stages, if there are any to run.
+    """
+    def __init__(self, projectname:str, watchdir:str, transfers:TransferQueue, maskmode:int=0, pruneplan:PrunePlan=None,
+                 stages:dict=None, stagepool:ThreadPoolExecutor=None):
+        config = Configurator.getConfig()
+        self.projectname = projectname
+        self.watchdir = os.path.abspath(watchdir)
+        self.destpath = os.path.join(config.getProperty("watcher","networkdrive"),projectname)
+        self.transfers = transfers
+        self.stages = stages if stages is not None else getSenderStages()
+        self.stagepool = stagepool
+        self.token = CancellationToken()
+        self.watch = None
+        self._lock = threading.Lock()
+        self._staging = set()
+        self._seen = {}
+        os.makedirs(self.destpath,exist_ok=True)
+        if bool(config.getPropertyOrDefault("watcher","streaming_manifest",True)):
+            self.manifest = StreamingManifest(projectname,maskmode,self.destpath,self.stages)
+        else:
+            self.manifest = Manifest(projectname,maskmode,self.stages)
+        transfers.addLane(projectname,self.destpath,self.transferred)
+        self.tracker = FileStabilityTracker(self._onReady,float(config.getPropertyOrDefault("watcher","settle_seconds",0.5)),
+                                            token=self.token)
+        self.handler = WatcherSenderHandler(self.tracker,transfers,self.stages,EventFilter.fromConfig(),pruneplan,projectname,
+                                            os.path.join(WatcherSenderHandler.getScratchDir(),projectname))
+
+    def transferred(self, result:dict):
+        WatcherSenderHandler.record_transfer(self.manifest,result)
+
+    def _onReady(self, path:str):
+        if self.stagepool is None:
+            self.handler.send(path)
+            return
+        #a picture reported again without having changed has already been staged.
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return
+        with self._lock:
+            if self._seen.get(path) == mtime:
+                return
+            self._seen[path] = mtime
+            self._staging.add(path)
+        self.stagepool.submit(self._stage,path)
+
+    def _stage(self, path:str):
+        try:
+            if not self.token.isCancelled():
+                self.handler.send(path)
+        except Exception as e:
+            get_logger().error("Could not prepare %s for %s: %s",path,self.projectname,e)
+        finally:
+            with self._lock:
+                self._staging.discard(path)
+
+    def getBacklog(self)->int:
+        """returns: the number of pictures of the capture still being written, staged or sent."""
+        with self._lock:
+            staging = len(self._staging)
+        return self.tracker.getPendingCount()+staging+self.transfers.getDepth(self.projectname)
+
+    def finish(self, timeout:float)->Path:
+        """Waits up to timeout seconds for the capture's pictures to be sent, then sends its manifest.
+
+        returns: the path of the manifest on the network drive.
+        """
+        deadline = time.monotonic()+timeout
+        while self.tracker.getPendingCount() > 0 or self._staging:
+            if time.monotonic() > deadline:
+                get_logger().warning("Gave up waiting for %d pictures of %s.",self.getBacklog(),self.projectname)
+                break
+            time.sleep(0.1)
+        if not self.transfers.waitUntilEmpty(max(0.0,deadline-time.monotonic()),lane=self.projectname):
+            get_logger().warning("Gave up waiting for %d transfers of %s.",self.transfers.getDepth(self.projectname),self.projectname)
+        self.close()
+        scratchdir = self.handler.scratchdir
+        os.makedirs(scratchdir,exist_ok=True)
+        manifestpath = self.manifest.finalize(scratchdir).resolve()
+        get_logger().info("Sending manifest %s",manifestpath)
+        transferscripts.transferToNetworkDirectory(self.destpath,[manifestpath])
+        return Path(self.destpath,manifestpath.name)
+
+    def close(self):
+        """Stops taking pictures for the capture, without sending its manifest."""
+        self.tracker.stop()
+        self.transfers.removeLane(self.projectname)
+
+
+class MultiSessionSender():
+    """Sends several captures from one capture computer at once, for example from two rigs, each writing to its own subfolder of
+    config.json->watcher->listen_and_send. Each capture is a SenderSession, with its own folder and manifest on the network drive,
+    and can be started and finished while the others carry on. They share one observer, the copy streams of one TransferQueue,
+    which takes from each capture's lane in turn, and the workers that run the sender's stages.
+
+    Methods:
+    ------------------------
+    addSession(projectname, subdir, maskmode, pruneplan): starts sending a capture.
+    finishSession(projectname): sends what is left of a capture and its manifest.
+    run(): waits until stop() is called, then finishes every capture.
+    """
+    def __init__(self, inputdir:str=None):
+        config = Configurator.getConfig()
+        self.inputdir = inputdir if inputdir else config.getProperty("watcher","listen_and_send")
+        self.stages = getSenderStages()
+        self.token = CancellationToken()
+        #the copy streams outlive the token, so the captures still being sent when the user finishes can finish.
+        self.transfers = TransferQueue(config.getProperty("watcher","networkdrive"),token=CancellationToken())
+        self.stagepool = None
+        if self.stages["convert"]:
+            self.stagepool = ThreadPoolExecutor(max_workers=int(config.getPropertyOrDefault("stages","sender_workers",1)),
+                                                thread_name_prefix="SenderStages")
+        self.observer = Observer()
+        self.sessions = {}
+        self._lock = threading.Lock()
+        self._started = False
+
+    def start(self):
+        if not self._started:
+            self._started = True
+            self.transfers.start()
+            self.observer.start()
+
+    def stop(self):
+        self.token.cancel("Sender stopped.")
+
+    def addSession(self, projectname:str, subdir:str=None, maskmode:int=0, pruneplan:PrunePlan=None)->SenderSession:
+        """Starts sending the pictures written to a subfolder of the listen folder.
+
+        Parameters:
+        -----------
+        projectname: the name of the project.
+        subdir: the subfolder of the listen folder the capture's pictures are written to. Defaults to projectname.
+        maskmode: the masking mode for the build.
+        pruneplan: an optional PrunePlan, if the capture's rig isn't set up like config.json->ortery.
+
+        returns: the new session.
+        """
+        watchdir = os.path.abspath(os.path.join(self.inputdir,subdir if subdir else projectname))
+        os.makedirs(watchdir,exist_ok=True)
+        key = os.path.normcase(watchdir)
+        with self._lock:
+            if projectname in self.sessions:
+                raise ValueError(f"A capture of {projectname} is already being sent.")
+            for other in self.sessions.values():
+                otherkey = os.path.normcase(other.watchdir)
+                if key == otherkey or key.startswith(otherkey+os.sep) or otherkey.startswith(key+os.sep):
+                    raise ValueError(f"{watchdir} overlaps the folder of {other.projectname}, {other.watchdir}.")
+            session = SenderSession(projectname,watchdir,self.transfers,maskmode,pruneplan,self.stages,self.stagepool)
+            self.sessions[projectname] = session
+        session.tracker.start()
+        self.start()
+        session.watch = self.observer.schedule(session.handler,watchdir,recursive=True)
+        get_logger().info("Sending %s from %s to %s.",projectname,watchdir,session.destpath)
+        return session
+
+    def finishSession(self, projectname:str)->Path:
+        """Stops watching a capture's folder, lets its pictures finish being sent, within transfer->drain_timeout_s, and sends its
+        manifest.
+
+        returns: the path of the manifest on the network drive.
+        """
+        with self._lock:
+            session = self.sessions.pop(projectname)
+        self.observer.unschedule(session.watch)
+        timeout = float(Configurator.getConfig().getPropertyOrDefault("transfer","drain_timeout_s",600))
+        return session.finish(timeout)
+
+    def getStats(self)->dict:
+        """returns: the stats of the shared TransferQueue, with the backlog of each capture under sessions."""
+        stats = self.transfers.getStats()
+        with self._lock:
+            stats["sessions"] = {name:s.getBacklog() for name,s in self.sessions.items()}
+        return stats
+
+    def run(self):
+        """Sends the captures until stop() is called or ctrl+c is pressed, then finishes each of them."""
+        self.start()
+        try:
+            while not self.token.wait(1):
+                pass
+        except KeyboardInterrupt:
+            self.stop()
+        finally:
+            with self._lock:
+                names = list(self.sessions.keys())
+            for name in names:
+                try:
+                    self.finishSession(name)
+                except Exception as e:
+                    get_logger().error("Could not finish %s: %s",name,e)
+            self.observer.stop()
+            self.observer.join()
+            if self.stagepool is not None:
+                self.stagepool.shutdown(wait=True)
+            self.transfers.stop()
@@ -12,24 +12,41 @@ import os
 import subprocess
 
 
-def execute_blender_script(scriptname:str, args:dict):
+def execute_blender_script(scriptname:str, args:dict, token=None)->bool:
     """Executes the named blender script and using the blender executable
     specified in the same place.
 
     Parameters:
     ------------------------
     scriptname = absolute path to a python script that can be run from within blender.
-    args: a dictionary of arguments in the form key:value"""
+    args: a dictionary of arguments in the form key:value
+    token: an optional CancellationToken. If it is cancelled while blender is running, blender is terminated.
+
+    returns: true if blender ran to completion, false if it was stopped."""
     
-    params = "-- "
+    params = ["--"]
     for k,v in args.items():
-        params += f" --{k}=\"{v}\""
+        params.append(f"--{k}={v}")
 
     bexec = Path(Configurator.getConfig().getProperty("postprocessing","blender_exec"))
-    cmd = f"\"{bexec}\" --background --factory-startup --python \"{scriptname}\" {params}"
-    print(cmd)
-
-    subprocess.run(cmd,shell=True,check = False)
+    #run blender directly rather than through a shell, so that terminating the process stops blender itself.
+    cmd = [str(bexec),"--background","--factory-startup","--python",str(scriptname)]+params
+    print(" ".join(cmd))
+
+    proc = subprocess.Popen(cmd)
+    if token is None:
+        proc.wait()
+        return True
+    while proc.poll() is None:
+        if token.wait(0.5):
+            proc.terminate()
+            try:
+                proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+            return False
+    return True
 
 def bottom_to_origin(filename,outputname):
     """Takes a mesh in the format obj, ply, or other meshlab supported formats and translates the local origin to 0,0,0, then
@@ -22,7 +22,6 @@ from util.Configurator import Configurator
 from util.InstrumentationStatistics import InstrumentationStatistics, Statistic_Event_Types,timed
 from util.PipelineLogging import getLogger
 from processing import maskingAlgorithms
-from tasks import MaskingTasks
 
 
 def build_masks(imagepath,outputdir,mode):
@@ -52,6 +51,7 @@ def build_masks(imagepath,outputdir,mode):
 
 
 def buildMasksWithInference(imagepath:Path,outputdir:Path):
+    from tasks import MaskingTasks #the inference client is slow to import, so only load it when AI masking is used.
     task = MaskingTasks.MaskAI({"maskoption":util.MaskingOptions.MASK_AI,
                                 "input":imagepath,
                                 "output":outputdir})
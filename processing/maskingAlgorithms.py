@@ -4,7 +4,6 @@ import cv2
 import numpy as np
 from util.PipelineLogging import getLogger as getGlobalLogger
 
-from inference_sdk import InferenceHTTPClient
 
 def otsuThresholding(picpath: Path, maskout: Path):
     img = cv2.imread(str(picpath))
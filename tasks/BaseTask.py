@@ -1,7 +1,16 @@
 
+import threading
+import time
 from enum import Enum
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from util.PipelineLogging import getLogger
 from util.ErrorCodeConsts import *
+from util.Fingerprint import fingerprintParams, readStamp, writeStamp, clearStamp
+from util.ArtifactCache import ArtifactCache
+from util.Cancellation import CancellationToken
+from util.MemoryBudget import MemoryBudget
+from util.InstrumentationStatistics import propagateSpan
 class TaskStatus(Enum):
     """Class containing constants for state status."""
     NONE = 0
@@ -9,14 +18,85 @@ class TaskStatus(Enum):
     RUNNING = 2
     FINISHED = 3
 
+class ResourceClass(Enum):
+    """Class containing constants for the kind of resource a task occupies while it runs. The task scheduler
+    limits how many tasks of each class run at once."""
+    CPU_POOL = "cpu-pool"
+    IO = "io"
+    METASHAPE_EXCLUSIVE = "metashape-exclusive"
+    BLENDER = "blender"
+
+def normalizeResult(result)->tuple:
+    """Tasks return either a bool or a tuple of (bool, ErrorCodes) from their setup, execute and exit phases.
+    This turns either form into a (bool, ErrorCodes) tuple.
+
+    Parameters:
+    -----------
+    result: the return value of a task phase.
+
+    returns: success, code
+    """
+    if isinstance(result,tuple):
+        success = result[0] if len(result)>0 else False
+        code = result[1] if len(result)>1 else ErrorCodes.NONE
+        if isinstance(success,tuple):
+            success, _ = normalizeResult(success)
+        return bool(success), code
+    success = bool(result)
+    return success, ErrorCodes.NONE if success else ErrorCodes.UNKNOWN
+
+def expandItems(paths:list, extns:list)->list:
+    """Turns a list of files and directories into the list of files a batch task should process.
+    Directories are expanded into the files directly inside them.
+
+    Parameters:
+    -----------
+    paths: a list of paths to files or directories.
+    extns: a list of upper case file extensions, like ".JPG", to keep.
+
+    returns: a list of Paths.
+    """
+    items = []
+    for p in paths:
+        p = Path(p)
+        if p.is_dir():
+            items += sorted(f for f in p.iterdir() if f.is_file() and f.suffix.upper() in extns)
+        elif p.suffix.upper() in extns:
+            items.append(p)
+    return items
+
 class BaseTask():
-    """Generic  base class for states"""
+    """Generic  base class for states.
+    Subclasses declare the files they read and write via getInputs and getOutputs, and the kind of resource they use
+    via resourceclass, so that the scheduler can work out which tasks depend on each other.
+
+    Tasks that work on many files implement process_item and call execute_items from execute, so that setup and exit
+    run once for the whole batch.
+
+    Tasks whose results don't persist on disk should set resumable to False so that a resumed build always reruns them.
+
+    The scheduler hands each task its cancellation token before running it. execute_items stops starting new items once the token
+    is cancelled, and tasks with long loops of their own should check isCancelled and return ErrorCodes.CANCELLED.
+
+    Batch tasks that make one output file per item can set memoize to True and implement getItemOutput and getMemoParams.
+    Their outputs are then kept in the artifact cache and reused whenever the same item is processed with the same parameters.
+
+    Batch tasks that load whole pictures implement getItemMemoryEstimate, so that items only start while their estimated memory
+    fits in the MemoryBudget. Memoized items that are up to date or in the artifact cache don't load anything, so they don't wait."""
+    resourceclass = ResourceClass.CPU_POOL
+    resumable = True
+    memoize = False
 
     def __init__(self):
         self._shouldFinish = False
         self._status = TaskStatus.NONE
         self._statename = self.__repr__()
-        
+        self._itemsprocessed = 0
+        self._itemcputime = 0.0
+        self._itemlock = threading.Lock()
+        self.maxworkers = None
+        self.cancellationtoken = None
+
     def setup(self)->bool:
         self._status = TaskStatus.SETUP
         getLogger(__name__).info("Starting %s",self._statename)
@@ -33,5 +113,159 @@ class BaseTask():
         return self._status
     def getName(self)->str:
         return self._statename
-    
-    
+    def getInputs(self)->list:
+        """Returns a list of paths (files or directories) this task reads."""
+        return []
+    def getOutputs(self)->list:
+        """Returns a list of paths (files or directories) this task writes."""
+        return []
+    def getIdentityParams(self)->dict:
+        """Returns any parameters, beyond its inputs and outputs, that tell this task apart from another task of the same type."""
+        return {}
+    def getIdentity(self)->str:
+        """Returns a string identifying this task, used as its key in the task journal."""
+        return fingerprintParams([self._statename,
+                                  [str(p) for p in self.getInputs()],
+                                  [str(p) for p in self.getOutputs()],
+                                  self.getIdentityParams()])
+    def getItemsProcessed(self)->int:
+        return self._itemsprocessed
+    def isCancelled(self)->bool:
+        return CancellationToken.check(self.cancellationtoken)
+    def getItemCpuTime(self)->float:
+        """Returns the CPU time, in seconds, spent processing batch items on threads other than the one running the task."""
+        return self._itemcputime
+
+    def getWorkerCount(self)->int:
+        """Returns how many items of a batch may be processed at once. Defaults to the scheduler limit for this task's resource class."""
+        if self.maxworkers is not None:
+            return max(1,self.maxworkers)
+        from tasks.TaskScheduler import getConfiguredLimits
+        return max(1,getConfiguredLimits().get(self.resourceclass,1))
+
+    def getItemOutput(self, item)->Path:
+        """Returns the file process_item writes for an item, or None if the item's output shouldn't be cached."""
+        return None
+
+    def getMemoParams(self)->dict:
+        """Returns the settings, beyond the input file, that change what process_item writes. Used in the artifact cache key."""
+        return {}
+
+    def getItemMemoryEstimate(self, item)->tuple:
+        """Returns the estimated peak memory, in bytes, that process_item needs for an item, and the name of the operation for
+        the memory report. Items with an estimate are admitted through the MemoryBudget. Defaults to 0, no admission control.
+
+        returns: bytes, operation
+        """
+        return 0, None
+
+    def getItemKey(self, item)->str:
+        """returns: the fingerprint an up to date output of the item is stamped with, or None if the item's output can't be
+        memoized."""
+        output = self.getItemOutput(item)
+        if output is None or Path(output)==Path(item):
+            return None
+        return ArtifactCache.getCache().getKey(item,self._statename,self.getMemoParams())
+
+    def process_item_memoized(self, item)->tuple:
+        """Runs process_item on an item, unless its output is already up to date. An output is up to date only when the fingerprint
+        recorded next to it, made from the contents of the item and getMemoParams, matches, so a changed picture or setting makes it
+        again. Otherwise the output is fetched from the artifact cache if it's there, or made and added to the cache.
+
+        returns: success, code
+        """
+        output = self.getItemOutput(item)
+        key = self.getItemKey(item)
+        if key is None:
+            return self.process_item_reserved(item)
+        if readStamp(output) == key:
+            return True, ErrorCodes.NONE
+        cache = ArtifactCache.getCache()
+        #the output was made from something else, or we can't tell, so it is never reused.
+        clearStamp(output)
+        if cache.fetch(key,output):
+            getLogger(__name__).debug("Reused cached %s for %s",output,item)
+            writeStamp(output,key)
+            return True, ErrorCodes.NONE
+        success, code = normalizeResult(self.process_item_reserved(item))
+        if success and Path(output).exists():
+            writeStamp(output,key)
+            cache.store(key,output)
+        return success, code
+
+    def process_item_reserved(self, item)->tuple:
+        """Runs process_item on an item once its memory estimate, from getItemMemoryEstimate, fits in the MemoryBudget.
+
+        returns: success, code
+        """
+        nbytes, operation = self.getItemMemoryEstimate(item)
+        if nbytes <= 0:
+            return self.process_item(item)
+        with MemoryBudget.getBudget().reserve(nbytes,operation,self.cancellationtoken):
+            if self.isCancelled():
+                return False, ErrorCodes.CANCELLED
+            return self.process_item(item)
+
+    def process_item(self, item)->tuple:
+        """Processes a single item of a batch. Subclasses override this.
+
+        returns: success, code
+        """
+        return True, ErrorCodes.NONE
+
+    def parallel_map(self, func, items, workers:int=None)->list:
+        """Calls func on every item, using a pool of threads if more than one worker is allowed.
+
+        Parameters:
+        -----------
+        func: a callable taking one item.
+        items: an iterable of items.
+        workers: the number of threads to use. Defaults to getWorkerCount.
+
+        returns: a list of the return values of func, in the same order as items.
+        """
+        items = list(items)
+        workers = self.getWorkerCount() if workers is None else workers
+        if workers <= 1 or len(items) <= 1:
+            return [func(i) for i in items]
+        #the spans timed on the pool's threads nest under the task's span.
+        with ThreadPoolExecutor(max_workers=min(workers,len(items))) as pool:
+            return list(pool.map(propagateSpan(func),items))
+
+    def execute_items(self, items)->list:
+        """Runs process_item on every item in a batch.
+
+        Parameters:
+        -----------
+        items: an iterable of items, usually Paths.
+
+        returns: a list of (item, success, code) tuples in the same order as the items. Items that weren't started because the
+        task was cancelled are returned with ErrorCodes.CANCELLED.
+        """
+        process = self.process_item_memoized if self.memoize else self.process_item_reserved
+        caller = threading.get_ident()
+        def run(item):
+            if self.isCancelled():
+                return item, False, ErrorCodes.CANCELLED
+            cpu = time.thread_time()
+            try:
+                success, code = normalizeResult(process(item))
+            except Exception as e:
+                getLogger(__name__).error("%s failed on %s: %s",self._statename,item,e)
+                success, code = False, ErrorCodes.UNKNOWN
+            if threading.get_ident() != caller:
+                with self._itemlock:
+                    self._itemcputime += time.thread_time()-cpu
+            return item, success, code
+        results = self.parallel_map(run,items)
+        self._itemsprocessed += len(results)
+        if self.memoize:
+            ArtifactCache.getCache().trim()
+        return results
+
+    def getSerialKey(self):
+        """Tasks that return the same non-None key are run one after another in the order they were queued,
+        for example tasks that share a single Metashape document."""
+        return None
+
+
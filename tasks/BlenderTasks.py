@@ -1,8 +1,9 @@
 from pathlib import Path
 from os import mkdir
-from tasks.BaseTask import BaseTask
+from tasks.BaseTask import BaseTask, ResourceClass
 from postprocessing import MeshlabHelpers
 from util.Configurator import Configurator
+from util.ErrorCodeConsts import ErrorCodes
 from  util.InstrumentationStatistics import Statistic_Event_Types, timed
 
 class BlenderSnapshotTask(BaseTask):
@@ -14,6 +15,7 @@ class BlenderSnapshotTask(BaseTask):
     scale -- should include scale, boolean.
     Rotation and scalesize can be set in config.json under postprocessing or via the ui.
     """
+    resourceclass = ResourceClass.BLENDER
 
     def __init__(self, argdict:dict):
         super().__init__()
@@ -25,6 +27,12 @@ class BlenderSnapshotTask(BaseTask):
 
     def __repr__(self):
         return "Blender: Snapshot"
+
+    def getInputs(self):
+        return [self.inputobj]
+
+    def getOutputs(self):
+        return [Path(self.inputobj.parent, f"{self.inputobj.stem}_render.png")]
     
     def setup(self):
         #setup will fail if there is no blender installed at the path specified in config or if the input directory is not 
@@ -51,7 +59,9 @@ class BlenderSnapshotTask(BaseTask):
             ry = Configurator.getConfig().getProperty("postprocessing", "rot_y")
             rz = Configurator.getConfig().getProperty("postprocessing", "rot_z")
             params = {"input":str(self.inputobj),"render":str(self.output),"scale":self.usescale, "rx":rx, "ry":ry, "rz":rz}
-            MeshlabHelpers.execute_blender_script(script,params)
+            if not MeshlabHelpers.execute_blender_script(script,params,self.cancellationtoken):
+                #blender was stopped before it rendered, so there is no partial render to clean up.
+                return False, ErrorCodes.CANCELLED
         except Exception as e:
             success = False
             raise e
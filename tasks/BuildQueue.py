@@ -0,0 +1,407 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from util.Cancellation import CancellationToken
+from util.Configurator import Configurator
+from util.FileLock import FileLock
+from util.PipelineLogging import getLogger
+
+
+class JobStatus():
+    """Constants for the status of a job in the build queue."""
+    QUEUED = "queued"               #waiting for its pictures to be converted and masked.
+    PREPROCESSING = "preprocessing" #being converted and masked.
+    READY = "ready"                 #waiting for a metashape lane.
+    BUILDING = "building"           #in a metashape lane.
+    COMPLETED = "completed"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    PENDING = [QUEUED,PREPROCESSING,READY,BUILDING]
+
+def _now()->str:
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+def getQueuePath()->Path:
+    """Returns the build queue file configured in config.json->buildqueue->queue_file, by default ~/.aphoma/buildqueue.json"""
+    path = Configurator.getConfig().getPropertyOrDefault("buildqueue","queue_file",None)
+    return Path(path) if path else Path(Path.home(),".aphoma","buildqueue.json")
+
+class BuildQueue():
+    """A persistent queue of model builds shared by every process on the machine: the watcher, the UI and the command line.
+    Jobs run highest priority first, and in the order they were submitted within a priority. The queue is a json file that is
+    read and rewritten under a lock for every change, so one process can reorder jobs while another runs them.
+
+    Parameters:
+    -----------
+    path: the queue file. Defaults to getQueuePath()
+    """
+
+    def __init__(self, path:Path=None):
+        self.path = Path(path) if path else getQueuePath()
+        self._lock = FileLock(Path(self.path.parent,f"{self.path.name}.lock"))
+
+    def _load(self)->dict:
+        if not self.path.exists():
+            return {"nextid":1,"runner":None,"jobs":[]}
+        with open(self.path,'r',encoding="utf-8") as f:
+            return json.load(f)
+
+    def _save(self, data:dict):
+        tmppath = Path(self.path.parent,f"{self.path.name}.tmp")
+        with open(tmppath,'w',encoding="utf-8") as f:
+            json.dump(data,f,indent=1)
+        os.replace(tmppath,self.path)
+
+    def _update(self, func):
+        """Loads the queue, calls func on it, saves it if func changed it, and returns what func returned."""
+        if not self.path.parent.exists():
+            os.makedirs(self.path.parent,exist_ok=True)
+        with self._lock:
+            data = self._load()
+            before = json.dumps(data,sort_keys=True)
+            ret = func(data)
+            if json.dumps(data,sort_keys=True) != before:
+                self._save(data)
+            return ret
+
+    @staticmethod
+    def _order(job:dict)->tuple:
+        return (-job["priority"],job["seq"])
+
+    @staticmethod
+    def _find(data:dict, jobid:int)->dict:
+        for job in data["jobs"]:
+            if job["id"] == jobid:
+                return job
+        raise KeyError(f"No job {jobid} in the build queue.")
+
+    def submit(self, projectname:str, sourcedir, projectdir, maskoption:int=0, palette:str="none", priority:int=0)->int:
+        """Adds a build to the queue.
+
+        Parameters:
+        -----------
+        projectname: the name of the project, used for the psx and exported model.
+        sourcedir: the folder of pictures to build from.
+        projectdir: the folder to build the project in.
+        maskoption: the MaskingOptions value to mask with.
+        palette: the name of the marker palette, as in util/MarkerPalettes.json
+        priority: jobs with a higher priority run first.
+
+        returns: the job's id.
+        """
+        def add(data):
+            jobid = data["nextid"]
+            data["nextid"]+=1
+            data["jobs"].append({"id":jobid,
+                                 "projectname":projectname,
+                                 "sourcedir":str(sourcedir),
+                                 "projectdir":str(projectdir),
+                                 "maskoption":int(maskoption),
+                                 "palette":palette,
+                                 "priority":int(priority),
+                                 "seq":jobid,
+                                 "status":JobStatus.QUEUED,
+                                 "submitted":_now(),
+                                 "started":None,
+                                 "finished":None,
+                                 "message":""})
+            return jobid
+        jobid = self._update(add)
+        getLogger(__name__).info("Queued build %s of %s with priority %s",jobid,projectname,priority)
+        return jobid
+
+    def getJobs(self, includefinished:bool=False)->list:
+        """Returns the jobs in the order they will run. Finished jobs are listed after pending ones."""
+        with self._lock:
+            jobs = self._load()["jobs"]
+        pending = sorted((j for j in jobs if j["status"] in JobStatus.PENDING),key=BuildQueue._order)
+        if not includefinished:
+            return pending
+        return pending+[j for j in jobs if j["status"] not in JobStatus.PENDING]
+
+    def setPriority(self, jobid:int, priority:int):
+        def change(data):
+            BuildQueue._find(data,jobid)["priority"] = int(priority)
+        self._update(change)
+
+    def moveToFront(self, jobid:int):
+        """Makes a job the next one to run by giving it the highest priority of any pending job and the earliest place in line."""
+        def change(data):
+            job = BuildQueue._find(data,jobid)
+            pending = [j for j in data["jobs"] if j["status"] in JobStatus.PENDING and j is not job]
+            if pending:
+                job["priority"] = max(job["priority"],max(j["priority"] for j in pending))
+                job["seq"] = min(j["seq"] for j in pending)-1
+        self._update(change)
+
+    def cancel(self, jobid:int)->bool:
+        """Cancels a pending job. A job that is already being built is stopped by the runner.
+
+        returns: true if the job was pending.
+        """
+        def change(data):
+            job = BuildQueue._find(data,jobid)
+            if job["status"] not in JobStatus.PENDING:
+                return False
+            job["status"] = JobStatus.CANCELLED
+            job["finished"] = _now()
+            return True
+        return self._update(change)
+
+    def clearFinished(self)->int:
+        """Removes completed, failed and cancelled jobs from the queue file.
+
+        returns: the number of jobs removed.
+        """
+        def change(data):
+            before = len(data["jobs"])
+            data["jobs"] = [j for j in data["jobs"] if j["status"] in JobStatus.PENDING]
+            return before-len(data["jobs"])
+        return self._update(change)
+
+    def getStatus(self, jobid:int)->str:
+        with self._lock:
+            return BuildQueue._find(self._load(),jobid)["status"]
+
+    def claimNext(self, fromstatus:str, tostatus:str)->dict:
+        """Moves the first job with status fromstatus to tostatus.
+
+        returns: a copy of the job, or None if there were no jobs with that status.
+        """
+        def claim(data):
+            jobs = sorted((j for j in data["jobs"] if j["status"]==fromstatus),key=BuildQueue._order)
+            if not jobs:
+                return None
+            jobs[0]["status"] = tostatus
+            if jobs[0]["started"] is None:
+                jobs[0]["started"] = _now()
+            return dict(jobs[0])
+        return self._update(claim)
+
+    def countStatus(self, status:str)->int:
+        with self._lock:
+            return len([j for j in self._load()["jobs"] if j["status"]==status])
+
+    def setStatus(self, jobid:int, status:str, message:str="", onlyif:list=None)->bool:
+        """Sets a job's status, unless onlyif is given and the job's status isn't in it (for example, if it was cancelled).
+
+        returns: true if the status was changed.
+        """
+        def change(data):
+            job = BuildQueue._find(data,jobid)
+            if onlyif is not None and job["status"] not in onlyif:
+                return False
+            job["status"] = status
+            job["message"] = message
+            if status not in JobStatus.PENDING:
+                job["finished"] = _now()
+            return True
+        return self._update(change)
+
+    def acquireRunner(self, owner:str, stale:float=30.0)->bool:
+        """Makes owner the only process running jobs from this queue, unless another runner has checked in within stale seconds.
+        Jobs left preprocessing or building by a runner that died are put back in line.
+
+        returns: true if owner is now the runner.
+        """
+        def acquire(data):
+            runner = data.get("runner")
+            if runner and runner["owner"] != owner and time.time()-runner["heartbeat"] < stale:
+                return False
+            data["runner"] = {"owner":owner,"heartbeat":time.time()}
+            if runner is None or runner["owner"] != owner:
+                for job in data["jobs"]:
+                    if job["status"] == JobStatus.PREPROCESSING:
+                        job["status"] = JobStatus.QUEUED
+                    elif job["status"] == JobStatus.BUILDING:
+                        job["status"] = JobStatus.READY
+            return True
+        return self._update(acquire)
+
+    def heartbeat(self, owner:str):
+        def beat(data):
+            if data.get("runner") and data["runner"]["owner"] == owner:
+                data["runner"]["heartbeat"] = time.time()
+        self._update(beat)
+
+    def releaseRunner(self, owner:str):
+        def release(data):
+            if data.get("runner") and data["runner"]["owner"] == owner:
+                data["runner"] = None
+        self._update(release)
+
+
+class BuildQueueRunner():
+    """Runs the jobs in a build queue. Each job goes through two stages:
+
+    preprocessing -- converting and masking its pictures, which only needs the CPU, run in this process one job at a time.
+    building -- the metashape and blender part of the build, run as "photogrammetryPipeline.py build --resume" in its own
+    process, so each metashape lane has its own document. The task journal written during preprocessing lets --resume skip
+    straight to metashape.
+
+    Preprocessing for the next jobs in line runs while earlier jobs are in metashape, so the metashape lanes don't sit idle
+    between jobs. Configured in config.json->buildqueue:
+    metashape_lanes -- how many builds may be in metashape at once. Defaults to 1.
+    preprocess_ahead -- how many jobs may be preprocessed and waiting for a lane. Defaults to 2.
+
+    Parameters:
+    -----------
+    queue: the BuildQueue to run.
+    """
+    _BACKGROUND = None
+
+    def __init__(self, queue:BuildQueue=None):
+        config = Configurator.getConfig()
+        self.queue = queue if queue is not None else BuildQueue()
+        self.lanes = max(1,int(config.getPropertyOrDefault("buildqueue","metashape_lanes",1)))
+        self.preprocessahead = max(1,int(config.getPropertyOrDefault("buildqueue","preprocess_ahead",2)))
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+        self.token = CancellationToken()
+        self._building = {}
+        self._preprocess = None
+        self._thread = None
+
+    def stop(self):
+        self.token.cancel("Build queue runner stopped.")
+
+    def _preprocess_job(self, job:dict, token:CancellationToken):
+        import photogrammetryPipeline
+        from tasks.TaskJournal import TaskJournal
+        from tasks.TaskScheduler import executeTasks
+        tasklist = photogrammetryPipeline.build_preprocessing_tasklist(job["sourcedir"],job["projectdir"],job["maskoption"])
+        if not tasklist:
+            return True, ""
+        journal = TaskJournal(Path(job["projectdir"],f"{job['projectname']}_journal.json"))
+        taskqueue = photogrammetryPipeline.buildTaskQueue(tasklist)
+        succeeded, code, _ = executeTasks(taskqueue,journal,True,token=token)
+        return succeeded, code.name
+
+    def _startBuild(self, job:dict):
+        script = Path(Path(__file__).parent.parent,"photogrammetryPipeline.py")
+        cmd = [sys.executable,str(script),"build",job["sourcedir"],job["projectdir"],job["projectname"],
+               "--maskoption",str(job["maskoption"]),"--palette",str(job["palette"]),"--resume"]
+        if not os.path.exists(job["projectdir"]):
+            os.makedirs(job["projectdir"])
+        log = open(Path(job["projectdir"],f"{job['projectname']}_build.log"),'a',encoding="utf-8")
+        getLogger(__name__).info("Building job %s, %s, in a metashape lane.",job["id"],job["projectname"])
+        proc = subprocess.Popen(cmd,cwd=script.parent,stdout=log,stderr=subprocess.STDOUT)
+        self._building[job["id"]] = (proc,log)
+
+    def _reapBuilds(self):
+        for jobid,(proc,log) in list(self._building.items()):
+            status = self.queue.getStatus(jobid)
+            if status == JobStatus.CANCELLED and proc.poll() is None:
+                getLogger(__name__).info("Stopping cancelled job %s.",jobid)
+                proc.terminate()
+            if proc.poll() is None:
+                continue
+            log.close()
+            del self._building[jobid]
+            if proc.returncode == 0:
+                self.queue.setStatus(jobid,JobStatus.COMPLETED,onlyif=[JobStatus.BUILDING])
+            else:
+                self.queue.setStatus(jobid,JobStatus.FAILED,f"Build exited with {proc.returncode}",onlyif=[JobStatus.BUILDING])
+            getLogger(__name__).info("Job %s finished with exit code %s.",jobid,proc.returncode)
+
+    def _reapPreprocess(self):
+        if self._preprocess is None:
+            return
+        job, thread, result, token = self._preprocess
+        if self.queue.getStatus(job["id"]) == JobStatus.CANCELLED:
+            token.cancel("Job cancelled.")
+        if thread.is_alive():
+            return
+        self._preprocess = None
+        succeeded, message = result.get("value",(False,result.get("error","")))
+        if succeeded:
+            self.queue.setStatus(job["id"],JobStatus.READY,onlyif=[JobStatus.PREPROCESSING])
+        elif self.token.isCancelled():
+            self.queue.setStatus(job["id"],JobStatus.QUEUED,onlyif=[JobStatus.PREPROCESSING])
+        else:
+            self.queue.setStatus(job["id"],JobStatus.FAILED,f"Preprocessing failed: {message}",onlyif=[JobStatus.PREPROCESSING])
+
+    def _startPreprocess(self, job:dict):
+        result = {}
+        token = CancellationToken()
+        def work():
+            try:
+                result["value"] = self._preprocess_job(job,token)
+            except Exception as e:
+                getLogger(__name__).error("Preprocessing job %s failed: %s",job["id"],e)
+                result["error"] = str(e)
+        thread = threading.Thread(target=work,daemon=True)
+        self._preprocess = (job,thread,result,token)
+        getLogger(__name__).info("Preprocessing job %s, %s.",job["id"],job["projectname"])
+        thread.start()
+
+    def run(self, untilempty:bool=True)->bool:
+        """Runs jobs until the queue is empty, or until stop is called if untilempty is false.
+
+        returns: false if another runner already owns the queue.
+        """
+        if not self.queue.acquireRunner(self.owner):
+            getLogger(__name__).info("Another process is already running the build queue at %s",self.queue.path)
+            return False
+        getLogger(__name__).info("Running the build queue at %s with %s metashape lanes.",self.queue.path,self.lanes)
+        try:
+            while not self.token.isCancelled():
+                self.queue.heartbeat(self.owner)
+                self._reapBuilds()
+                self._reapPreprocess()
+                while len(self._building) < self.lanes:
+                    job = self.queue.claimNext(JobStatus.READY,JobStatus.BUILDING)
+                    if job is None:
+                        break
+                    self._startBuild(job)
+                if self._preprocess is None and self.queue.countStatus(JobStatus.READY) < self.preprocessahead:
+                    job = self.queue.claimNext(JobStatus.QUEUED,JobStatus.PREPROCESSING)
+                    if job is not None:
+                        self._startPreprocess(job)
+                if untilempty and not self._building and self._preprocess is None and not self.queue.getJobs():
+                    break
+                self.token.wait(1)
+        finally:
+            self._shutdown()
+        return True
+
+    def _shutdown(self):
+        """Stops anything still running and puts its job back in line, so the next runner picks it up with --resume."""
+        if self._preprocess is not None:
+            self._preprocess[3].cancel("Build queue runner stopped.")
+            self._preprocess[1].join()
+            self._reapPreprocess()
+        for jobid,(proc,log) in self._building.items():
+            proc.terminate()
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+            log.close()
+            self.queue.setStatus(jobid,JobStatus.READY,"Interrupted; will resume.",onlyif=[JobStatus.BUILDING])
+        self._building = {}
+        self.queue.releaseRunner(self.owner)
+
+    @staticmethod
+    def ensureBackgroundRunner()->"BuildQueueRunner":
+        """Starts a runner on a background thread of this process, unless one is already running here. It keeps running, waiting
+        for new jobs, until the process exits or stop is called. If another process owns the queue, the runner exits straight
+        away and leaves the jobs to that process."""
+        runner = BuildQueueRunner._BACKGROUND
+        if runner is None or not runner._thread.is_alive():
+            runner = BuildQueueRunner()
+            runner._thread = threading.Thread(target=runner.run,kwargs={"untilempty":False},daemon=True)
+            BuildQueueRunner._BACKGROUND = runner
+            runner._thread.start()
+        return runner
+
+def useBuildQueue()->bool:
+    """Returns true if the watcher and the UI should queue builds rather than run them straight away. Set in
+    config.json->buildqueue->use_build_queue"""
+    return bool(Configurator.getConfig().getPropertyOrDefault("buildqueue","use_build_queue",False))
@@ -1,8 +1,10 @@
 from pathlib import Path
 import imageio
 from os import mkdir,listdir
-from tasks.BaseTask import BaseTask
+from tasks.BaseTask import BaseTask, ResourceClass, expandItems
 from util import util
+from util.ErrorCodeConsts import ErrorCodes
+from util.MemoryBudget import estimateImageBytes
 from PIL import Image as PILImage
 import rawpy
 
@@ -11,40 +13,72 @@ from util.PipelineLogging import getLogger
 
 
 class ConvertToJPG(BaseTask):
+    """Converts RAW and TIF files to JPGs, and copies JPGs into the output folder. It requires a dict with the keys:
+    input -- a file, a directory, or a list of files and directories to convert.
+    output -- the directory to put the JPGs in.
+    """
+    resourceclass = ResourceClass.CPU_POOL
+    memoize = True
+    extns = [".TIF",".CR2",".NEF",".JPG"]
 
     def __init__(self, argdict:dict):
         super().__init__()
-        self.input = Path(argdict["input"])
+        inputs = argdict["input"]
+        self.inputs = [Path(i) for i in inputs] if isinstance(inputs,(list,tuple)) else [Path(inputs)]
+        self.input = self.inputs[0] if len(self.inputs)>0 else None
         self.output = Path(argdict["output"])
+        self.items = []
 
     def __repr__(self):
         return "Conversions: ConvertToJPG"
-    
+
+    def getInputs(self):
+        return list(self.inputs)
+
+    def getOutputs(self):
+        outputs = []
+        for i in self.inputs:
+            outputs.append(Path(self.output,f"{i.stem}.jpg") if i.suffix else self.output)
+        return outputs
+
+    def getItemOutput(self, item:Path):
+        #JPGs are only copied, so there's nothing worth caching.
+        if item.suffix.upper() == ".JPG":
+            return None
+        return Path(self.output,f"{item.stem}.jpg")
+
+    def getMemoParams(self):
+        return {"quality":95,"use_camera_wb":True}
+
+    def getItemMemoryEstimate(self, item:Path):
+        ext = item.suffix.upper()
+        operation = "copy" if ext == ".JPG" else ("raw_convert" if ext in (".CR2",".NEF") else "tif_convert")
+        return estimateImageBytes(item,operation), operation
+
     def setup(self):
         super().setup()
 
-        if not self.output.exists or not self.output.is_dir:
+        if not self.output.exists() or not self.output.is_dir():
             mkdir(self.output)
+        self.items = expandItems(self.inputs,self.extns)
         ret = True
         return ret
-    
+
 
     def convert(self,fn:Path)->bool:
         success = True
         fp = fn.stem
-        ipname = Path(self.input,fn)
+        ipname = Path(fn)
         outputname = Path(self.output,f"{fp}.jpg")
         ext = fn.suffix.upper()
-        if outputname.exists():
-            return success
         try:
             if ext ==".CR2" or ext == ".NEF":
-                print("Converting from RAW")
+                getLogger(__name__).debug("Converting %s from RAW",fn)
                 with rawpy.imread(str(ipname)) as raw:
                     rgb = raw.postprocess(use_camera_wb=True)
                     imageio.imwrite(outputname,rgb)
             else:
-                print("Converting from TIF")
+                getLogger(__name__).debug("Converting %s from TIF",fn)
                 f=PILImage.open(ipname)
                 rgb = f.convert('RGB')
                 rgb.save(outputname,quality=95)
@@ -55,14 +89,23 @@ class ConvertToJPG(BaseTask):
         return success
 
     @timed(Statistic_Event_Types.EVENT_CONVERT_PHOTO)
+    def process_item(self, item:Path):
+        if item.suffix.upper() == ".JPG":
+            if item.parent != self.output:
+                util.copy_file_to_dest([item],self.output,False)
+            return True, ErrorCodes.NONE
+        success = self.convert(item)
+        return success, ErrorCodes.NONE if success else ErrorCodes.INVALID_FILE
+
     def execute(self)->bool:
         super().execute()
-        success = True
-        extns = [".TIF",".CR2",".NEF",]
-        if self.input.is_file() and self.input.suffix.upper() in extns:
-            success = self.convert(self.input)
-        elif self.input.suffix.upper() == ".JPG":
-             if self.input.parent != self.output:
-                util.copy_file_to_dest(self.input,Path(self.output,self.input.name),False)
-        return success
-    
+        results = self.execute_items(self.items)
+        if self.isCancelled():
+            getLogger(__name__).info("Stopped converting files into %s",self.output)
+            return False, ErrorCodes.CANCELLED
+        failed = [item for item,success,_ in results if not success]
+        if failed:
+            getLogger(__name__).error("Failed to convert %s of %s files: %s",len(failed),len(results),failed)
+        else:
+            getLogger(__name__).info("Converted %s files into %s",len(results),self.output)
+        return len(failed)==0
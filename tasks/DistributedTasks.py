@@ -0,0 +1,131 @@
+import threading
+import time
+from pathlib import Path
+from tasks.BaseTask import BaseTask, ResourceClass, expandItems
+from tasks.TaskRegistry import createTask
+from tasks.WorkQueue import DirectoryWorkQueue, getQueueDir, runWorker
+from util.Cancellation import CancellationToken
+from util.Configurator import Configurator
+from util.ErrorCodeConsts import ErrorCodes
+from util.Fingerprint import readStamp
+from util.PipelineLogging import getLogger
+
+
+def useWorkQueue()->bool:
+    """Returns true if conversion and masking should be shared out through the work queue in config.json->workqueue->queue_dir."""
+    config = Configurator.getConfig()
+    return bool(config.getPropertyOrDefault("workqueue","use_work_queue",False)) and getQueueDir() is not None
+
+def distribute(taskentry:dict)->dict:
+    """Wraps a ConvertJPG or Masking entry from a task list so that it runs through the work queue."""
+    return {"name":"Distributed","kwargs":{"task":taskentry["name"],"kwargs":taskentry["kwargs"]}}
+
+
+class DistributedBatch(BaseTask):
+    """Splits a batch task, like ConvertJPG or Masking, into work items of a few pictures each and puts them on the shared work
+    queue, where worker PCs running "photogrammetryScripts.py worker" pick them up. Unless workqueue->work_locally is false,
+    this machine works on the queue too while it waits, so a build still finishes when no workers are running. Expired
+    leases are reclaimed while waiting. It requires a dict with the keys:
+    task -- the name of the batch task.
+    kwargs -- the batch task's arguments. The input and output paths have to be reachable from the workers, so use paths on the
+    network share.
+    """
+    resourceclass = ResourceClass.IO
+
+    def __init__(self, argdict:dict):
+        self.taskname = argdict["task"]
+        self.taskargs = argdict["kwargs"]
+        self.inner = createTask(self.taskname,self.taskargs)
+        super().__init__()
+        config = Configurator.getConfig()
+        self.chunksize = max(1,int(config.getPropertyOrDefault("workqueue","chunk_size",8)))
+        self.worklocally = bool(config.getPropertyOrDefault("workqueue","work_locally",True))
+        self.queue = None
+        self.chunks = []
+
+    def __repr__(self):
+        return f"Distributed: {self.inner}"
+
+    def getInputs(self):
+        return self.inner.getInputs()
+
+    def getOutputs(self):
+        return self.inner.getOutputs()
+
+    def getIdentityParams(self):
+        return self.inner.getIdentityParams()
+
+    def getSerialKey(self):
+        return self.inner.getSerialKey()
+
+    def _needsWork(self, item:Path)->bool:
+        output = self.inner.getItemOutput(item)
+        if output is None:
+            return item.parent != self.inner.output
+        #an output left over from another picture or setting has to be made again, as process_item_memoized would.
+        if self.inner.memoize:
+            key = self.inner.getItemKey(item)
+            if key is not None:
+                return readStamp(output) != key
+        return not output.exists()
+
+    def setup(self):
+        super().setup()
+        queuedir = getQueueDir()
+        if queuedir is None:
+            getLogger(__name__).error("There's no work queue configured in config.json->workqueue->queue_dir.")
+            return False
+        self.queue = DirectoryWorkQueue(queuedir)
+        items = [i for i in expandItems(self.inner.getInputs(),self.inner.extns) if self._needsWork(i)]
+        self.chunks = [items[i:i+self.chunksize] for i in range(0,len(items),self.chunksize)]
+        return True
+
+    def execute(self):
+        logger = getLogger(__name__)
+        pending = {}
+        for chunk in self.chunks:
+            kwargs = dict(self.taskargs)
+            kwargs["input"] = [str(i) for i in chunk]
+            kwargs["output"] = str(self.taskargs["output"])
+            pending[self.queue.submit(self.taskname,kwargs)] = chunk
+        logger.info("%s queued %d work items.",self,len(pending))
+        workertoken = CancellationToken()
+        worker = None
+        if self.worklocally and pending:
+            worker = threading.Thread(target=runWorker,args=(self.queue,workertoken),kwargs={"idle":0.5},daemon=True)
+            worker.start()
+        failures = []
+        try:
+            while pending and not self.isCancelled():
+                self.queue.reclaimExpired()
+                for itemid in list(pending.keys()):
+                    result = self.queue.getResult(itemid)
+                    if result is None:
+                        continue
+                    pending.pop(itemid)
+                    self.queue.removeResult(itemid)
+                    with self._itemlock:
+                        self._itemsprocessed += result.get("items",0)
+                    if not result.get("success"):
+                        failures.append(itemid)
+                        logger.error("Work item %s failed on %s: %s",itemid,result.get("worker"),result.get("code"))
+                if pending and self.cancellationtoken is not None:
+                    self.cancellationtoken.wait(0.5)
+                elif pending:
+                    time.sleep(0.5)
+        finally:
+            workertoken.cancel()
+            if worker is not None:
+                worker.join()
+        if pending:
+            #nobody has started these yet, so take them back off the queue. Leased ones are left to finish or expire.
+            for itemid in pending:
+                self.queue.withdraw(itemid)
+            return False, ErrorCodes.CANCELLED
+        return len(failures)==0
+
+    def exit(self):
+        missing = [p for p in self.getOutputs() if not Path(p).exists()]
+        if missing:
+            getLogger(__name__).error("The work queue didn't produce %s",missing)
+        return len(missing)==0
@@ -9,50 +9,92 @@ from util.InstrumentationStatistics import *
 from util.PipelineLogging import getLogger
 from util.Configurator import Configurator
 from tasks.BaseTask import *
+from util.MemoryBudget import estimateImageBytes
 import cv2
 from inference_sdk import InferenceHTTPClient
 
 class MaskImages(BaseTask):
+    """Base class for tasks that build a mask for each picture in a batch. It requires a dict with the keys:
+    maskoption -- the masking option from util.MaskingOptions.
+    input -- a picture, a directory of pictures, or a list of pictures and directories to mask.
+    output -- the directory to put the masks in.
+    """
+    extns = [".JPG",".TIF"]
+    #the key in MemoryBudget.BYTES_PER_PIXEL for building one mask.
+    memoryoperation = None
+
     def __init__(self, argdict:dict):
         super().__init__()
         self.maskingmode = argdict["maskoption"]
-        self.input = Path(argdict["input"])
+        inputs = argdict["input"]
+        self.inputs = [Path(i) for i in inputs] if isinstance(inputs,(list,tuple)) else [Path(inputs)]
+        self.input = self.inputs[0] if len(self.inputs)>0 else None
         self.output = Path(argdict["output"])
+        self.items = []
+
+    def getInputs(self):
+        return list(self.inputs)
+
+    def getOutputs(self):
+        outputs = []
+        for i in self.inputs:
+            outputs.append(Path(self.output,f"{i.stem}.png") if i.suffix else self.output)
+        return outputs
+
+    def getMaskPath(self, fn:Path)->Path:
+        return Path(self.output,f"{fn.stem}.png")
+
+    def getItemMemoryEstimate(self, item:Path):
+        if self.memoryoperation is None:
+            return 0, None
+        return estimateImageBytes(item,self.memoryoperation), self.memoryoperation
 
     def setup(self):
         success = super().setup()
         if success:
-            success= (Path(self.input).exists())
+            missing = [i for i in self.inputs if not i.exists()]
+            success = len(missing)==0
             if not success:
-                getLogger(__name__).error("Input Path %s does not exist.",self.input)
+                getLogger(__name__).error("Input Paths %s do not exist.",missing)
             else:
                 outputpath = Path(self.output)
                 if not outputpath.exists():
                     mkdir(outputpath)
+                self.items = expandItems(self.inputs,self.extns)
         return success
     
     def build_mask(self,fn:Path):
         pass
 
+    def getItemOutput(self, item:Path):
+        return self.getMaskPath(item)
+
+    def process_item(self, item:Path):
+        if self.build_mask(item) is False:
+            return False, ErrorCodes.INVALID_FILE
+        return True, ErrorCodes.NONE
+
     def execute(self):
         success = super().execute()
         if not success:
             return False
-        extns = [".JPG",".TIF"]
-        if self.input.is_file and self.input.suffix.upper in extns:
-            if not Path(self.output,f"{self.input.stem}.png").exists():
-                self.build_mask(self.input)
+        results = self.execute_items(self.items)
+        if self.isCancelled():
+            getLogger(__name__).info("Stopped building masks in %s",self.output)
+            return False, ErrorCodes.CANCELLED
+        failed = [item for item,ok,_ in results if not ok]
+        if failed:
+            getLogger(__name__).warning("Could not build masks for %s of %s pictures.",len(failed),len(results))
         return True
         
     def exit(self):
         success = True
-        extns = [".JPG",".TIF"] 
         getLogger(__name__).info("Verifying masks were created")
-        if self.input.is_file and self.input.suffix.upper in extns:
-            maskname = Path(self.output,f"{self.input.stem}.png")
+        for item in self.items:
+            maskname = self.getMaskPath(item)
             if not maskname.exists():
                 success = False
-                getLogger(__name__).info("Could not find mask for %s as %s", self.input,maskname)
+                getLogger(__name__).info("Could not find mask for %s as %s", item,maskname)
         return success
 class MaskIntersection(MaskImages):
     """Builds a mask that is the intersection of two other masks."""
@@ -70,12 +112,18 @@ class MaskThreshold(MaskImages):
     changing the thresholding_lower_gray_threshold value in config.json if you are not getting results you like. This should be a value between 0 and 255.
     For this method to work well, you should have good control over the lighting in your photographs and have a background and turntable that are white."""
 
+    memoize = True
+    memoryoperation = "threshold_mask"
+
     def __init__(self, argdict:dict):
         super().__init__(argdict)
         self.greythreshold = Configurator.getConfig().getProperty("processing","thresholding_lower_gray_threshold")
 
     def __repr__(self):
         return "Masking: MaskThreshold"
+
+    def getMemoParams(self):
+        return {"threshold":self.greythreshold}
     
     def setup(self):
         success = super().setup()
@@ -86,8 +134,8 @@ class MaskThreshold(MaskImages):
     
     @timed(Statistic_Event_Types.EVENT_BUILD_MASK)
     def build_mask(self,fn:Path):
-        picpath = Path(self.input,fn)
-        maskout = Path(self.output,f"{fn.stem}.png")
+        picpath = Path(fn)
+        maskout = self.getMaskPath(fn)
         img = cv2.imread(str(picpath))
         #threshold image
         grayscale = cv2.cvtColor(img,cv2.COLOR_BGR2GRAY)
@@ -103,14 +151,29 @@ class MaskDroplet(MaskImages):
     also in config.json under processing->Droplet_Output. This is generally the slowest way to do masking and requires that the object is positioned over the center pixel
     when the photograph is taken. It generally does the most accurate maksing job for the widest variety of objects, but takes about 5 times as much time as the
     Docker Roboflow-inference method and about 16 times as long as thresholding."""
+    memoize = True
+    memoryoperation = "droplet_mask"
 
     def __init__(self, argdict:dict):
         super().__init__(argdict)
         self.dropletoutput = Path(Configurator.getConfig().getProperty("processing","Droplet_Output"))
         self.dropletpath = Path(Configurator.getConfig().getProperty("processing","SmartSelectDroplet"))
+        self.maxworkers = 1 #the droplet dumps everything into one folder, so only one picture can be in flight.
 
     def __repr__(self):
         return "Masking: MaskDroplet"
+
+    def getMemoParams(self):
+        #a droplet re-recorded in photoshop keeps its name, so its size and date stand in for its contents.
+        try:
+            st = self.dropletpath.stat()
+            return {"droplet":self.dropletpath.name,"size":st.st_size,"mtime":st.st_mtime_ns}
+        except OSError:
+            return {"droplet":str(self.dropletpath)}
+
+    def getSerialKey(self):
+        #every droplet run dumps its mask into the same output folder, so droplet tasks can't overlap.
+        return self.dropletoutput
     
     def setup(self):
         success = super().setup()
@@ -119,7 +182,7 @@ class MaskDroplet(MaskImages):
         if not self.dropletpath.exists():
             getLogger(__name__).error("Invalid droplet path, %s", self.dropletpath)
             return False
-        getLogger(__name__).info("Using Droplet at %s to process photos in %s", self.dropletpath,self.input)
+        getLogger(__name__).info("Using Droplet at %s to process photos in %s", self.dropletpath,self.inputs)
 
         maskdir = self.output
         if not maskdir.exists():
@@ -130,9 +193,9 @@ class MaskDroplet(MaskImages):
     
     @timed(Statistic_Event_Types.EVENT_BUILD_MASK)
     def build_mask(self, fn:Path):
-        subprocess.run([str(self.dropletpath),Path(self.input,fn)],check = False)
+        subprocess.run([str(self.dropletpath),Path(fn)],check = False)
         newmask = Path(self.dropletoutput,f"{fn.stem}.png")
-        maskpath = Path(self.output,f"{fn.stem}.png")
+        maskpath = self.getMaskPath(fn)
         if newmask.exists():
             shutil.move(newmask,maskpath)
         else:
@@ -140,11 +203,10 @@ class MaskDroplet(MaskImages):
         return True
     
     def exit(self):
-        success = super().execute()
-        if not success:
-            return False
-        shutil.rmtree(self.dropletoutput)
-        return True
+        success = super().exit()
+        if self.dropletoutput.exists():
+            shutil.rmtree(self.dropletoutput)
+        return success
     
 class MaskAI(MaskImages):
 
@@ -154,16 +216,22 @@ class MaskAI(MaskImages):
     However, it does require that the user have the inference engine running on a local server on port 9001, a roboflow API key set
     in an environment variable ROBOFLOW_KEY, and access to the pot_or_not/2 model. For help setting up the docker container, see the 
     roboflow documentation here: https://inference.roboflow.com/quickstart/docker/"""
-    
+    resourceclass = ResourceClass.IO
+    memoize = True
+    memoryoperation = "ai_mask"
 
     def __init__(self,argdict:dict):
         self.apikey = Configurator.getConfig().getProperty("processing","Roboflow_API_Key")
         self.serverurl = "http://localhost:9001"
         self.model = "pot_or_not/3"
+        self.client = None
         super().__init__(argdict)
     
     def __repr__(self):
         return "Masking: MaskAI"
+
+    def getMemoParams(self):
+        return {"model":self.model}
     
     def setup(self):
         #check to see if server is up and responsive.
@@ -183,11 +251,22 @@ class MaskAI(MaskImages):
                 ret = False
         return ret
     
+    def connect(self):
+        """Makes the inference client and loads the model on the server. Done once and shared by every picture."""
+        self.client = InferenceHTTPClient(api_url = self.serverurl,
+                                     api_key = self.apikey)
+        self.client.load_model(self.model,set_as_default=True)
+        return self.client
+
     @timed(Statistic_Event_Types.EVENT_BUILD_MASK)
-    def build_mask(self,fn:Path, inferenceclient:InferenceHTTPClient):
-        potprediction = {}             
-        picpath = Path(self.input,fn)
-        potprediction = inferenceclient.infer(str(picpath))
+    def build_mask(self,fn:Path):
+        potprediction = self.client.infer(str(Path(fn)))
+        self.drawMask(fn,potprediction)
+
+    def drawMask(self, fn:Path, potprediction:dict):
+        """Draws the mask for a picture from the predictions the inference server made for it. Kept apart from the request so
+        that the request can be made without holding a thread, as the asynchronous watcher does."""
+        picpath = Path(fn)
         pots = []
         holes=[]
         for prediction in potprediction["predictions"]:
@@ -203,24 +282,11 @@ class MaskAI(MaskImages):
                 draw.polygon(pot,fill=(255,255,255))
             for hole in holes:
                 draw.polygon(hole,fill=(0,0,0))
-            outpicpath = Path(self.output,f"{fn.stem}.png")
+            outpicpath = self.getMaskPath(fn)
             pmask.save(outpicpath)
 
     def execute(self):
-        "Need to do this because I'm fully overriding baseclass functionality here."
-        self._status = TaskStatus.RUNNING
-        getLogger(__name__).info("Executing %s",self._statename)
-        success = True
-        client = InferenceHTTPClient(api_url = self.serverurl,
-                                     api_key = self.apikey)
-        client.load_model(self.model,set_as_default=True)
-        getLogger(__name__).info("Building masks for files in %s and leaving the results in %s", self.input, self.output)
-        extns = [".JPG",".TIF"]
-        t = self.input.is_file()
-        ex = self.input.suffix.upper() in extns
-        if self.input.is_file() and self.input.suffix.upper() in extns:
-            maskname =  Path(self.output,f"{self.input.stem}.png")
-            if not maskname.exists():
-                self.build_mask(self.input,client)
-        return success
-
+        "The inference client is made once and shared by every picture in the batch."
+        self.connect()
+        getLogger(__name__).info("Building masks for files in %s and leaving the results in %s", self.inputs, self.output)
+        return super().execute()
@@ -11,9 +11,12 @@ from util.Configurator import Configurator
 from util.MetashapeFileHandleSingleton import MetashapeFileSingleton
 from util import util
 from photogrammetry import ModelHelpers
-from tasks.BaseTask import BaseTask
+from tasks.BaseTask import BaseTask, ResourceClass
+from util.Cancellation import OperationCancelled
 
 class MetashapeTask(BaseTask):
+    resourceclass = ResourceClass.METASHAPE_EXCLUSIVE
+
     def __init__(self, argdict:dict):
         super().__init__()
         self.projectname = argdict["projectname"]
@@ -22,6 +25,11 @@ class MetashapeTask(BaseTask):
         self.doc = None
         self.chunkname = argdict["chunkname"]
         self.chunk = None
+    def getIdentityParams(self):
+        return {"projectname":self.projectname,"chunkname":self.chunkname}
+    def getSerialKey(self):
+        #all tasks on the same project share one psx file, so they have to run in the order they were queued.
+        return Path(self.output,f"{self.projectname}.psx")
     def setup(self):
         success,code = super().setup()
         self.doc =MetashapeFileSingleton.getMetashapeDoc(self.projectname,self.output)
@@ -35,8 +43,8 @@ class MetashapeTask(BaseTask):
             getLogger(__name__).warning("Setup task failed to execute because there is no chunk %s",self.chunkname)
         return success,code
     def exit(self):
-        success = super().exit()
-        return success, ErrorCodes.NONE
+        success, code = super().exit()
+        return success, code
 
 
 class MetashapeTask_AlignPhotos(MetashapeTask):
@@ -58,6 +66,13 @@ class MetashapeTask_AlignPhotos(MetashapeTask):
 
     def __repr__(self):
         return "Metashape Task: Align Photos"
+    def getInputs(self):
+        if len(self.photos)>0:
+            return [Path(p) for p in self.photos]
+        inputs = [self.input]
+        if self.maskoption is not MaskingOptions.NOMASKS and self.maskoption != MaskingOptions.NOMASKS.value:
+            inputs.append(Path(self.output,self.maskpath))
+        return inputs
     def setup(self):
         #in order for this task to succeed, there must be a chunk, and there must be photos.
         success,code = super().setup()
@@ -112,7 +127,7 @@ class MetashapeTask_AlignPhotos(MetashapeTask):
 
     def loadMasks(self):
         maskpath = Path(self.output,self.maskpath)
-        masks = listdir(maskpath)
+        masks = [m for m in listdir(maskpath) if not m.startswith(".")] #skip the fingerprints recorded next to the masks.
         if len(masks)>0:
             getLogger(__name__).info("Loading masks from %s", maskpath)
             ext = Path(masks[0]).suffix #get the ext
@@ -259,6 +274,11 @@ class MetashapeTask_AlignChunks(MetashapeTask):
 
     def __repr__(self):
         return "Metashape Task: Align Chunks by Marker"
+
+    def getIdentityParams(self):
+        params = super().getIdentityParams()
+        params["chunklist"] = self.chunkstoalign
+        return params
     
     def setup(self):
         #for this to succeed, if in marker based alignment, there must be a palette.
@@ -378,7 +398,11 @@ class MetashapeTask_ErrorReduction(MetashapeTask):
             try:     
                 if self.chunk.tie_points and not self.chunk.model:  
                     thresholds = Configurator.getConfig().getProperty("photogrammetry","error_thresholds")
-                    ModelHelpers.refine_sparse_cloud(self.doc, self.chunk,thresholds)
+                    ModelHelpers.refine_sparse_cloud(self.doc, self.chunk,thresholds,self.cancellationtoken)
+            except OperationCancelled:
+                #the document is left as of its last save, so rerunning the task starts the refinement over.
+                getLogger(__name__).info("Stopped refining the sparse cloud on %s",self.chunk.label)
+                return False, ErrorCodes.CANCELLED
             except Exception as e:
                 getLogger(__name__).error(e)
                 code = ErrorCodes.UNKNOWN
@@ -505,6 +529,7 @@ class MetashapeTask_Reorient(MetashapeTask):
         the UI. NOTE: THIS OPERATION DOES NOT SAVE.
 
     """
+    resumable = False
     def __init__(self,argdict:dict):
         super().__init__(argdict)
         self.palette_info = None 
@@ -562,6 +587,11 @@ class MetashapeTask_ExportModel(MetashapeTask):
 
     def __repr__(self):
         return "Metashape Task: Export Chunk"
+
+    def getOutputs(self):
+        outputfolder = Configurator.getConfig().getProperty("photogrammetry","output_path")
+        outputfile = util.get_export_filename(self.chunkname.replace(" ",""),self.extn)
+        return [Path(self.output,outputfolder,f"{outputfile}{self.extn}")]
     
     def setup(self):
         success, code = super().setup()
@@ -592,6 +622,9 @@ class MetashapeTask_ExportOrthomosaic(MetashapeTask):
 
     def __repr__(self):
         return "Metashape Task: Export Orthomosaic"
+    def getOutputs(self):
+        outputfolder = Configurator.getConfig().getProperty("photogrammetry","output_path")
+        return [Path(self.output,outputfolder,f"{self.chunkname}_Orthomosaic.tif")]
     def setup(self):
         success, code = super().setup()
         if success:
@@ -0,0 +1,158 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from tasks.BaseTask import normalizeResult
+from util.ErrorCodeConsts import ErrorCodes
+
+
+def _codeName(code)->str:
+    return code.name if isinstance(code,ErrorCodes) else str(code)
+
+class TaskRecord():
+    """The timings and result of one task in a run. Created by RunReport.beginTask.
+
+    CPU time is the time spent on the thread running the task plus the time spent on any threads the task's batch used via
+    BaseTask.parallel_map. Threads started inside native libraries, like Metashape's own worker threads, are not counted here,
+    but do show up in the CPU time of the whole run.
+    """
+
+    def __init__(self, task, identity:str, offset:float):
+        self.task = task
+        self.name = str(task)
+        self.identity = identity
+        self.resourceclass = task.resourceclass.value
+        self.phases = {}
+        self.started = offset
+        self.ended = None
+        self.status = "running"
+        self.result = None
+        self.itemsprocessed = 0
+
+    def timePhase(self, phase:str, func)->tuple:
+        """Calls one phase of the task, recording how long it took.
+
+        Parameters:
+        -----------
+        phase: the name of the phase, setup, execute or exit.
+        func: the bound method for the phase.
+
+        returns: success, code
+        """
+        itemcpu = self.task.getItemCpuTime()
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            success, code = normalizeResult(func())
+        except Exception:
+            self._recordPhase(phase,wall,cpu,itemcpu,ErrorCodes.UNKNOWN)
+            raise
+        self._recordPhase(phase,wall,cpu,itemcpu,code)
+        return success, code
+
+    def _recordPhase(self, phase, wall, cpu, itemcpu, code):
+        self.phases[phase] = {"wall_s":round(time.perf_counter()-wall,4),
+                              "cpu_s":round(time.thread_time()-cpu+self.task.getItemCpuTime()-itemcpu,4),
+                              "result":_codeName(code)}
+
+    def getWallTime(self)->float:
+        return sum(p["wall_s"] for p in self.phases.values())
+
+    def getCpuTime(self)->float:
+        return sum(p["cpu_s"] for p in self.phases.values())
+
+    def toDict(self)->dict:
+        return {"name":self.name,
+                "identity":self.identity,
+                "resource_class":self.resourceclass,
+                "status":self.status,
+                "result":self.result,
+                "items_processed":self.itemsprocessed,
+                "started_s":None if self.started is None else round(self.started,4),
+                "ended_s":None if self.ended is None else round(self.ended,4),
+                "wall_s":round(self.getWallTime(),4),
+                "cpu_s":round(self.getCpuTime(),4),
+                "phases":self.phases}
+
+class RunReport():
+    """A structured record of a run of the task scheduler: for every task, how long each of its phases took in wall clock and CPU
+    time, what it returned, and how many items it processed. Task start and end times are seconds since the start of the run,
+    so overlapping tasks can be spotted. The memory section compares the MemoryBudget's estimates with the rss measured while
+    they were reserved, so that the estimates can be tuned. Written as json next to the project by executeTasks.
+
+    Parameters:
+    -----------
+    limits: the scheduler's per resource class concurrency limits, recorded so runs with different settings can be compared.
+    """
+
+    def __init__(self, limits:dict=None):
+        self._lock = threading.Lock()
+        self.started = datetime.now()
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        self.limits = {rc.value:v for rc,v in (limits or {}).items()}
+        self.records = []
+        self.wall = None
+        self.cpu = None
+        self.succeeded = None
+        self.result = None
+        self.memory = None
+
+    def getOffset(self)->float:
+        return time.perf_counter()-self._wall
+
+    def beginTask(self, task, identity:str=None)->TaskRecord:
+        record = TaskRecord(task,identity,self.getOffset())
+        with self._lock:
+            self.records.append(record)
+        return record
+
+    def finishTask(self, record:TaskRecord, success:bool, code, skipped:bool=False):
+        record.ended = self.getOffset()
+        record.status = "skipped" if skipped else ("completed" if success else "failed")
+        record.result = _codeName(code)
+        record.itemsprocessed = record.task.getItemsProcessed()
+
+    def addNotRun(self, task, identity:str=None):
+        """Records a task that never started, because an earlier task failed or the run was halted."""
+        record = TaskRecord(task,identity,None)
+        record.status = "not run"
+        with self._lock:
+            self.records.append(record)
+
+    def finish(self, succeeded:bool, code):
+        self.wall = time.perf_counter()-self._wall
+        self.cpu = time.process_time()-self._cpu
+        self.succeeded = succeeded
+        self.result = _codeName(code)
+
+    def toDict(self)->dict:
+        with self._lock:
+            records = list(self.records)
+        byclass = {}
+        for r in records:
+            c = byclass.setdefault(r.resourceclass,{"tasks":0,"wall_s":0.0,"cpu_s":0.0})
+            c["tasks"]+=1
+            c["wall_s"]=round(c["wall_s"]+r.getWallTime(),4)
+            c["cpu_s"]=round(c["cpu_s"]+r.getCpuTime(),4)
+        return {"started":self.started.strftime("%Y-%m-%d %H:%M:%S.%f"),
+                "wall_s":None if self.wall is None else round(self.wall,4),
+                "cpu_s":None if self.cpu is None else round(self.cpu,4),
+                "succeeded":self.succeeded,
+                "result":self.result,
+                "limits":self.limits,
+                "by_resource_class":byclass,
+                "memory":self.memory,
+                "tasks":[r.toDict() for r in records]}
+
+    def write(self, path:Path):
+        """Writes the report as json, replacing any report from an earlier run."""
+        path = Path(path)
+        if not path.parent.exists():
+            os.makedirs(path.parent)
+        tmppath = Path(path.parent,f"{path.name}.tmp")
+        with open(tmppath,'w',encoding="utf-8") as f:
+            json.dump(self.toDict(),f,indent=1)
+        os.replace(tmppath,path)
@@ -0,0 +1,70 @@
+import json
+import os
+import threading
+from datetime import datetime
+from pathlib import Path
+from util.ErrorCodeConsts import ErrorCodes
+from util.PipelineLogging import getLogger
+
+
+class JournalStatus():
+    """Constants for the status of a task in the journal."""
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"
+
+class TaskJournal():
+    """An on-disk record of the tasks run for a project, so that a build that died halfway can be resumed.
+    Each entry is keyed by the task's identity and records the fingerprint of its inputs, its status, how long it took,
+    and the ErrorCodes value it finished with. The journal is rewritten after every change so that it survives a crash.
+
+    Parameters:
+    -----------
+    path: the json file to keep the journal in, usually <projectdir>/<projectname>_journal.json
+    """
+
+    def __init__(self, path:Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self.entries = {}
+        if self.path.exists():
+            try:
+                with open(self.path,'r',encoding="utf-8") as f:
+                    self.entries = json.load(f).get("tasks",{})
+            except (OSError, ValueError) as e:
+                getLogger(__name__).warning("Could not read task journal %s, starting a new one. %s",self.path,e)
+                self.entries = {}
+
+    def save(self):
+        tmppath = Path(self.path.parent,f"{self.path.name}.tmp")
+        if not self.path.parent.exists():
+            os.makedirs(self.path.parent)
+        with open(tmppath,'w',encoding="utf-8") as f:
+            json.dump({"tasks":self.entries},f,indent=1)
+        os.replace(tmppath,self.path)
+
+    def isComplete(self, identity:str, fingerprint:str)->bool:
+        """Returns true if the task with this identity completed successfully with inputs matching the fingerprint."""
+        with self._lock:
+            entry = self.entries.get(identity)
+        return entry is not None and entry["status"]==JournalStatus.COMPLETED and entry["fingerprint"]==fingerprint
+
+    def recordStart(self, identity:str, name:str, fingerprint:str):
+        with self._lock:
+            self.entries[identity] = {"name":name,
+                                      "fingerprint":fingerprint,
+                                      "status":JournalStatus.RUNNING,
+                                      "started":datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f"),
+                                      "duration":None,
+                                      "result":None}
+            self.save()
+
+    def recordResult(self, identity:str, success:bool, code:ErrorCodes, duration:float):
+        with self._lock:
+            entry = self.entries.get(identity)
+            if entry is None:
+                return
+            entry["status"] = JournalStatus.COMPLETED if success else JournalStatus.FAILED
+            entry["duration"] = duration
+            entry["result"] = code.name if isinstance(code,ErrorCodes) else str(code)
+            self.save()
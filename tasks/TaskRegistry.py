@@ -0,0 +1,91 @@
+"""Maps the task names used in task lists, like "ConvertJPG" or "Metashape_Align", to the classes that implement them.
+
+Task classes are only imported the first time a task of that name is built, so that scripts which never touch Metashape,
+Blender, or the roboflow inference client don't pay to load them. Register new tasks here instead of importing them in
+photogrammetryPipeline.py."""
+
+import importlib
+import threading
+from util.util import MaskingOptions
+
+_LOCK = threading.Lock()
+#task name -> (module, class name)
+_REGISTRY = {
+    "ConvertJPG":("tasks.ConversionTasks","ConvertToJPG"),
+    "Metashape_DetectMarkers":("tasks.MetashapeTasks","MetashapeTask_DetectMarkers"),
+    "Metashape_Align":("tasks.MetashapeTasks","MetashapeTask_AlignPhotos"),
+    "Metashape_ErrorReduction":("tasks.MetashapeTasks","MetashapeTask_ErrorReduction"),
+    "Metashape_BuildModel":("tasks.MetashapeTasks","MetashapeTask_BuildModel"),
+    "Metashape_FindScales":("tasks.MetashapeTasks","MetashapeTask_AddScales"),
+    "Metashape_AlignChunks":("tasks.MetashapeTasks","MetashapeTask_AlignChunks"),
+    "Metashape_BuildTextures":("tasks.MetashapeTasks","MetashapeTask_BuildTextures"),
+    "Metashape_Reorient":("tasks.MetashapeTasks","MetashapeTask_Reorient"),
+    "Metashape_ExportModel":("tasks.MetashapeTasks","MetashapeTask_ExportModel"),
+    "Blender_Snapshot":("tasks.BlenderTasks","BlenderSnapshotTask"),
+    "Distributed":("tasks.DistributedTasks","DistributedBatch"),
+}
+#the "Masking" task picks its class by the maskoption argument. MaskingOptions value -> (module, class name)
+_MASKING_REGISTRY = {
+    MaskingOptions.MASK_AI.value:("tasks.MaskingTasks","MaskAI"),
+    MaskingOptions.MASK_THRESHOLDING.value:("tasks.MaskingTasks","MaskThreshold"),
+    MaskingOptions.MASK_CONTEXT_AWARE_DROPLET.value:("tasks.MaskingTasks","MaskDroplet"),
+}
+_LOADED = {}
+
+def registerTask(name:str, modulename:str, classname:str):
+    """Adds a task to the registry, or points an existing name at a different class.
+
+    Parameters:
+    -----------
+    name: the name used for the task in task lists.
+    modulename: the dotted name of the module the class lives in, e.g. tasks.MetashapeTasks
+    classname: the name of the class in that module.
+    """
+    with _LOCK:
+        _REGISTRY[name] = (modulename,classname)
+        _LOADED.pop((modulename,classname),None)
+
+def getRegisteredNames()->list:
+    with _LOCK:
+        return list(_REGISTRY.keys())+["Masking"]
+
+def _load(entry:tuple):
+    with _LOCK:
+        cls = _LOADED.get(entry)
+    if cls is None:
+        modulename, classname = entry
+        cls = getattr(importlib.import_module(modulename),classname)
+        with _LOCK:
+            _LOADED[entry] = cls
+    return cls
+
+def getTaskClass(name:str, argdict:dict=None):
+    """Returns the class for a task name, importing its module if it hasn't been imported yet.
+
+    Parameters:
+    -----------
+    name: the name of the task.
+    argdict: the task's arguments. Only used for "Masking", where maskoption picks the class.
+
+    returns: the task class, or None if no task is registered under that name.
+    """
+    if name == "Masking":
+        maskoption = (argdict or {}).get("maskoption")
+        maskoption = maskoption.value if isinstance(maskoption,MaskingOptions) else maskoption
+        entry = _MASKING_REGISTRY.get(int(maskoption)) if maskoption is not None else None
+    else:
+        with _LOCK:
+            entry = _REGISTRY.get(name)
+    if entry is None:
+        return None
+    return _load(entry)
+
+def createTask(name:str, argdict:dict):
+    """Builds a task from its name and arguments, as given in a task list.
+
+    returns: the task, or None if no task is registered under that name.
+    """
+    cls = getTaskClass(name,argdict)
+    if cls is None:
+        return None
+    return cls(argdict)
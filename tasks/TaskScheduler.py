@@ -0,0 +1,293 @@
+import heapq
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+from queue import Queue
+from tasks.BaseTask import ResourceClass, normalizeResult
+from tasks.RunReport import RunReport
+from util.Configurator import Configurator
+from util.Cancellation import CancellationToken
+from util.ErrorCodeConsts import ErrorCodes
+from util.Fingerprint import fingerprintPaths
+from util.InstrumentationStatistics import InstrumentationStatistics
+from util.MemoryBudget import MemoryBudget
+from util.MetashapeFileHandleSingleton import MetashapeFileSingleton
+from util.PipelineLogging import getLogger
+
+
+def _normalizePath(p)->Path:
+    return Path(os.path.normcase(os.path.abspath(p)))
+
+def getConfiguredLimits()->dict:
+    """Reads the number of tasks of each resource class that may run at once from config.json->scheduler.
+    Missing values fall back to one metashape lane, one blender lane, four io workers and one cpu worker per core.
+
+    returns: a dictionary of ResourceClass:int
+    """
+    defaults = {ResourceClass.CPU_POOL:("cpu_pool_workers",os.cpu_count() or 1),
+                ResourceClass.IO:("io_workers",4),
+                ResourceClass.METASHAPE_EXCLUSIVE:("metashape_workers",1),
+                ResourceClass.BLENDER:("blender_workers",1)}
+    config = Configurator.getConfig()
+    limits = {}
+    for rc,(key,default) in defaults.items():
+        limits[rc] = int(config.getPropertyOrDefault("scheduler",key,0)) or default
+    return limits
+
+def runTask(task, record=None)->tuple:
+    """Runs the setup, execute and exit phases of a single task, stopping at the first phase that fails.
+
+    Parameters:
+    -----------
+    task: an object subclassed off of tasks::basetask.
+    record: an optional TaskRecord from a RunReport in which to record how long each phase took.
+
+    returns: success, code, phase where phase is the name of the last phase that ran.
+    """
+    def runPhase(name, func):
+        if record is None:
+            return normalizeResult(func())
+        return record.timePhase(name,func)
+    phase = "setup"
+    #the spans the task times, e.g. for each picture it converts, nest under a span for the whole task.
+    with InstrumentationStatistics.getStatistics().span(name=str(task)):
+        success, code = runPhase(phase,task.setup)
+        if success:
+            phase = "execute"
+            success, code = runPhase(phase,task.execute)
+            if success:
+                phase = "exit"
+                success, code = runPhase(phase,task.exit)
+    return success, code, phase
+
+def runJournaledTask(task, identity:str, journal, canskip:bool, record=None)->tuple:
+    """Runs a task, recording it in the task journal. If canskip is true and the journal says that the task already
+    completed with the same inputs, and its outputs are still there, the task is skipped.
+
+    returns: success, code, phase, skipped
+    """
+    fingerprint = fingerprintPaths(task.getInputs())
+    if canskip and journal.isComplete(identity,fingerprint) and all(os.path.exists(p) for p in task.getOutputs()):
+        getLogger(__name__).info("Skipping %s, which already completed with the same inputs.",str(task))
+        return True, ErrorCodes.NONE, "journal", True
+    journal.recordStart(identity,str(task),fingerprint)
+    start = time.perf_counter()
+    try:
+        success, code, phase = runTask(task,record)
+    except Exception:
+        journal.recordResult(identity,False,ErrorCodes.UNKNOWN,time.perf_counter()-start)
+        raise
+    journal.recordResult(identity,success,code,time.perf_counter()-start)
+    return success, code, phase, False
+
+
+class TaskScheduler():
+    """Runs a list of tasks as a dependency graph instead of strictly in order.
+
+    A task depends on an earlier task if one of its inputs is, or contains, one of the earlier task's outputs, or if both tasks
+    return the same serial key (for example, tasks that share a psx file). Tasks whose dependencies are all finished run concurrently,
+    up to a per-resource-class limit. As with the old linear queue, the first failure stops any new tasks from starting.
+    """
+
+    def __init__(self, limits:dict=None):
+        self.limits = limits if limits is not None else getConfiguredLimits()
+        self._tasks = []
+        self._halt = False
+        self.report = None
+
+    def addTask(self, task):
+        self._tasks.append(task)
+
+    def addTasks(self, tasks):
+        for task in tasks:
+            self.addTask(task)
+
+    def addQueue(self, taskqueue:Queue):
+        """Drains a queue built by buildTaskQueue or the multibanded task builders into the scheduler."""
+        while not taskqueue.empty():
+            self.addTask(taskqueue.get())
+
+    def halt(self):
+        """Stops new tasks from starting. Tasks that are already running are allowed to finish."""
+        self._halt = True
+
+    def buildDependencies(self)->list:
+        """Works out which earlier tasks each task has to wait for.
+
+        returns: a list, parallel to the list of tasks, of sets of task indices.
+        """
+        producers = {} #path -> tasks writing that path or something beneath it.
+        exactoutputs = {} #path -> tasks writing exactly that path.
+        lastserial = {}
+        dependencies = []
+        for idx, task in enumerate(self._tasks):
+            deps = set()
+            for inp in task.getInputs():
+                p = _normalizePath(inp)
+                deps.update(producers.get(p,[]))
+                for parent in p.parents:
+                    deps.update(exactoutputs.get(parent,[]))
+            key = task.getSerialKey()
+            if key is not None:
+                key = _normalizePath(key) if isinstance(key,(str,Path)) else key
+                if key in lastserial:
+                    deps.add(lastserial[key])
+                lastserial[key] = idx
+            deps.discard(idx)
+            dependencies.append(deps)
+            for out in task.getOutputs():
+                p = _normalizePath(out)
+                exactoutputs.setdefault(p,[]).append(idx)
+                producers.setdefault(p,[]).append(idx)
+                for parent in p.parents:
+                    producers.setdefault(parent,[]).append(idx)
+        return dependencies
+
+    def getIdentities(self)->list:
+        """Returns the journal identity of each task. Tasks that are queued more than once get a counter appended."""
+        seen = {}
+        identities = []
+        for task in self._tasks:
+            identity = task.getIdentity()
+            count = seen.get(identity,0)
+            seen[identity] = count+1
+            identities.append(identity if count==0 else f"{identity}#{count}")
+        return identities
+
+    def run(self, shouldhalt=None, journal=None, resume:bool=False, token:CancellationToken=None)->tuple:
+        """Runs every task that was added to the scheduler.
+
+        Parameters:
+        -----------
+        shouldhalt: an optional callable that returns true when no new tasks should be started.
+        token: an optional CancellationToken. It is handed to every task so that running tasks can stop partway through, and
+        no new tasks start once it is cancelled. Tasks that stop early are journaled as failed, so a resumed build reruns them.
+        journal: an optional TaskJournal to record each task in.
+        resume: if true, tasks that the journal says completed with unchanged inputs are skipped, as long as every task
+        they depend on was skipped too. This restarts the build from the first incomplete task.
+
+        returns: success, code where code is the ErrorCodes value of the first task that failed. How long each task took is left
+        in self.report.
+        """
+        logger = getLogger(__name__)
+        self.report = RunReport(self.limits)
+        for task in self._tasks:
+            task.cancellationtoken = token
+        dependencies = self.buildDependencies()
+        identities = self.getIdentities()
+        skipped = set()
+        dependents = [[] for _ in self._tasks]
+        waitingon = []
+        for idx, deps in enumerate(dependencies):
+            waitingon.append(len(deps))
+            for d in deps:
+                dependents[d].append(idx)
+        ready = {rc:[] for rc in ResourceClass}
+        for idx, count in enumerate(waitingon):
+            if count == 0:
+                heapq.heappush(ready[self._tasks[idx].resourceclass],idx)
+        running = {}
+        records = {}
+        busy = {rc:0 for rc in ResourceClass}
+        succeeded = True
+        failcode = ErrorCodes.NONE
+        error = None
+        finished = 0
+        workers = max(1,sum(max(1,v) for v in self.limits.values()))
+        logger.info("Scheduling %s tasks.",len(self._tasks))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while True:
+                halted = self._halt or (shouldhalt is not None and shouldhalt()) or CancellationToken.check(token)
+                if succeeded and not halted:
+                    for rc, heap in ready.items():
+                        while heap and busy[rc] < max(1,self.limits.get(rc,1)):
+                            idx = heapq.heappop(heap)
+                            busy[rc]+=1
+                            records[idx] = self.report.beginTask(self._tasks[idx],identities[idx])
+                            if journal is not None:
+                                canskip = resume and self._tasks[idx].resumable and dependencies[idx] <= skipped
+                                future = pool.submit(runJournaledTask,self._tasks[idx],identities[idx],journal,canskip,records[idx])
+                            else:
+                                future = pool.submit(runTask,self._tasks[idx],records[idx])
+                            running[future] = idx
+                if not running:
+                    break
+                #wake up at least twice a second so that a halt or cancellation is noticed while long tasks run.
+                done, _ = wait(running, timeout=0.5, return_when=FIRST_COMPLETED)
+                for future in done:
+                    idx = running.pop(future)
+                    task = self._tasks[idx]
+                    busy[task.resourceclass]-=1
+                    wasskipped = False
+                    try:
+                        success, code, phase, *wasskipped = future.result()
+                        wasskipped = bool(wasskipped and wasskipped[0])
+                        if wasskipped:
+                            skipped.add(idx)
+                    except Exception as e:
+                        logger.error("Task %s raised %s",str(task),e)
+                        success, code, phase = False, ErrorCodes.UNKNOWN, "unknown"
+                        error = error or e
+                    self.report.finishTask(records[idx],success,code,wasskipped)
+                    if not success:
+                        if succeeded:
+                            failcode = code
+                        succeeded = False
+                        logger.error("Phase %s for Task %s failed with error %s",phase, str(task),ErrorCodes.numToFriendlyString(code))
+                        continue
+                    finished+=1
+                    for d in dependents[idx]:
+                        waitingon[d]-=1
+                        if waitingon[d]==0:
+                            heapq.heappush(ready[self._tasks[d].resourceclass],d)
+        for idx, task in enumerate(self._tasks):
+            if idx not in records:
+                self.report.addNotRun(task,identities[idx])
+        if error is not None:
+            self.report.finish(False,ErrorCodes.UNKNOWN)
+            raise error
+        if skipped:
+            logger.info("Skipped %s tasks that were already complete.",len(skipped))
+        if succeeded and finished < len(self._tasks):
+            logger.warning("Stopped after %s of %s tasks.",finished,len(self._tasks))
+            succeeded = False
+            if CancellationToken.check(token):
+                failcode = ErrorCodes.CANCELLED
+        self.report.finish(succeeded,failcode)
+        return succeeded, failcode
+
+def executeTasks(taskqueue:Queue, journal=None, resume:bool=False, reportpath:Path=None, shouldhalt=None, token:CancellationToken=None)->tuple:
+    """Runs a queue of tasks through the task scheduler, then logs the instrumentation statistics, releases the
+    Metashape document, logs the memory budget's estimates against the measured rss and, if a report path is given, writes the run report there as json. Both the single model and
+    multibanded builds execute their task lists through this.
+
+    Parameters:
+    -----------
+    taskqueue: a queue full of objects subclassed off of tasks::basetask.
+    journal: an optional TaskJournal to record each task in.
+    resume: if true, skip tasks that the journal says already completed with the same inputs.
+    reportpath: where to write the run report, usually <projectdir>/<projectname>_runreport.json
+    shouldhalt: an optional callable that returns true when no new tasks should be started.
+    token: an optional CancellationToken that stops the run, including tasks that are partway through.
+
+    returns: success, code, report where report is the RunReport for the run.
+    """
+    scheduler = TaskScheduler()
+    scheduler.addQueue(taskqueue)
+    try:
+        succeeded, code = scheduler.run(shouldhalt, journal, resume, token)
+    finally:
+        InstrumentationStatistics.getStatistics().logReport()
+        InstrumentationStatistics.destroyStatistics()
+        MetashapeFileSingleton.destroyDoc()
+        MemoryBudget.getBudget().logStats()
+        if scheduler.report is not None:
+            scheduler.report.memory = MemoryBudget.getBudget().getStats()
+        if reportpath is not None and scheduler.report is not None:
+            try:
+                scheduler.report.write(reportpath)
+                getLogger(__name__).info("Wrote run report to %s",reportpath)
+            except OSError as e:
+                getLogger(__name__).warning("Could not write run report to %s: %s",reportpath,e)
+    return succeeded, code, scheduler.report
@@ -0,0 +1,295 @@
+import json
+import os
+import re
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+from util.Cancellation import CancellationToken
+from util.Configurator import Configurator
+from util.ErrorCodeConsts import ErrorCodes
+from util.PipelineLogging import getLogger
+
+
+def getQueueDir()->Path:
+    """Returns the shared work queue directory from config.json->workqueue->queue_dir, or None if it isn't set."""
+    path = Configurator.getConfig().getPropertyOrDefault("workqueue","queue_dir",None)
+    return Path(path) if path else None
+
+def getLeaseSeconds()->int:
+    return int(Configurator.getConfig().getPropertyOrDefault("workqueue","lease_seconds",120))
+
+def _writeJson(path:Path, data:dict):
+    tmppath = Path(path.parent,f".{path.name}.{uuid.uuid4().hex}.tmp")
+    with open(tmppath,'w',encoding="utf-8") as f:
+        json.dump(data,f,indent=1,default=str)
+    os.replace(tmppath,path)
+
+def _readJson(path:Path)->dict:
+    with open(path,'r',encoding="utf-8") as f:
+        return json.load(f)
+
+
+class DirectoryWorkQueue():
+    """A work queue kept in a shared directory, so that the capture PC and any idle workstations that can see the network share
+    can help with conversion and masking. There's no broker: every state change is a rename, which is atomic on a single
+    filesystem, so only one machine can ever win a work item.
+
+    pending/<id>.json -- waiting to be claimed.
+    leased/<id>__<worker>__<expiry>.json -- claimed by a worker until expiry, in seconds since the epoch. Workers renew the lease by
+    renaming the file with a later expiry. The coordinator renames expired leases back into pending.
+    leased/<id>__<worker>__done.json -- the worker has finished and is writing the result. Nobody else touches it.
+    leased/<id>__<worker>__reclaiming-<nonce>.json -- the coordinator has taken back an expired lease and is putting it in pending.
+    done/<id>.json -- the item with its result.
+
+    Expiry times are set by the worker's clock and checked by the coordinator's, so the lease length should be much longer than
+    the clock difference between machines.
+
+    Parameters:
+    -----------
+    queuedir: the shared directory.
+    leaseseconds: how long a claim lasts without being renewed.
+    """
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, queuedir:Path, leaseseconds:int=None):
+        self.queuedir = Path(queuedir)
+        self.leaseseconds = leaseseconds if leaseseconds is not None else getLeaseSeconds()
+        self.pending = Path(self.queuedir,"pending")
+        self.leased = Path(self.queuedir,"leased")
+        self.done = Path(self.queuedir,"done")
+        for d in (self.pending,self.leased,self.done):
+            os.makedirs(d,exist_ok=True)
+
+    @staticmethod
+    def _parseLease(name:str)->tuple:
+        """returns: id, worker, expiry where expiry is None for a lease that is being completed or reclaimed."""
+        stem = name[:-len(".json")]
+        itemid, worker, expiry = stem.rsplit("__",2)
+        return itemid, worker, (None if expiry=="done" or expiry.startswith("reclaiming") else int(expiry))
+
+    def submit(self, taskname:str, kwargs:dict)->str:
+        """Adds a work item, which a worker will run as the task taskname with the arguments kwargs.
+
+        returns: the item's id.
+        """
+        itemid = f"{time.time_ns():x}-{uuid.uuid4().hex[:8]}"
+        _writeJson(Path(self.pending,f"{itemid}.json"),{"id":itemid,"task":taskname,"kwargs":kwargs,"attempts":0})
+        return itemid
+
+    def claim(self, worker:str)->tuple:
+        """Claims the oldest pending item.
+
+        returns: item, leasepath or None, None if there was nothing to claim.
+        """
+        for p in sorted(self.pending.glob("*.json")):
+            leasepath = Path(self.leased,f"{p.stem}__{worker}__{int(time.time())+self.leaseseconds}.json")
+            try:
+                os.rename(p,leasepath)
+            except OSError:
+                continue #another worker got there first.
+            try:
+                return _readJson(leasepath), leasepath
+            except (OSError, ValueError) as e:
+                getLogger(__name__).error("Could not read work item %s: %s",leasepath,e)
+        return None, None
+
+    def renew(self, leasepath:Path)->Path:
+        """Extends a lease.
+
+        returns: the new lease path, or None if the lease was lost.
+        """
+        itemid, worker, _ = DirectoryWorkQueue._parseLease(leasepath.name)
+        newpath = Path(self.leased,f"{itemid}__{worker}__{int(time.time())+self.leaseseconds}.json")
+        try:
+            os.rename(leasepath,newpath)
+            return newpath
+        except OSError:
+            return None
+
+    def complete(self, leasepath:Path, item:dict, result:dict)->bool:
+        """Records the result of an item.
+
+        returns: false if the lease had expired and the item was given to someone else.
+        """
+        itemid, worker, _ = DirectoryWorkQueue._parseLease(leasepath.name)
+        completing = Path(self.leased,f"{itemid}__{worker}__done.json")
+        try:
+            os.rename(leasepath,completing)
+        except OSError:
+            return False
+        item["result"] = result
+        _writeJson(Path(self.done,f"{itemid}.json"),item)
+        try:
+            os.remove(completing)
+        except FileNotFoundError:
+            pass #the coordinator took it for a worker that died while completing it, and will drop it now the result is in.
+        return True
+
+    def reclaimExpired(self)->int:
+        """Puts items whose leases have expired back in pending. Items that have expired MAX_ATTEMPTS times are failed,
+        in case they are what's killing the workers.
+
+        Each lease is first renamed to a reclaiming name of its own, so that a worker renewing or completing it at the same moment,
+        or another coordinator, either wins the rename or finds the lease gone. It is only read and changed once the rename
+        has succeeded.
+
+        returns: the number of items reclaimed.
+        """
+        now = time.time()
+        reclaimed = 0
+        logger = getLogger(__name__)
+        for p in self.leased.glob("*.json"):
+            try:
+                itemid, worker, expiry = DirectoryWorkQueue._parseLease(p.name)
+                if expiry is None:
+                    #a worker died while writing its result, or a coordinator while reclaiming. Give it a full lease to finish first.
+                    if now-os.path.getmtime(p) < self.leaseseconds:
+                        continue
+                elif expiry > now:
+                    continue
+                reclaiming = Path(self.leased,f"{itemid}__{worker}__reclaiming-{uuid.uuid4().hex[:8]}.json")
+                os.rename(p,reclaiming)
+                os.utime(reclaiming)
+            except (OSError, ValueError):
+                continue #renewed, completed or reclaimed by someone else while we looked at it.
+            try:
+                if Path(self.done,f"{itemid}.json").exists():
+                    os.remove(reclaiming)
+                    continue
+                item = _readJson(reclaiming)
+                item["attempts"] = item.get("attempts",0)+1
+                if item["attempts"] >= DirectoryWorkQueue.MAX_ATTEMPTS:
+                    item["result"] = {"success":False,"code":ErrorCodes.UNKNOWN.name,"worker":worker,
+                                      "message":f"Lease expired {item['attempts']} times."}
+                    _writeJson(Path(self.done,f"{itemid}.json"),item)
+                    os.remove(reclaiming)
+                else:
+                    _writeJson(reclaiming,item)
+                    os.rename(reclaiming,Path(self.pending,f"{itemid}.json"))
+            except (OSError, ValueError) as e:
+                logger.error("Could not reclaim work item %s: %s",itemid,e)
+                continue
+            logger.warning("Reclaimed work item %s from %s, whose lease expired.",itemid,worker)
+            reclaimed+=1
+        return reclaimed
+
+    def getResult(self, itemid:str)->dict:
+        """returns: the item's result, or None if it isn't done."""
+        p = Path(self.done,f"{itemid}.json")
+        if not p.exists():
+            return None
+        try:
+            return _readJson(p).get("result")
+        except (OSError, ValueError):
+            return None
+
+    def withdraw(self, itemid:str)->bool:
+        """Takes an item off the queue if nobody has claimed it yet.
+
+        returns: true if the item was withdrawn.
+        """
+        try:
+            os.remove(Path(self.pending,f"{itemid}.json"))
+            return True
+        except OSError:
+            return False
+
+    def removeResult(self, itemid:str):
+        try:
+            os.remove(Path(self.done,f"{itemid}.json"))
+        except OSError:
+            pass
+
+
+def _publish(src:Path, destdir:Path):
+    """Copies a file into a shared folder under a temporary name and renames it into place, so that nobody sees a half copied file
+    and two workers writing the same output can't interleave."""
+    os.makedirs(destdir,exist_ok=True)
+    dest = Path(destdir,src.name)
+    tmp = Path(destdir,f".{src.name}.{uuid.uuid4().hex}.tmp")
+    shutil.copyfile(src,tmp)
+    os.replace(tmp,dest)
+
+def processItem(item:dict, token:CancellationToken=None)->dict:
+    """Runs a work item: builds its task with a local scratch folder as the output, runs it, and copies what it made into the
+    item's real output folder.
+
+    returns: the result, a json serializable dictionary.
+    """
+    from tasks.TaskRegistry import createTask
+    from tasks.TaskScheduler import runTask
+    start = time.perf_counter()
+    kwargs = dict(item["kwargs"])
+    output = Path(kwargs["output"])
+    with tempfile.TemporaryDirectory(prefix="aphoma_work_") as scratch:
+        kwargs["output"] = scratch
+        task = createTask(item["task"],kwargs)
+        if task is None:
+            return {"success":False,"code":ErrorCodes.UNKNOWN.name,"message":f"No task named {item['task']}"}
+        task.cancellationtoken = token
+        try:
+            success, code, phase = runTask(task)
+        except Exception as e:
+            getLogger(__name__).error("Work item %s raised %s",item["id"],e)
+            success, code, phase = False, ErrorCodes.UNKNOWN, "unknown"
+        published = []
+        for f in sorted(Path(scratch).iterdir()):
+            if f.is_file():
+                _publish(f,output)
+                published.append(f.name)
+    return {"success":success,"code":code.name,"phase":phase,"outputs":published,
+            "items":task.getItemsProcessed(),"duration_s":round(time.perf_counter()-start,3)}
+
+def getWorkerName()->str:
+    return re.sub(r"[^A-Za-z0-9.-]","-",f"{socket.gethostname()}-{os.getpid()}-{threading.get_ident()}")
+
+def runWorker(queue:DirectoryWorkQueue, token:CancellationToken=None, once:bool=False, idle:float=2.0)->int:
+    """Claims and runs work items until the token is cancelled. The lease on the current item is renewed in the background.
+
+    Parameters:
+    -----------
+    queue: the shared work queue.
+    token: stops the worker. The current item is abandoned, and its lease left to expire, if it doesn't finish promptly.
+    once: if true, return as soon as the queue is empty.
+    idle: how long to wait between looks at an empty queue.
+
+    returns: the number of items completed.
+    """
+    token = token if token is not None else CancellationToken()
+    worker = getWorkerName()
+    logger = getLogger(__name__)
+    completed = 0
+    logger.info("Worker %s waiting for work in %s",worker,queue.queuedir)
+    while not token.isCancelled():
+        item, leasepath = queue.claim(worker)
+        if item is None:
+            if once or token.wait(idle):
+                break
+            continue
+        logger.info("Worker %s running %s on %s",worker,item["task"],item["id"])
+        lease = {"path":leasepath}
+        finished = threading.Event()
+        def renew():
+            while not finished.wait(queue.leaseseconds/3):
+                newpath = queue.renew(lease["path"])
+                if newpath is None:
+                    logger.warning("Lost the lease on %s",item["id"])
+                    return
+                lease["path"] = newpath
+        renewer = threading.Thread(target=renew,daemon=True)
+        renewer.start()
+        try:
+            result = processItem(item,token)
+        finally:
+            finished.set()
+            renewer.join()
+        result["worker"] = worker
+        if queue.complete(lease["path"],item,result):
+            completed+=1
+        else:
+            logger.warning("Work item %s was reclaimed before %s finished it.",item["id"],worker)
+    return completed
@@ -0,0 +1,33 @@
+"""Shared fixtures. The tests run from a checkout without a config.json, so each one gets a Configurator loaded from
+config_template.json that it can change without touching the real one."""
+import json
+import sys
+from pathlib import Path
+import pytest
+
+REPO_ROOT = Path(__file__).parent.parent.absolute()
+if str(REPO_ROOT) not in sys.path:
+    sys.path.insert(0,str(REPO_ROOT))
+
+from util.Configurator import Configurator
+
+
+def loadTemplateConfig(overrides:dict=None)->Configurator:
+    """Makes config_template.json, with overrides of the form {section:{key:value}}, the config every Configurator.getConfig()
+    returns."""
+    config = Configurator.__new__(Configurator)
+    config._cfgfile = Path(REPO_ROOT,"config_template.json")
+    config._template = config._cfgfile
+    with open(config._cfgfile,'r',encoding="utf-8") as f:
+        config._config = json.load(f)["config"]
+    for section, values in (overrides or {}).items():
+        config._config.setdefault(section,{}).update(values)
+    Configurator._CONFIG = config
+    return config
+
+
+@pytest.fixture
+def config():
+    previous = Configurator._CONFIG
+    yield loadTemplateConfig()
+    Configurator._CONFIG = previous
@@ -0,0 +1,136 @@
+import threading
+from pathlib import Path
+import pytest
+from conftest import loadTemplateConfig
+from tasks.BaseTask import BaseTask
+from tasks.DistributedTasks import DistributedBatch
+from util.ArtifactCache import ArtifactCache
+from util.Configurator import Configurator
+from util.MemoryBudget import MemoryBudget
+
+
+class FakeThreshold(BaseTask):
+    """Writes the threshold and the contents of each picture into its 'mask', so a test can tell what a mask was made from."""
+    memoize = True
+
+    def __init__(self, output:Path, threshold:int):
+        super().__init__()
+        self.output = output
+        self.threshold = threshold
+        self.made = []
+
+    def __repr__(self):
+        return "Masking: FakeThreshold"
+
+    def getItemOutput(self, item:Path):
+        return Path(self.output,f"{item.stem}.png")
+
+    def getMemoParams(self):
+        return {"threshold":self.threshold}
+
+    def getItemMemoryEstimate(self, item:Path):
+        return 80, "threshold_mask"
+
+    def process_item(self, item:Path):
+        self.made.append(item)
+        self.getItemOutput(item).write_text(f"{self.threshold}:{item.read_text()}")
+        return True
+
+
+@pytest.fixture
+def cache(tmp_path):
+    previous = Configurator._CONFIG
+    loadTemplateConfig({"cache":{"use_artifact_cache":True,"artifact_cache_dir":str(Path(tmp_path,"cache"))}})
+    ArtifactCache._CACHE = None
+    yield ArtifactCache.getCache()
+    ArtifactCache._CACHE = None
+    Configurator._CONFIG = previous
+
+
+def makeProject(base:Path, contents:str)->tuple:
+    Path(base,"masks").mkdir(parents=True)
+    pic = Path(base,"pic.jpg")
+    pic.write_text(contents)
+    return pic, Path(base,"masks")
+
+
+def test_changed_picture_or_threshold_remakes_the_mask(tmp_path, config):
+    pic, masks = makeProject(tmp_path,"first")
+    task = FakeThreshold(masks,100)
+    task.execute_items([pic])
+    assert Path(masks,"pic.png").read_text() == "100:first"
+    task.execute_items([pic])
+    assert len(task.made) == 1
+
+    pic.write_text("second picture")
+    task.execute_items([pic])
+    assert Path(masks,"pic.png").read_text() == "100:second picture"
+
+    task = FakeThreshold(masks,150)
+    task.execute_items([pic])
+    assert Path(masks,"pic.png").read_text() == "150:second picture"
+
+
+def test_output_made_without_a_fingerprint_is_remade(tmp_path, config):
+    pic, masks = makeProject(tmp_path,"first")
+    Path(masks,"pic.png").write_text("left over from another build")
+    task = FakeThreshold(masks,100)
+    task.execute_items([pic])
+    assert Path(masks,"pic.png").read_text() == "100:first"
+
+
+def test_same_picture_in_another_project_is_fetched(tmp_path, cache):
+    pic, masks = makeProject(Path(tmp_path,"one"),"pot")
+    FakeThreshold(masks,100).execute_items([pic])
+    pic2, masks2 = makeProject(Path(tmp_path,"two"),"pot")
+    task = FakeThreshold(masks2,100)
+    task.execute_items([pic2])
+    assert task.made == []
+    assert Path(masks2,"pic.png").read_text() == "100:pot"
+    assert cache.getStats()["hits"] == 1
+
+
+def test_trim_keeps_a_running_total(tmp_path, cache):
+    cache.maxbytes = 20
+    for i in range(3):
+        pic, masks = makeProject(Path(tmp_path,str(i)),f"picture {i}")
+        FakeThreshold(masks,100).execute_items([pic])
+    assert cache.getSize() <= 20
+    assert len(list(cache.cachedir.rglob("*.png"))) == 1
+
+
+def test_distributed_batch_queues_outputs_that_are_out_of_date(tmp_path, config):
+    pic, masks = makeProject(tmp_path,"first")
+    batch = DistributedBatch.__new__(DistributedBatch)
+    batch.inner = FakeThreshold(masks,100)
+    assert batch._needsWork(pic)
+    Path(masks,"pic.png").write_text("left over from another build")
+    assert batch._needsWork(pic)
+    batch.inner.execute_items([pic])
+    assert not batch._needsWork(pic)
+    batch.inner = FakeThreshold(masks,150)
+    assert batch._needsWork(pic)
+
+
+def test_up_to_date_output_does_not_wait_on_the_memory_budget(tmp_path, config):
+    pic, masks = makeProject(tmp_path,"first")
+    FakeThreshold(masks,100).execute_items([pic])
+    previous = MemoryBudget._instance
+    MemoryBudget._instance = MemoryBudget(100)
+    holding = threading.Event()
+    release = threading.Event()
+    def other():
+        with MemoryBudget._instance.reserve(90,"raw_convert"):
+            holding.set()
+            release.wait(10)
+    threading.Thread(target=other,daemon=True).start()
+    try:
+        assert holding.wait(10)
+        done = threading.Event()
+        task = FakeThreshold(masks,100)
+        threading.Thread(target=lambda: (task.execute_items([pic]),done.set()),daemon=True).start()
+        assert done.wait(2)
+        assert task.made == []
+    finally:
+        release.set()
+        MemoryBudget._instance = previous
@@ -0,0 +1,17 @@
+from pathlib import Path
+from tasks.BuildQueue import BuildQueue, JobStatus
+
+
+def test_empty_queue_reads_before_its_folder_exists(tmp_path, config):
+    queue = BuildQueue(Path(tmp_path,"new","buildqueue.json"))
+    assert queue.getJobs() == []
+    assert queue.getJobs(True) == []
+    assert queue.countStatus(JobStatus.QUEUED) == 0
+
+
+def test_submitted_jobs_run_by_priority(tmp_path, config):
+    queue = BuildQueue(Path(tmp_path,"buildqueue.json"))
+    first = queue.submit("first","src","proj")
+    urgent = queue.submit("urgent","src","proj",priority=5)
+    assert [j["id"] for j in queue.getJobs()] == [urgent,first]
+    assert queue.getStatus(first) == JobStatus.QUEUED
@@ -0,0 +1,45 @@
+import os
+import time
+from pathlib import Path
+from util.FileLock import FileLock
+
+
+def makeStale(path:Path, owner:str):
+    path.write_text(owner)
+    old = time.time()-120
+    os.utime(path,(old,old))
+
+
+def test_stale_lock_is_broken(tmp_path):
+    path = Path(tmp_path,"queue.lock")
+    makeStale(path,"deadhost:1:x")
+    with FileLock(path,timeout=5) as lock:
+        assert path.read_text() == lock._owner
+    assert not path.exists()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_release_leaves_a_lock_someone_else_took(tmp_path):
+    path = Path(tmp_path,"queue.lock")
+    lock = FileLock(path,timeout=5)
+    lock.acquire()
+    #the lock was broken as stale while held, and another process has it now.
+    path.write_text("otherhost:2:y")
+    lock.release()
+    assert path.read_text() == "otherhost:2:y"
+
+
+def test_fresh_lock_taken_while_breaking_is_put_back(tmp_path):
+    path = Path(tmp_path,"queue.lock")
+    makeStale(path,"deadhost:1:x")
+    class Racing(FileLock):
+        #another process breaks the stale lock and takes a fresh one just after this one reads the owner.
+        def _readOwner(self, p):
+            owner = super()._readOwner(p)
+            if p == self.path and owner == "deadhost:1:x":
+                os.remove(self.path)
+                self.path.write_text("otherhost:2:y")
+            return owner
+    assert not Racing(path,timeout=5)._breakStale()
+    assert path.read_text() == "otherhost:2:y"
+    assert list(tmp_path.iterdir()) == [path]
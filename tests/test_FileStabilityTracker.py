@@ -0,0 +1,46 @@
+import threading
+import time
+from util.FileStabilityTracker import FileStabilityTracker
+
+
+def waitFor(condition, timeout:float=10.0):
+    deadline = time.monotonic()+timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_file_counts_as_pending_until_onready_returns(tmp_path):
+    picture = tmp_path/"pic.cr2"
+    picture.write_bytes(b"raw")
+    entered = threading.Event()
+    release = threading.Event()
+    def onready(path):
+        entered.set()
+        release.wait(10)
+    tracker = FileStabilityTracker(onready,settle=0.05,interval=0.01)
+    tracker.start()
+    try:
+        tracker.track(picture)
+        assert entered.wait(10)
+        assert tracker.getPendingCount() == 1
+        release.set()
+        waitFor(lambda: tracker.getPendingCount() == 0)
+    finally:
+        release.set()
+        tracker.stop()
+
+
+def test_file_on_the_ready_queue_counts_until_its_worker_is_done(tmp_path):
+    picture = tmp_path/"pic.cr2"
+    picture.write_bytes(b"raw")
+    tracker = FileStabilityTracker(settle=0.05,interval=0.01)
+    tracker.start()
+    try:
+        tracker.track(picture)
+        assert tracker.ready.get(timeout=10) == str(picture)
+        assert tracker.getPendingCount() == 1
+        tracker.ready.task_done()
+        assert tracker.getPendingCount() == 0
+    finally:
+        tracker.stop()
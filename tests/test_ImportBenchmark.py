@@ -0,0 +1,28 @@
+import subprocess
+import sys
+import pytest
+from util.ImportBenchmark import REPO_ROOT, measureImportTime, summarize
+
+#modules that tasks.TaskRegistry only imports once a task from them is created.
+LAZY_MODULES = ["tasks.MaskingTasks","tasks.MetashapeTasks","tasks.ConversionTasks","tasks.BlenderTasks"]
+
+
+@pytest.mark.parametrize("modulename",["tasks.TaskRegistry","photogrammetryPipeline","photogrammetryScripts"])
+def test_entry_point_leaves_sdks_and_tasks_unloaded(modulename):
+    returncode, entries, errors = measureImportTime(modulename)
+    assert returncode == 0, errors
+    assert summarize(modulename,entries,0)["lazy_loaded"] == []
+    assert [name for _,_,_,name in entries if name in LAZY_MODULES] == []
+
+
+def test_creating_a_masking_task_loads_its_module():
+    for sdk in ["cv2","PIL","inference_sdk"]:
+        pytest.importorskip(sdk)
+    code = ("import sys, photogrammetryPipeline\n"
+            "from tasks.TaskRegistry import getTaskClass\n"
+            "from util.util import MaskingOptions\n"
+            "assert 'tasks.MaskingTasks' not in sys.modules and 'cv2' not in sys.modules\n"
+            "getTaskClass('Masking',{'maskoption':MaskingOptions.MASK_THRESHOLDING})\n"
+            "assert 'tasks.MaskingTasks' in sys.modules and 'cv2' in sys.modules\n")
+    proc = subprocess.run([sys.executable,"-c",code],cwd=REPO_ROOT,capture_output=True,text=True,check=False)
+    assert proc.returncode == 0, proc.stderr
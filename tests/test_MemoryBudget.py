@@ -0,0 +1,40 @@
+import threading
+from util.MemoryBudget import MemoryBudget
+
+
+def test_nested_reservation_on_the_same_thread_is_let_in():
+    budget = MemoryBudget(100)
+    admitted = threading.Event()
+    def nested():
+        with budget.reserve(80,"raw_convert"):
+            with budget.reserve(60,"ai_mask"):
+                admitted.set()
+    worker = threading.Thread(target=nested,daemon=True)
+    worker.start()
+    assert admitted.wait(10)
+    worker.join(10)
+    assert budget.getInUse() == 0
+
+
+def test_nested_reservation_still_waits_on_other_threads():
+    budget = MemoryBudget(100)
+    release = threading.Event()
+    holding = threading.Event()
+    def other():
+        with budget.reserve(50,"tif_convert"):
+            holding.set()
+            release.wait(10)
+    threading.Thread(target=other,daemon=True).start()
+    assert holding.wait(10)
+    admitted = threading.Event()
+    def nested():
+        with budget.reserve(30,"raw_convert"):
+            with budget.reserve(60,"ai_mask"):
+                admitted.set()
+    worker = threading.Thread(target=nested,daemon=True)
+    worker.start()
+    assert not admitted.wait(0.3)
+    release.set()
+    assert admitted.wait(10)
+    worker.join(10)
+    assert budget.getInUse() == 0
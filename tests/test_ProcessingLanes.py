@@ -0,0 +1,40 @@
+import threading
+import time
+from util.ProcessingLanes import ProcessingLanes
+
+
+def waitFor(condition, timeout:float=10.0):
+    deadline = time.monotonic()+timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_manifest_submitted_again_while_its_build_is_queued_is_built_once(tmp_path):
+    manifest = tmp_path/"capture_manifest.json"
+    manifest.write_text("{}")
+    release = threading.Event()
+    started = []
+    finished = []
+    def build(path):
+        started.append(path)
+        release.wait(10)
+        finished.append(path)
+    lanes = ProcessingLanes(lambda p: None,build,lambda p: p.endswith("_manifest.json"))
+    lanes.start()
+    try:
+        #the second submit is the reconcile finding the manifest again while the first build waits or runs.
+        assert lanes.submit(str(manifest))
+        assert lanes.submit(str(manifest))
+        waitFor(lambda: started)
+        assert lanes.submit(str(manifest))
+        release.set()
+        waitFor(lambda: finished)
+        time.sleep(0.3)
+        assert started == [str(manifest)]
+        #once the build is done, whether to build it again is up to the caller.
+        assert lanes.submit(str(manifest))
+        waitFor(lambda: len(finished) == 2)
+    finally:
+        release.set()
+        lanes.stop()
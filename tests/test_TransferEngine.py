@@ -0,0 +1,100 @@
+import json
+import os
+from pathlib import Path
+from transfer.TransferEngine import TransferEngine, checksumFile
+from util.Cancellation import CancellationToken
+
+
+def makeSource(folder:Path, size:int=300_000)->Path:
+    folder.mkdir(parents=True,exist_ok=True)
+    src = Path(folder,"IMG_0.CR2")
+    src.write_bytes(os.urandom(size))
+    return src
+
+
+def leavePartial(src:Path, destdir:Path, nbytes:int, source:dict=None)->tuple:
+    """Makes the partial file and sidecar that an interrupted copy of the first nbytes of src leaves behind."""
+    destdir.mkdir(parents=True,exist_ok=True)
+    partial, sidecar = TransferEngine.getPartialPaths(Path(destdir,src.name))
+    partial.write_bytes(src.read_bytes()[:nbytes])
+    st = os.stat(src)
+    sidecar.write_text(json.dumps(source if source is not None else {"size":st.st_size,"mtime_ns":st.st_mtime_ns}))
+    return partial, sidecar
+
+
+def test_copy_resumes_from_the_partial_file(tmp_path):
+    src = makeSource(Path(tmp_path,"src"))
+    destdir = Path(tmp_path,"net")
+    partial, sidecar = leavePartial(src,destdir,100_000)
+    result = TransferEngine(streams=1,retries=0).copyFile(src,destdir)
+    assert result["ok"]
+    assert result["bytes"] == 200_000
+    assert result["checksum"] == checksumFile(src)
+    assert Path(destdir,src.name).read_bytes() == src.read_bytes()
+    assert not partial.exists() and not sidecar.exists()
+
+
+def test_partial_file_of_a_changed_source_is_started_again(tmp_path):
+    src = makeSource(Path(tmp_path,"src"))
+    destdir = Path(tmp_path,"net")
+    leavePartial(src,destdir,100_000,{"size":300_000,"mtime_ns":1})
+    result = TransferEngine(streams=1,retries=0).copyFile(src,destdir)
+    assert result["ok"]
+    assert result["bytes"] == 300_000
+    assert Path(destdir,src.name).read_bytes() == src.read_bytes()
+
+
+class FlakyEngine(TransferEngine):
+    """Fails the first few attempts at a copy, like a dropped network connection would."""
+
+    def __init__(self, failures:int, token:CancellationToken=None, **kwargs):
+        super().__init__(**kwargs)
+        self.failures = failures
+        self.token = token
+
+    def _copyOnce(self, src, dest, token):
+        if self.failures > 0:
+            self.failures -= 1
+            if self.token is not None:
+                self.token.cancel("Stopped during the backoff.")
+            raise OSError("The network name is no longer available.")
+        return super()._copyOnce(src,dest,token)
+
+
+def test_failed_copy_is_retried(tmp_path):
+    src = makeSource(Path(tmp_path,"src"))
+    result = FlakyEngine(2,streams=1,retries=3,backoff=0.01).copyFile(src,Path(tmp_path,"net"))
+    assert result["ok"]
+    assert result["attempts"] == 3
+    assert "error" not in result
+
+
+def test_copy_gives_up_after_its_retries(tmp_path):
+    src = makeSource(Path(tmp_path,"src"))
+    result = FlakyEngine(5,streams=1,retries=2,backoff=0.01).copyFile(src,Path(tmp_path,"net"))
+    assert not result["ok"]
+    assert result["attempts"] == 3
+    assert "no longer available" in result["error"]
+    assert not Path(tmp_path,"net",src.name).exists()
+
+
+def test_cancelling_during_the_backoff_stops_retrying(tmp_path):
+    src = makeSource(Path(tmp_path,"src"))
+    token = CancellationToken()
+    result = FlakyEngine(1,token,streams=1,retries=3,backoff=5.0).copyFile(src,Path(tmp_path,"net"),token)
+    assert not result["ok"]
+    assert result["attempts"] == 1
+    assert result["error"] == "cancelled"
+
+
+def test_cancelled_copy_keeps_its_partial_file(tmp_path):
+    src = makeSource(Path(tmp_path,"src"))
+    destdir = Path(tmp_path,"net")
+    token = CancellationToken()
+    token.cancel()
+    result = TransferEngine(streams=1,retries=3).copyFile(src,destdir,token)
+    assert result["error"] == "cancelled"
+    partial, sidecar = TransferEngine.getPartialPaths(Path(destdir,src.name))
+    assert partial.exists() and sidecar.exists()
+    assert not Path(destdir,src.name).exists()
+    assert [r["error"] for r in TransferEngine(streams=2).transfer(destdir,[src,src],token)] == ["cancelled","cancelled"]
@@ -0,0 +1,86 @@
+import time
+from pathlib import Path
+from transfer.TransferEngine import TransferEngine
+from transfer.TransferQueue import TransferQueue
+
+
+def makeFiles(folder:Path, names:list)->list:
+    folder.mkdir(parents=True,exist_ok=True)
+    paths = []
+    for n in names:
+        p = Path(folder,n)
+        p.write_bytes(n.encode("utf-8")*100)
+        paths.append(p)
+    return paths
+
+
+def test_lane_is_busy_until_its_callback_has_run(tmp_path, config):
+    recorded = []
+    def slowrecord(result):
+        time.sleep(0.3)
+        recorded.append(Path(result["file"]).name)
+    queue = TransferQueue(Path(tmp_path,"default"),engine=TransferEngine(streams=2,checksum=False,retries=0))
+    queue.addLane("capture",Path(tmp_path,"net"),slowrecord)
+    queue.start()
+    try:
+        for p in makeFiles(Path(tmp_path,"src"),["IMG_0.CR2","IMG_1.CR2","IMG_2.CR2"]):
+            queue.submit(p,lane="capture")
+        assert queue.waitUntilEmpty(10,lane="capture")
+        assert sorted(recorded) == ["IMG_0.CR2","IMG_1.CR2","IMG_2.CR2"]
+    finally:
+        queue.stop()
+
+
+def test_files_are_copied_in_priority_order(tmp_path, config):
+    copied = []
+    queue = TransferQueue(Path(tmp_path,"net"),lambda r: copied.append(Path(r["file"]).name),
+                          TransferEngine(streams=1,checksum=False,retries=0))
+    #with 24 pictures to a ring, IMG_25 and IMG_30 are on the second ring, and the manifest goes before any picture.
+    for p in makeFiles(Path(tmp_path,"src"),["IMG_30.CR2","IMG_25.CR2","capture_manifest.json","IMG_1.CR2"]):
+        queue.submit(p)
+    queue.start()
+    try:
+        assert queue.waitUntilEmpty(10)
+        assert copied == ["capture_manifest.json","IMG_1.CR2","IMG_25.CR2","IMG_30.CR2"]
+    finally:
+        queue.stop()
+
+
+def test_lanes_take_turns(tmp_path, config):
+    copied = []
+    queue = TransferQueue(Path(tmp_path,"default"),engine=TransferEngine(streams=1,checksum=False,retries=0))
+    for name in ["one","two"]:
+        queue.addLane(name,Path(tmp_path,"net",name),lambda r, name=name: copied.append(name))
+    for p in makeFiles(Path(tmp_path,"src","one"),["IMG_0.CR2","IMG_1.CR2","IMG_2.CR2","IMG_3.CR2"]):
+        queue.submit(p,lane="one")
+    for p in makeFiles(Path(tmp_path,"src","two"),["IMG_0.CR2","IMG_1.CR2"]):
+        queue.submit(p,lane="two")
+    queue.start()
+    try:
+        assert queue.waitUntilEmpty(10)
+        assert copied == ["one","two","one","two","one","one"]
+        assert len(list(Path(tmp_path,"net","one").iterdir())) == 4
+    finally:
+        queue.stop()
+
+
+def test_wait_until_empty_times_out_and_watches_only_its_lane(tmp_path, config):
+    queue = TransferQueue(Path(tmp_path,"default"),engine=TransferEngine(streams=1,checksum=False,retries=0))
+    queue.addLane("waiting",Path(tmp_path,"net"))
+    queue.addLane("empty",Path(tmp_path,"net"))
+    queue.submit(makeFiles(Path(tmp_path,"src"),["IMG_0.CR2"])[0],lane="waiting")
+    #nothing copies until the queue is started.
+    assert not queue.waitUntilEmpty(0.2)
+    assert not queue.waitUntilEmpty(0.2,lane="waiting")
+    assert queue.waitUntilEmpty(0.2,lane="empty")
+    assert queue.getDepth() == 1
+    queue.start()
+    try:
+        assert queue.waitUntilEmpty(10)
+        assert queue.getDepth() == 0
+        assert queue.getStats()["completed"] == 1
+    finally:
+        queue.stop()
+    #a stopped queue never empties, so waiting on it returns straight away rather than hanging.
+    queue.submit(makeFiles(Path(tmp_path,"src"),["IMG_1.CR2"])[0],lane="waiting")
+    assert not queue.waitUntilEmpty()
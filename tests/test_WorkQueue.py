@@ -0,0 +1,72 @@
+import subprocess
+import sys
+import time
+from pathlib import Path
+from tasks.WorkQueue import DirectoryWorkQueue, _readJson
+
+
+def test_expired_lease_is_reclaimed_and_lost_by_its_worker(tmp_path, config):
+    queue = DirectoryWorkQueue(tmp_path,leaseseconds=0)
+    itemid = queue.submit("ConvertJPG",{"input":"a.cr2","output":"out"})
+    item, leasepath = queue.claim("worker-a")
+    assert item["id"] == itemid
+    assert queue.reclaimExpired() == 1
+    assert list(queue.leased.iterdir()) == []
+    assert _readJson(Path(queue.pending,f"{itemid}.json"))["attempts"] == 1
+    assert queue.renew(leasepath) is None
+    assert not queue.complete(leasepath,item,{"success":True})
+
+
+def test_lease_expiring_too_often_fails_the_item(tmp_path, config):
+    queue = DirectoryWorkQueue(tmp_path,leaseseconds=0)
+    itemid = queue.submit("ConvertJPG",{"input":"a.cr2","output":"out"})
+    for _ in range(DirectoryWorkQueue.MAX_ATTEMPTS):
+        queue.claim("worker-a")
+        queue.reclaimExpired()
+    assert queue.getResult(itemid)["success"] is False
+    assert list(queue.pending.iterdir()) == []
+
+
+def startWorkers(queuedir:Path, leaseseconds:int, count:int)->list:
+    script = Path(Path(__file__).parent,"workqueue_worker.py")
+    return [subprocess.Popen([sys.executable,str(script),str(queuedir),str(leaseseconds)]) for _ in range(count)]
+
+
+def test_workers_finish_every_item_once_when_one_is_killed(tmp_path, config):
+    queue = DirectoryWorkQueue(Path(tmp_path,"queue"),leaseseconds=2)
+    output = Path(tmp_path,"output")
+    log = Path(tmp_path,"log.txt")
+    names = {}
+    for i in range(8):
+        itemid = queue.submit("SlowItem",{"input":f"pic{i}","output":str(output),"log":str(log),"seconds":0.5})
+        names[itemid] = f"pic{i}"
+    workers = startWorkers(queue.queuedir,2,3)
+    victim = workers[0]
+    try:
+        #kill the first worker while it holds a lease, so that its item is only finished once its lease is reclaimed.
+        deadline = time.monotonic()+60
+        leases = []
+        while not leases:
+            assert time.monotonic() < deadline, "the worker never claimed anything"
+            leases = [p for p in queue.leased.glob("*.json") if f"-{victim.pid}-" in p.name]
+            time.sleep(0.01)
+        victim.kill()
+        victim.wait()
+        lost, _, _ = DirectoryWorkQueue._parseLease(leases[0].name)
+        reclaimed = 0
+        while len(list(queue.done.glob("*.json"))) < len(names):
+            assert time.monotonic() < deadline, "the items were never all done"
+            reclaimed += queue.reclaimExpired()
+            time.sleep(0.1)
+    finally:
+        for w in workers:
+            w.kill()
+            w.wait()
+    assert reclaimed == 1
+    assert _readJson(Path(queue.done,f"{lost}.json"))["attempts"] == 1
+    finished = [line.split()[1] for line in log.read_text().splitlines() if line.startswith("end ")]
+    assert sorted(finished) == sorted(names.values())
+    for itemid, name in names.items():
+        assert queue.getResult(itemid)["success"]
+        assert Path(output,f"{name}.out").exists()
+    assert list(queue.leased.iterdir()) == []
@@ -0,0 +1,30 @@
+from queue import Queue
+import photogrammetryPipeline
+from tasks.BaseTask import BaseTask
+from util.Cancellation import CancellationToken
+from util.ErrorCodeConsts import ErrorCodes
+
+
+class Noop(BaseTask):
+    resumable = False
+
+    def __repr__(self):
+        return "Test: Noop"
+
+
+def makeQueue()->Queue:
+    q = Queue()
+    q.put(Noop())
+    return q
+
+
+def test_halt_does_not_stop_later_builds(config):
+    photogrammetryPipeline.halt("Stopped before anything was running.")
+    assert photogrammetryPipeline.executeTaskQueue(makeQueue()) == (True, ErrorCodes.NONE)
+
+
+def test_cancelling_a_token_stops_only_its_build(config):
+    token = CancellationToken()
+    token.cancel("Stopped by the caller.")
+    assert photogrammetryPipeline.executeTaskQueue(makeQueue(), token=token) == (False, ErrorCodes.CANCELLED)
+    assert photogrammetryPipeline.executeTaskQueue(makeQueue()) == (True, ErrorCodes.NONE)
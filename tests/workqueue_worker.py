@@ -0,0 +1,44 @@
+"""Runs a work queue worker in its own process for test_WorkQueue, on a task that logs when it starts and finishes each item.
+
+usage: python workqueue_worker.py <queuedir> <leaseseconds>
+"""
+import os
+import sys
+import time
+from pathlib import Path
+from conftest import loadTemplateConfig
+from tasks.BaseTask import BaseTask
+from tasks.TaskRegistry import registerTask
+from tasks.WorkQueue import DirectoryWorkQueue, runWorker
+
+
+def logEvent(log:Path, event:str, name:str):
+    with open(log,'a',encoding="utf-8") as f:
+        f.write(f"{event} {name} {os.getpid()}\n")
+
+
+class SlowItem(BaseTask):
+    """Takes seconds to 'process' the input named in its arguments, and writes <input>.out to its output folder."""
+
+    def __init__(self, argdict:dict):
+        super().__init__()
+        self.input = argdict["input"]
+        self.output = Path(argdict["output"])
+        self.log = Path(argdict["log"])
+        self.seconds = argdict["seconds"]
+
+    def __repr__(self):
+        return "Test: SlowItem"
+
+    def execute(self):
+        logEvent(self.log,"start",self.input)
+        time.sleep(self.seconds)
+        Path(self.output,f"{self.input}.out").write_text(str(os.getpid()))
+        logEvent(self.log,"end",self.input)
+        return True
+
+
+if __name__=="__main__":
+    loadTemplateConfig()
+    registerTask("SlowItem","workqueue_worker","SlowItem")
+    runWorker(DirectoryWorkQueue(Path(sys.argv[1]),int(sys.argv[2])),idle=0.1)
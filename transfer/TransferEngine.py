@@ -0,0 +1,243 @@
+"""Copies pictures from the capture computer to the network drive, several at a time, so that a dropped connection can't leave a
+truncated file where the recipient will find it."""
+
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from util.Cancellation import CancellationToken
+from util.Configurator import Configurator
+from util.PipelineLogging import getLogger
+
+CHECKSUM_ALGORITHM = "blake2b"
+
+
+class TransferCancelled(Exception):
+    """Raised inside a copy when the transfer's cancellation token is cancelled. The partial file is kept so the copy can resume."""
+
+
+def newHasher():
+    return hashlib.blake2b(digest_size=20)
+
+def formatChecksum(hasher)->str:
+    return f"{CHECKSUM_ALGORITHM}:{hasher.hexdigest()}"
+
+def checksumFile(path:Path, chunksize:int=8*1024*1024)->str:
+    """Returns the checksum of a whole file in the form the transfer engine records in the manifest, e.g. blake2b:<hex>."""
+    hasher = newHasher()
+    with open(path,'rb') as f:
+        while True:
+            chunk = f.read(chunksize)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    return formatChecksum(hasher)
+
+
+class BandwidthLimiter():
+    """Paces writes from every copy stream so that together they stay under a byte rate. Use BandwidthLimiter.getLimiter(), which
+    reads transfer->max_mbps from config.json, so that all transfers in the process share one limit.
+
+    Parameters:
+    -----------
+    bytespersecond: the limit. 0 means no limit.
+    """
+    _instance = None
+    _instancelock = threading.Lock()
+
+    @staticmethod
+    def getLimiter():
+        with BandwidthLimiter._instancelock:
+            if BandwidthLimiter._instance is None:
+                mbps = float(Configurator.getConfig().getPropertyOrDefault("transfer","max_mbps",0))
+                BandwidthLimiter._instance = BandwidthLimiter(int(mbps*1024*1024))
+            return BandwidthLimiter._instance
+
+    def __init__(self, bytespersecond:int):
+        self.rate = bytespersecond
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def consume(self, nbytes:int, token:CancellationToken=None):
+        """Waits until nbytes more can be written without going over the limit."""
+        if self.rate <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            #a stream that was idle doesn't earn more than a second of credit.
+            start = max(self._next,now-1.0)
+            self._next = start+nbytes/self.rate
+            delay = self._next-now
+        if delay > 0:
+            if token is not None:
+                token.wait(delay)
+            else:
+                time.sleep(delay)
+
+
+class TransferEngine():
+    """Copies files into a folder, usually on the network drive, with several copy streams at once.
+
+    Each file is copied in large chunks to <name>.partial next to its destination and only renamed to its real name once every
+    byte is there, so the recipient's watcher never sees a truncated picture. A copy that fails, say because the SMB connection
+    dropped, is retried with exponential backoff, and picks up from the end of the partial file as long as the source hasn't
+    changed since, which a small <name>.partial.json file records. Optionally, a checksum of the source is computed as it
+    streams past, so it costs no extra read, and returned to be recorded in the manifest.
+
+    Settings come from config.json->transfer. Use TransferEngine.fromConfig() to build one.
+
+    Parameters:
+    -----------
+    streams: how many files are copied at once.
+    chunksize: bytes read and written at a time.
+    checksum: if true, compute a checksum of each file.
+    retries: how many times a failed copy is retried.
+    backoff: seconds before the first retry. Each retry waits twice as long as the one before, up to a minute.
+    limiter: an optional BandwidthLimiter shared by every stream.
+    """
+
+    def __init__(self, streams:int=4, chunksize:int=8*1024*1024, checksum:bool=True, retries:int=5, backoff:float=1.0,
+                 limiter:BandwidthLimiter=None):
+        self.streams = max(1,streams)
+        self.chunksize = max(64*1024,chunksize)
+        self.checksum = checksum
+        self.retries = max(0,retries)
+        self.backoff = backoff
+        self.limiter = limiter
+
+    @staticmethod
+    def fromConfig():
+        config = Configurator.getConfig()
+        return TransferEngine(int(config.getPropertyOrDefault("transfer","streams",4)),
+                              int(float(config.getPropertyOrDefault("transfer","chunk_mb",8))*1024*1024),
+                              bool(config.getPropertyOrDefault("transfer","checksum",True)),
+                              int(config.getPropertyOrDefault("transfer","retries",5)),
+                              float(config.getPropertyOrDefault("transfer","retry_backoff_s",1.0)),
+                              BandwidthLimiter.getLimiter())
+
+    @staticmethod
+    def getPartialPaths(dest:Path)->tuple:
+        return Path(dest.parent,f"{dest.name}.partial"), Path(dest.parent,f"{dest.name}.partial.json")
+
+    def _copyOnce(self, src:Path, dest:Path, token:CancellationToken)->tuple:
+        """Copies src to dest through a partial file, resuming an earlier attempt if its source is unchanged.
+
+        returns: checksum or None, bytes copied in this attempt.
+        """
+        partial, sidecar = TransferEngine.getPartialPaths(dest)
+        st = os.stat(src)
+        source = {"size":st.st_size,"mtime_ns":st.st_mtime_ns}
+        offset = 0
+        if partial.exists() and sidecar.exists():
+            try:
+                with open(sidecar,'r',encoding="utf-8") as f:
+                    if json.load(f) == source:
+                        offset = min(os.path.getsize(partial),st.st_size)
+            except (OSError, ValueError):
+                offset = 0
+        if offset == 0:
+            with open(sidecar,'w',encoding="utf-8") as f:
+                json.dump(source,f)
+        hasher = newHasher() if self.checksum else None
+        buffer = bytearray(self.chunksize)
+        view = memoryview(buffer)
+        copied = 0
+        with open(src,'rb') as fin:
+            if offset > 0:
+                getLogger(__name__).info("Resuming %s at %d of %d bytes.",src.name,offset,st.st_size)
+                if hasher is not None:
+                    #the bytes already sent are hashed from the local source rather than read back over the network.
+                    remaining = offset
+                    while remaining > 0:
+                        n = fin.readinto(view[:min(self.chunksize,remaining)])
+                        if n == 0:
+                            break
+                        hasher.update(view[:n])
+                        remaining -= n
+                else:
+                    fin.seek(offset)
+            with open(partial,'r+b' if offset > 0 else 'wb') as fout:
+                fout.seek(offset)
+                fout.truncate()
+                while True:
+                    if CancellationToken.check(token):
+                        raise TransferCancelled(str(src))
+                    n = fin.readinto(view)
+                    if n == 0:
+                        break
+                    fout.write(view[:n])
+                    if self.limiter is not None:
+                        self.limiter.consume(n,token)
+                    if hasher is not None:
+                        hasher.update(view[:n])
+                    copied += n
+                fout.flush()
+                os.fsync(fout.fileno())
+        if os.path.getsize(partial) != st.st_size or os.stat(src).st_mtime_ns != st.st_mtime_ns:
+            #the source changed under us, so start again from scratch next time.
+            os.remove(sidecar)
+            raise OSError(f"{src} changed while it was being copied.")
+        os.replace(partial,dest)
+        os.remove(sidecar)
+        return (formatChecksum(hasher) if hasher is not None else None), copied
+
+    def copyFile(self, src, destdir, token:CancellationToken=None)->dict:
+        """Copies one file into destdir, retrying with backoff.
+
+        returns: a dictionary with the keys file, ok, checksum, bytes, attempts, seconds and, if it succeeded, size, or if it
+        failed, error.
+        """
+        src = Path(src)
+        dest = Path(destdir,src.name)
+        os.makedirs(destdir,exist_ok=True)
+        start = time.perf_counter()
+        result = {"file":str(src),"ok":False,"checksum":None,"bytes":0,"attempts":0}
+        for attempt in range(self.retries+1):
+            result["attempts"] = attempt+1
+            try:
+                checksum, copied = self._copyOnce(src,dest,token)
+                result["ok"] = True
+                result["checksum"] = checksum
+                result["bytes"] += copied
+                break
+            except TransferCancelled:
+                result["error"] = "cancelled"
+                break
+            except OSError as e:
+                result["error"] = str(e)
+                if attempt == self.retries:
+                    getLogger(__name__).error("Giving up on %s after %d attempts: %s",src,attempt+1,e)
+                    break
+                delay = min(60.0,self.backoff*(2**attempt))*random.uniform(0.75,1.25)
+                getLogger(__name__).warning("Copying %s failed (%s), retrying in %.1fs.",src,e,delay)
+                if token is not None and token.wait(delay):
+                    result["error"] = "cancelled"
+                    break
+                if token is None:
+                    time.sleep(delay)
+        result["seconds"] = round(time.perf_counter()-start,3)
+        if result["ok"]:
+            result.pop("error",None)
+            result["size"] = os.path.getsize(dest)
+        return result
+
+    def transfer(self, destpath, filestocopy, token:CancellationToken=None)->list:
+        """Copies files into destpath, streams at a time, making destpath if it doesn't exist.
+
+        returns: a list of results from copyFile, in the same order as filestocopy.
+        """
+        os.makedirs(destpath,exist_ok=True)
+        files = list(filestocopy)
+        def copy(f):
+            if CancellationToken.check(token):
+                return {"file":str(f),"ok":False,"checksum":None,"bytes":0,"attempts":0,"error":"cancelled"}
+            getLogger(__name__).info("Transfering %s",f)
+            return self.copyFile(f,destpath,token)
+        if self.streams == 1 or len(files) <= 1:
+            return [copy(f) for f in files]
+        with ThreadPoolExecutor(max_workers=min(self.streams,len(files))) as pool:
+            return list(pool.map(copy,files))
@@ -0,0 +1,217 @@
+"""The sender's transfer path during a capture: files are copied to the network drive in priority order rather than in the
+order they arrived, at no more than a configured bandwidth, so that copying never competes with the capture software for the disk
+and the network."""
+
+import heapq
+import itertools
+import re
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from transfer.TransferEngine import TransferEngine
+from util.Cancellation import CancellationToken
+from util.Configurator import Configurator
+from util.PipelineLogging import getLogger
+
+PRIORITY_CONTROL = 0
+PRIORITY_FRAME = 1
+CONTROL_EXTENSIONS = [".TXT",".JSON",".JSONL"]
+
+
+def getTransferPriority(path)->tuple:
+    """Returns the sort key for a file: manifests and other control files first, then frames by camera ring and then by number, so
+    that each ring of the turntable arrives together. Ortery frames are numbered from zero, pics_per_revolution to a ring."""
+    path = Path(path)
+    if path.suffix.upper() in CONTROL_EXTENSIONS:
+        return (PRIORITY_CONTROL,0,0)
+    m = re.match(r"[a-zA-Z]*_*(\d+)$",path.stem)
+    if m is None:
+        return (PRIORITY_FRAME,1<<30,0)
+    filenum = int(m.group(1))
+    perring = int(Configurator.getConfig().getPropertyOrDefault("ortery","pics_per_revolution",24))
+    return (PRIORITY_FRAME,filenum//max(perring,1),filenum)
+
+
+class TransferLane():
+    """The files waiting in a TransferQueue for one capture, and where they go."""
+    def __init__(self, destpath:Path, oncomplete=None):
+        self.destpath = destpath
+        self.oncomplete = oncomplete
+        self.heap = []
+        self.inflight = 0
+
+
+class TransferQueue():
+    """A priority queue of files waiting to be copied to one folder, drained by transfer->streams copy workers through a
+    TransferEngine.
+
+    Several captures can share one queue, and so one set of copy streams, by each adding a lane with its own destination and
+    callback. Every lane keeps its own priority order, and the workers take from the lanes with files waiting in turn, so a capture
+    with a long backlog can't starve the others.
+
+    Parameters:
+    -----------
+    destpath: the folder to copy to, usually on the network drive.
+    oncomplete: an optional callable taking the TransferEngine result of each copy, called on the copy worker. The file counts as
+    in flight until it returns.
+    engine: the TransferEngine to copy with. Defaults to one built from config.json.
+    token: stops the queue. Copies in progress stop and keep their partial files so they can resume.
+    """
+
+    def __init__(self, destpath, oncomplete=None, engine:TransferEngine=None, token:CancellationToken=None):
+        self.destpath = Path(destpath)
+        self.oncomplete = oncomplete
+        self.engine = engine if engine is not None else TransferEngine.fromConfig()
+        self.token = token if token is not None else CancellationToken()
+        self._lanes = {None:TransferLane(self.destpath,oncomplete)}
+        self._turns = deque() #lanes with files waiting, in the order they get the next worker.
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._inflight = 0
+        self._threads = []
+        self.completed = 0
+        self.failed = 0
+        self.bytes = 0
+        self._recent = deque() #(time, bytes) of recent copies, for the rate.
+        self.reportinterval = float(Configurator.getConfig().getPropertyOrDefault("transfer","report_interval_s",10))
+
+    def start(self):
+        for i in range(self.engine.streams):
+            t = threading.Thread(target=self._worker,daemon=True,name=f"Transfer-{i}")
+            t.start()
+            self._threads.append(t)
+        t = threading.Thread(target=self._reporter,daemon=True,name="TransferReport")
+        t.start()
+        self._threads.append(t)
+
+    def stop(self):
+        self.token.cancel("Transfer queue stopped.")
+        with self._cond:
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+    def addLane(self, name:str, destpath, oncomplete=None):
+        """Adds a lane for a capture that copies to its own folder, with its own callback for finished copies."""
+        with self._cond:
+            self._lanes[name] = TransferLane(Path(destpath),oncomplete)
+
+    def removeLane(self, name:str):
+        """Removes a lane. Files still waiting in it are dropped."""
+        with self._cond:
+            lane = self._lanes.pop(name,None)
+            if name in self._turns:
+                self._turns.remove(name)
+            if lane is not None and lane.heap:
+                getLogger(__name__).warning("Dropped %d transfers for %s.",len(lane.heap),name)
+
+    def submit(self, path, priority:tuple=None, subdir:str="", source:str=None, lane:str=None):
+        """Queues a file to be copied.
+
+        Parameters:
+        -----------
+        path: the file.
+        priority: its place in the queue. Defaults to getTransferPriority.
+        subdir: an optional folder under destpath to copy it into.
+        source: for a file made from another picture, such as a mask, the name of that picture. Passed back in the result.
+        lane: the lane to queue it in, from addLane. Defaults to the queue's own.
+        """
+        key = priority if priority is not None else getTransferPriority(path)
+        with self._cond:
+            heapq.heappush(self._lanes[lane].heap,(key,next(self._seq),str(path),subdir,source))
+            if lane not in self._turns:
+                self._turns.append(lane)
+            self._cond.notify()
+
+    def getDepth(self, lane:str=...)->int:
+        """returns: the number of files waiting or being copied, in one lane if lane is given."""
+        with self._cond:
+            lanes = self._lanes.values() if lane is ... else [self._lanes[lane]] if lane in self._lanes else []
+            return sum(len(l.heap)+l.inflight for l in lanes)
+
+    def waitUntilEmpty(self, timeout:float=None, lane:str=...)->bool:
+        """Waits for every queued file, or every file in one lane if lane is given, to be copied.
+
+        returns: true if the queue emptied, false if it timed out or was stopped first.
+        """
+        deadline = None if timeout is None else time.monotonic()+timeout
+        with self._cond:
+            while self._isBusy(lane):
+                if self.token.isCancelled():
+                    return False
+                remaining = None if deadline is None else deadline-time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(0.5 if remaining is None else min(0.5,remaining))
+            return True
+
+    def getRate(self, window:float=5.0)->float:
+        """returns: MB/s copied over the last window seconds."""
+        now = time.monotonic()
+        with self._cond:
+            while self._recent and self._recent[0][0] < now-window:
+                self._recent.popleft()
+            total = sum(b for _,b in self._recent)
+        return total/window/(1024*1024)
+
+    def _isBusy(self, lane)->bool:
+        lanes = self._lanes.values() if lane is ... else [self._lanes[lane]] if lane in self._lanes else []
+        return any(l.heap or l.inflight for l in lanes)
+
+    def getStats(self)->dict:
+        with self._cond:
+            depth = sum(len(l.heap) for l in self._lanes.values())
+            inflight = self._inflight
+            stats = {"queued":depth,"in_flight":inflight,"completed":self.completed,"failed":self.failed,
+                     "mb":round(self.bytes/(1024*1024),1)}
+        stats["mb_per_s"] = round(self.getRate(),2)
+        return stats
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._turns and not self.token.isCancelled():
+                    self._cond.wait(0.5)
+                if self.token.isCancelled():
+                    return
+                name = self._turns.popleft()
+                lane = self._lanes[name]
+                _, _, path, subdir, source = heapq.heappop(lane.heap)
+                if lane.heap:
+                    self._turns.append(name)
+                self._inflight += 1
+                lane.inflight += 1
+            result = {"file":path,"ok":False,"bytes":0,"error":"not started"}
+            try:
+                try:
+                    result = self.engine.copyFile(path,Path(lane.destpath,subdir),self.token)
+                except Exception as e:
+                    result["error"] = str(e)
+                    getLogger(__name__).error("Could not transfer %s: %s",path,e)
+                result["subdir"] = subdir
+                result["source"] = source
+                #the file stays in flight until its callback has run, so that a capture waiting on its lane doesn't send its
+                #manifest before the last file has been added to it.
+                if lane.oncomplete is not None:
+                    try:
+                        lane.oncomplete(result)
+                    except Exception as e:
+                        getLogger(__name__).error("Handling the transfer of %s failed: %s",path,e)
+            finally:
+                with self._cond:
+                    self._inflight -= 1
+                    lane.inflight -= 1
+                    self.completed += 1 if result["ok"] else 0
+                    self.failed += 0 if result["ok"] else 1
+                    self.bytes += result["bytes"]
+                    self._recent.append((time.monotonic(),result["bytes"]))
+                    self._cond.notify_all()
+
+    def _reporter(self):
+        while not self.token.wait(self.reportinterval):
+            if self.getDepth() > 0:
+                s = self.getStats()
+                getLogger(__name__).info("Transfers: %d queued, %d in flight, %d done, %d failed, %.2f MB/s.",
+                                         s["queued"],s["in_flight"],s["completed"],s["failed"],s["mb_per_s"])
@@ -1,27 +1,39 @@
 """Scripts to be run on the computer controlling the photography rig, in order to facilitate transfer of photos to the computer
 which will be running the processing operations."""
 
-import shutil
 import os.path
+from transfer.TransferEngine import TransferEngine
+from util.PrunePlan import PrunePlan
 
 
-def transferToNetworkDirectory(destpath, filestocopy):
-    """Copies files to a directory specified and if it doesn't exist, make it.
+def transferToNetworkDirectory(destpath, filestocopy, token=None, checksums:dict=None):
+    """Copies files to a directory specified and if it doesn't exist, make it. The copy is done by the TransferEngine, with
+    the number of parallel streams, retries and checksumming set in config.json->transfer. Each file only appears under its own
+    name once it has been copied completely.
 
     Parameters:
     ----------
     destpath: Network directory to copy to.
     filestocopy: list of full paths of files to copy.
+    token: an optional CancellationToken. If it is cancelled, no more files are started, and files being copied stop, keeping
+    what they have copied so a later transfer can resume them.
+    checksums: an optional dictionary, which is filled in with the checksum of each file copied, keyed by file name, if checksums
+    are turned on.
 
-    returns: the path of on the network directory that it copied to.
+    returns: true if every file was copied, false if the transfer was stopped first or a file couldn't be copied.
     """
-    #transfer image files in directory to the networkdrive 
-    if not os.path.exists(os.path.join(destpath)):
-        os.mkdir(destpath)
-
-    for f in filestocopy:
-        print(f"Transfering {f}")
-        shutil.copy(f,destpath)
+    results = TransferEngine.fromConfig().transfer(destpath,filestocopy,token)
+    succeeded = True
+    for r in results:
+        if not r["ok"]:
+            succeeded = False
+            if r.get("error") == "cancelled":
+                print(f"Transfer to {destpath} stopped before {r['file']} was finished.")
+            else:
+                print(f"Could not transfer {r['file']}: {r.get('error')}")
+        elif checksums is not None and r["checksum"]:
+            checksums[os.path.basename(r["file"])] = r["checksum"]
+    return succeeded
 
     
 #removes pics from a set of pictures such that the desired number in the configuration file is reached.
@@ -30,8 +42,8 @@ def pruneOrteryPics(filestocopy, orteryconfig):
 
     The Ortery takes too many pictures for photogrammetry at certain angles, like 90 degrees, where only about 3 pics are needed. The number of pictures per
     ortery camera is specified in the config.json file under ortery->pics_per_cam.
-    This script takes the list of files to transfer to the network drive, and removes every Nth picture where N is the is the number of (
-    pictures per revolution-the number of deisred pictures/ pictures per revolution.
+    This script takes the list of files to transfer to the network drive, and removes the pictures that the PrunePlan for these settings
+    drops, the same ones the listen and send watcher leaves out.
     
     Parameters:
     -------------------------
@@ -39,19 +51,11 @@ def pruneOrteryPics(filestocopy, orteryconfig):
     orteryconfig: the dictionary of config.json under the key ortery
     """
 
-    picsperrevolution=orteryconfig["pics_per_revolution"]
-    desirednumbers=orteryconfig["pics_per_cam"]
-    expectedfiles = len(desirednumbers)*picsperrevolution
+    plan = PrunePlan(orteryconfig["pics_per_revolution"],orteryconfig["pics_per_cam"])
+    expectedfiles = len(plan.keep)
     if len(filestocopy)!=expectedfiles:
         print(f"Cannot prune: the expected number of files was {expectedfiles}, but there were really {len(filestocopy)} files in the folder.")
         return filestocopy
-    finallist = []
     print("Pruning pics according to specifications per camera in the config.json file.")
-    for i,k in enumerate(desirednumbers.keys()):
-        if desirednumbers[k]==0:
-            continue
-        fractiontoremove = (picsperrevolution-desirednumbers[k])/picsperrevolution
-        for j in range(0,picsperrevolution):
-            if (j*fractiontoremove)%1==0:
-                finallist.append(filestocopy[i*picsperrevolution+j])
-    return finallist
\ No newline at end of file
+    #the files are in the order they were taken, so a file's place in the list is its frame number.
+    return [f for i,f in enumerate(filestocopy) if plan.keepsFrame(i)]
@@ -0,0 +1,182 @@
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from util.Configurator import Configurator
+from util.Fingerprint import fingerprintFile, fingerprintParams
+from util.PipelineLogging import getLogger
+
+
+class ArtifactCache():
+    """A content addressed store of files produced by per-picture tasks, like converted JPGs and masks, so that the same
+    picture processed with the same settings is never processed twice, even in another project.
+
+    An artifact's key is made from a fast hash of the contents of the input file, the name of the task, and any parameters that
+    change the output, such as the threshold used for masking, so a picture copied into another project still hits. Artifacts
+    are stored as <cachedir>/<key[:2]>/<key><suffix> by hardlinking the output into the cache, falling back to a copy when the
+    cache is on another drive, and are handed back the same way. Tasks remove an output before they write it again, so a
+    rewritten output never changes the cached artifact.
+
+    The size of the cache is read from disk once and then kept as a running total, so trimming it after a batch doesn't walk
+    the cache again. Artifacts added by other processes sharing the cache are only counted the next time it is loaded.
+
+    Configured in config.json->cache:
+    use_artifact_cache -- turns the cache on. Off by default.
+    artifact_cache_dir -- where to keep artifacts. Defaults to ~/.aphoma/artifacts.
+    artifact_cache_max_gb -- the size above which the least recently used artifacts are removed. Defaults to 20.
+    """
+    _CACHE = None
+
+    def __init__(self):
+        config = Configurator.getConfig()
+        self.enabled = bool(config.getPropertyOrDefault("cache","use_artifact_cache",False))
+        self.cachedir = Path(config.getPropertyOrDefault("cache","artifact_cache_dir","") or Path(Path.home(),".aphoma","artifacts"))
+        self.maxbytes = int(float(config.getPropertyOrDefault("cache","artifact_cache_max_gb",20))*(1<<30))
+        self._lock = threading.Lock()
+        self._entries = None #artifact path -> size, least recently used first. Loaded on first use.
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def getCache():
+        if ArtifactCache._CACHE is None:
+            ArtifactCache._CACHE = ArtifactCache()
+        return ArtifactCache._CACHE
+
+    def getKey(self, inputpath:Path, taskname:str, params:dict=None)->str:
+        """Builds the cache key for the output of a task run on one input file. Also used to tell whether an output already on
+        disk was made from the same input and settings, so it is worked out whether or not the cache is turned on.
+
+        Parameters:
+        -----------
+        inputpath: the file the task reads.
+        taskname: the name of the task, so that different tasks on the same picture don't collide.
+        params: a json serializable dictionary of anything else that changes the output.
+
+        returns: a hex digest, or None if the input can't be read.
+        """
+        try:
+            fp = fingerprintFile(inputpath,True)
+        except OSError:
+            return None
+        return fingerprintParams([taskname,fp,params or {}])
+
+    def _artifactPath(self, key:str, suffix:str)->Path:
+        return Path(self.cachedir,key[:2],f"{key}{suffix}")
+
+    def _loadEntries(self):
+        """Reads the artifacts already in the cache, oldest first, and their total size. Called with the lock held."""
+        if self._entries is not None:
+            return
+        found = []
+        if self.cachedir.exists():
+            for root, _, files in os.walk(self.cachedir):
+                for f in files:
+                    p = Path(root,f)
+                    try:
+                        st = p.stat()
+                    except OSError:
+                        continue
+                    found.append((st.st_mtime,st.st_size,p))
+        found.sort()
+        self._entries = OrderedDict((p,size) for _,size,p in found)
+        self._size = sum(size for _,size,_ in found)
+
+    def fetch(self, key:str, dest:Path)->bool:
+        """Puts the artifact with this key at dest if the cache has it.
+
+        returns: true if dest now holds the cached artifact.
+        """
+        if not self.enabled or key is None:
+            return False
+        dest = Path(dest)
+        artifact = self._artifactPath(key,dest.suffix.lower())
+        if not artifact.exists():
+            with self._lock:
+                self.misses+=1
+            return False
+        try:
+            if dest.exists():
+                os.remove(dest)
+            try:
+                os.link(artifact,dest)
+            except OSError:
+                shutil.copyfile(artifact,dest)
+            os.utime(artifact)
+        except OSError as e:
+            getLogger(__name__).warning("Could not fetch %s from the artifact cache: %s",dest,e)
+            with self._lock:
+                self.misses+=1
+            return False
+        with self._lock:
+            self.hits+=1
+            if self._entries is not None and artifact in self._entries:
+                self._entries.move_to_end(artifact)
+        return True
+
+    def store(self, key:str, src:Path)->bool:
+        """Adds a file to the cache under key. The file is linked, or copied, under a temporary name and then renamed, so that a
+        half written artifact is never fetched.
+
+        returns: true if the artifact was stored.
+        """
+        if not self.enabled or key is None or not Path(src).exists():
+            return False
+        src = Path(src)
+        artifact = self._artifactPath(key,src.suffix.lower())
+        if artifact.exists():
+            return True
+        tmp = Path(artifact.parent,f".{artifact.name}.{uuid.uuid4().hex}.tmp")
+        try:
+            os.makedirs(artifact.parent,exist_ok=True)
+            try:
+                os.link(src,tmp)
+            except OSError:
+                shutil.copyfile(src,tmp)
+            os.replace(tmp,artifact)
+            size = artifact.stat().st_size
+        except OSError as e:
+            getLogger(__name__).warning("Could not add %s to the artifact cache: %s",src,e)
+            if tmp.exists():
+                os.remove(tmp)
+            return False
+        with self._lock:
+            self._loadEntries()
+            if artifact not in self._entries:
+                self._size+=size
+            self._entries[artifact] = size
+            self._entries.move_to_end(artifact)
+        return True
+
+    def getSize(self)->int:
+        """returns: the number of bytes the cache holds, as far as this process knows."""
+        with self._lock:
+            self._loadEntries()
+            return self._size
+
+    def trim(self):
+        """Removes the least recently used artifacts until the cache is under artifact_cache_max_gb. Cheap when it's already under."""
+        if not self.enabled or self.maxbytes <= 0:
+            return
+        removed = 0
+        with self._lock:
+            self._loadEntries()
+            while self._size > self.maxbytes and self._entries:
+                p, size = self._entries.popitem(last=False)
+                self._size-=size
+                try:
+                    os.remove(p)
+                    removed+=1
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    getLogger(__name__).warning("Could not remove %s from the artifact cache: %s",p,e)
+        if removed:
+            getLogger(__name__).info("Removed %s artifacts from the cache at %s",removed,self.cachedir)
+
+    def getStats(self)->dict:
+        with self._lock:
+            return {"hits":self.hits,"misses":self.misses}
@@ -0,0 +1,59 @@
+import threading
+
+
+class OperationCancelled(Exception):
+    """Raised by CancellationToken.raiseIfCancelled, and from inside Metashape progress callbacks, to unwind out of a
+    long running operation once a stop has been requested."""
+
+
+class CancellationToken():
+    """A flag that long running code checks so that a stop request takes effect quickly instead of at the next task boundary.
+
+    The code asking for the stop calls cancel(). Loops check isCancelled() or call raiseIfCancelled() between items, and code that
+    would otherwise sleep or wait on a subprocess calls wait(), which returns as soon as the token is cancelled. Each piece of
+    code that checks the token is responsible for leaving its outputs either finished or absent, so that a resumed build can
+    pick up where it stopped.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self.reason = None
+
+    def cancel(self, reason:str="Stop requested."):
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    def isCancelled(self)->bool:
+        return self._event.is_set()
+
+    def raiseIfCancelled(self):
+        if self._event.is_set():
+            raise OperationCancelled(self.reason)
+
+    def wait(self, timeout:float=None)->bool:
+        """Sleeps until the token is cancelled or the timeout runs out.
+
+        returns: true if the token was cancelled.
+        """
+        return self._event.wait(timeout)
+
+    def progressCallback(self, callback=None):
+        """Returns a function to pass as the progress argument of a Metashape operation. Metashape calls it periodically with
+        the percent complete, and raising an exception from it aborts the operation, so a stop request interrupts even a single
+        long call like optimizeCameras.
+
+        Parameters:
+        -----------
+        callback: an optional function that also wants the progress value.
+        """
+        def progress(value):
+            if callback is not None:
+                callback(value)
+            self.raiseIfCancelled()
+        return progress
+
+    @staticmethod
+    def check(token)->bool:
+        """Returns true if token is a cancelled token. Lets code that takes an optional token avoid checking for None."""
+        return token is not None and token.isCancelled()
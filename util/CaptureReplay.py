@@ -0,0 +1,351 @@
+"""Records a capture session, the names, sizes and arrival times of the pictures the Ortery writes, and replays it into a listen
+folder at 1x, 2x, 10x or any other speed, from the real pictures or from synthetic ones. The bench command replays a session into
+a recipient Watcher running in this process, with Metashape stubbed out so it runs on any Linux box, and reports how long each
+picture took from arriving to being processed and masked, how many pictures were waiting over time, and how long the build took
+to start after the manifest arrived. Run it from the repository root:
+
+    python -m util.CaptureReplay record D:/Ortery/capture session.jsonl
+    python -m util.CaptureReplay record D:/Photos/lastweek session.jsonl --from-mtimes
+    python -m util.CaptureReplay replay session.jsonl D:/listen --speed 2 --sourcedir D:/Photos/lastweek
+    python -m util.CaptureReplay bench session.jsonl --speed 10 --report bench.json
+
+Processing still needs the pipeline's image libraries. Synthetic pictures need pillow, and without it are random bytes, which
+only exercise the path up to processing."""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from util.Cancellation import CancellationToken
+from util.Configurator import Configurator
+from util.ErrorCodeConsts import ErrorCodes
+from util.PipelineLogging import getLogger
+
+PICTURE_EXTENSIONS = [".CR2",".JPG",".TIF"]
+
+
+class CaptureSession():
+    """The pictures of a capture in the order they arrived, each with its name, size and the seconds since the capture started,
+    and when the manifest arrived, if it did. Saved as one json record per line.
+
+    Parameters:
+    -----------
+    name: the name of the project.
+    files: a list of (seconds, name, size).
+    manifesttime: the seconds since the capture started when the manifest arrived, or None.
+    """
+
+    def __init__(self, name:str, files:list, manifesttime:float=None):
+        self.name = name
+        self.files = sorted(files)
+        self.manifesttime = manifesttime
+
+    def getDuration(self)->float:
+        last = self.files[-1][0] if self.files else 0.0
+        return max(last,self.manifesttime or 0.0)
+
+    def save(self, path):
+        with open(path,'w',encoding="utf-8") as f:
+            f.write(json.dumps({"type":"session","name":self.name,"count":len(self.files)})+"\n")
+            for t, name, size in self.files:
+                f.write(json.dumps({"type":"file","t":round(t,4),"name":name,"size":size})+"\n")
+            if self.manifesttime is not None:
+                f.write(json.dumps({"type":"manifest","t":round(self.manifesttime,4)})+"\n")
+
+    @staticmethod
+    def load(path):
+        name = Path(path).stem
+        files = []
+        manifesttime = None
+        with open(path,'r',encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if record["type"] == "session":
+                    name = record["name"]
+                elif record["type"] == "file":
+                    files.append((float(record["t"]),record["name"],int(record["size"])))
+                elif record["type"] == "manifest":
+                    manifesttime = float(record["t"])
+        return CaptureSession(name,files,manifesttime)
+
+    @staticmethod
+    def fromFolder(folder, name:str=None):
+        """Makes a session from the pictures already in a folder, using their modification times as their arrival times."""
+        files = []
+        with os.scandir(folder) as it:
+            for e in it:
+                if e.is_file() and os.path.splitext(e.name)[1].upper() in PICTURE_EXTENSIONS:
+                    st = e.stat()
+                    files.append((st.st_mtime,e.name,st.st_size))
+        start = min((t for t,_,_ in files),default=0.0)
+        return CaptureSession(name if name else Path(folder).name,[(t-start,n,s) for t,n,s in files])
+
+    @staticmethod
+    def record(folder, token:CancellationToken, interval:float=0.2, name:str=None):
+        """Records the pictures written to a folder, by listing it every interval seconds, until token is cancelled or a
+        _manifest.txt arrives. A picture counts as arrived once its size has stopped changing between two listings.
+
+        returns: the session.
+        """
+        start = time.monotonic()
+        sizes = {}
+        files = {}
+        manifesttime = None
+        while not token.isCancelled() and manifesttime is None:
+            now = time.monotonic()-start
+            with os.scandir(folder) as it:
+                for e in it:
+                    if not e.is_file() or e.name in files:
+                        continue
+                    if e.name.endswith("_manifest.txt"):
+                        manifesttime = now
+                        name = name if name else e.name[:-len("_manifest.txt")]
+                    elif os.path.splitext(e.name)[1].upper() in PICTURE_EXTENSIONS:
+                        size = e.stat().st_size
+                        if size > 0 and sizes.get(e.name) == size:
+                            files[e.name] = (now,e.name,size)
+                            getLogger(__name__).info("Recorded %s, %d bytes at %.2fs.",e.name,size,now)
+                        sizes[e.name] = size
+            token.wait(interval)
+        return CaptureSession(name if name else Path(folder).name,list(files.values()),manifesttime)
+
+    def replay(self, listendir, speed:float=1.0, sourcedir=None, synthetic:Path=None, token:CancellationToken=None,
+               onarrived=None, manifest:bool=True)->dict:
+        """Writes the session's pictures into a folder at the times they arrived, divided by speed, and then its manifest.
+
+        Parameters:
+        -----------
+        listendir: the folder to write to.
+        speed: how many times faster than the capture to replay it.
+        sourcedir: a folder with the real pictures. Pictures that aren't in it are synthetic.
+        synthetic: a picture to copy in place of pictures that aren't in sourcedir, under their names but with its extension.
+        If not given, they are random bytes of the recorded size.
+        token: stops the replay.
+        onarrived: an optional callable taking the path of each picture, and of the manifest, once it has been written.
+        manifest: if true, write a _manifest.txt listing the pictures after the last of them.
+
+        returns: a dictionary of the path of each file written to the time.perf_counter() it finished being written.
+        """
+        from util.buildManifest import Manifest
+        os.makedirs(listendir,exist_ok=True)
+        speed = max(speed,1e-3)
+        arrived = {}
+        sent = Manifest(self.name,0)
+        start = time.perf_counter()
+        def waituntil(t):
+            delay = start+t/speed-time.perf_counter()
+            if delay > 0:
+                if token is not None:
+                    token.wait(delay)
+                else:
+                    time.sleep(delay)
+        for t, name, size in self.files:
+            waituntil(t)
+            if CancellationToken.check(token):
+                return arrived
+            source = Path(sourcedir,name) if sourcedir else None
+            if source is not None and source.exists():
+                dest = Path(listendir,name)
+                shutil.copyfile(source,dest)
+            elif synthetic is not None:
+                dest = Path(listendir,f"{Path(name).stem}{Path(synthetic).suffix}")
+                shutil.copyfile(synthetic,dest)
+            else:
+                dest = Path(listendir,name)
+                with open(dest,'wb') as f:
+                    f.write(os.urandom(size))
+            arrived[str(dest)] = time.perf_counter()
+            sent.addFile(dest.name)
+            if onarrived is not None:
+                onarrived(str(dest))
+        if manifest:
+            waituntil(self.manifesttime if self.manifesttime is not None else self.getDuration())
+            if CancellationToken.check(token):
+                return arrived
+            manifestpath = str(sent.finalize(listendir))
+            arrived[manifestpath] = time.perf_counter()
+            if onarrived is not None:
+                onarrived(manifestpath)
+        return arrived
+
+
+def makeSyntheticPicture(path, width:int, height:int)->Path:
+    """Writes a noisy picture of the given size, in the format of path's extension, for sessions replayed without their pictures.
+
+    returns: path, or None if pillow isn't installed.
+    """
+    try:
+        import numpy as np
+        from PIL import Image
+    except ImportError:
+        getLogger(__name__).warning("Pillow isn't installed, so synthetic pictures are random bytes.")
+        return None
+    rng = np.random.default_rng(0)
+    #a smooth gradient under the noise, so masking has something to find.
+    y, x = np.mgrid[0:height,0:width]
+    base = ((x/width+y/height)*100).astype(np.uint8)[...,None]
+    pixels = np.clip(base+rng.integers(0,40,(height,width,3),dtype=np.uint8),0,255).astype(np.uint8)
+    Image.fromarray(pixels).save(path)
+    return Path(path)
+
+
+def _percentile(values:list, q:float)->float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered)-1,int(round(q*(len(ordered)-1))))]
+
+
+def runBenchmark(session:CaptureSession, workdir, speed:float=1.0, sourcedir=None, synthetic:Path=None, interval:float=0.5,
+                 timeout:float=600.0, buildseconds:float=0.0)->dict:
+    """Replays a session into a recipient Watcher running in this process and measures how it keeps up. The watcher's scratch,
+    project and state folders are moved under workdir for the run, and the build, the only part that needs Metashape, is
+    replaced by a stub that records when it was called.
+
+    Parameters:
+    -----------
+    session: the session to replay.
+    workdir: a folder for the listen, scratch and project folders of the run.
+    speed: how many times faster than the capture to replay it.
+    sourcedir: a folder with the real pictures.
+    synthetic: a picture to use in place of the ones that aren't in sourcedir.
+    interval: seconds between samples of the number of pictures waiting.
+    timeout: seconds to wait for the build to start after the replay finishes.
+    buildseconds: how long the stubbed build takes.
+
+    returns: a dictionary with the keys session, speed, files, processed, latency_ms (mean, p50, p95 and max from each picture
+    arriving to it being processed and masked), depth (a list of seconds, pictures waiting), max_depth, manifest_to_build_s and
+    seconds.
+    """
+    import photogrammetryPipeline
+    from photogrammetryWatchers import Watcher, WatcherRecipientHandler
+    config = Configurator.getConfig()
+    workdir = os.path.abspath(workdir)
+    listendir = os.path.join(workdir,"listen")
+    config.setProperty("watcher","temp_scratch",os.path.join(workdir,"scratch"))
+    config.setProperty("watcher","project_base",os.path.join(workdir,"projects"))
+    config.setProperty("watcher","state_file",os.path.join(workdir,"watcher_state.jsonl"))
+    if "buildqueue" in config.getSections():
+        config.setProperty("buildqueue","use_build_queue",False)
+    os.makedirs(listendir,exist_ok=True)
+    lock = threading.Lock()
+    arrived = {}
+    processed = {}
+    buildstarted = []
+    processimage = WatcherRecipientHandler.process_image_file
+    def timedprocess(eventpath):
+        processimage(eventpath)
+        with lock:
+            processed[str(eventpath)] = time.perf_counter()
+    def stubbedbuild(args, token=None):
+        buildstarted.append(time.perf_counter())
+        getLogger(__name__).info("Stubbed build of %s from %s.",args.projectname,args.sourcedir)
+        time.sleep(buildseconds)
+        return True, ErrorCodes.NONE
+    def onarrived(path):
+        with lock:
+            arrived[path] = time.perf_counter()
+    WatcherRecipientHandler.process_image_file = staticmethod(timedprocess)
+    buildmodel = photogrammetryPipeline.build_model_cmd
+    photogrammetryPipeline.build_model_cmd = stubbedbuild
+    watcher = Watcher(listendir,False)
+    thread = threading.Thread(target=watcher.run,daemon=True)
+    depth = []
+    start = time.perf_counter()
+    try:
+        thread.start()
+        replayer = threading.Thread(target=session.replay,args=(listendir,speed,sourcedir,synthetic,watcher.token,onarrived),
+                                    daemon=True)
+        replayer.start()
+        deadline = None
+        while not buildstarted:
+            with lock:
+                waiting = sum(1 for p in arrived if p not in processed and not p.endswith("_manifest.txt"))
+            depth.append((round(time.perf_counter()-start,3),waiting))
+            if not replayer.is_alive() and deadline is None:
+                deadline = time.monotonic()+timeout
+            if deadline is not None and time.monotonic() > deadline:
+                getLogger(__name__).warning("The build didn't start within %.0fs of the replay finishing.",timeout)
+                break
+            time.sleep(interval)
+    finally:
+        watcher.stop()
+        thread.join()
+        WatcherRecipientHandler.process_image_file = staticmethod(processimage)
+        photogrammetryPipeline.build_model_cmd = buildmodel
+    latencies = [(processed[p]-t)*1000 for p,t in arrived.items() if p in processed]
+    manifests = [t for p,t in arrived.items() if p.endswith("_manifest.txt")]
+    return {"session":session.name,
+            "speed":speed,
+            "files":len(session.files),
+            "processed":len(latencies),
+            "latency_ms":{"mean":round(statistics.fmean(latencies),1),"p50":round(_percentile(latencies,0.5),1),
+                          "p95":round(_percentile(latencies,0.95),1),"max":round(max(latencies),1)} if latencies else None,
+            "depth":depth,
+            "max_depth":max((d for _,d in depth),default=0),
+            "manifest_to_build_s":round(buildstarted[0]-manifests[0],3) if buildstarted and manifests else None,
+            "seconds":round(time.perf_counter()-start,3)}
+
+
+def main(argv=None)->int:
+    parser = argparse.ArgumentParser(prog="CaptureReplay",description="Record and replay capture sessions to benchmark the watcher.")
+    subparsers = parser.add_subparsers(dest="command",required=True)
+    recordparser = subparsers.add_parser("record",help="Record the pictures written to a folder until a manifest arrives or ctrl+c.")
+    recordparser.add_argument("folder",help="The folder the capture software writes to.")
+    recordparser.add_argument("session",help="The .jsonl file to save the session to.")
+    recordparser.add_argument("--from-mtimes",action="store_true",help="Make the session from the pictures already in the folder.")
+    recordparser.add_argument("--name",default="",help="The project name. Defaults to the manifest's or the folder's.")
+    for name, helptext in [("replay","Replay a session into a folder."),("bench","Replay a session into a watcher and measure it.")]:
+        p = subparsers.add_parser(name,help=helptext)
+        p.add_argument("session",help="A session saved by record.")
+        if name == "replay":
+            p.add_argument("listendir",help="The folder to replay into.")
+        else:
+            p.add_argument("--workdir",default="",help="Folder for the run's listen, scratch and project folders. Defaults to a temporary one.")
+            p.add_argument("--report",default="",help="Optional json file to write the results to.")
+            p.add_argument("--timeout",type=float,default=600.0,help="Seconds to wait for the build after the replay.")
+            p.add_argument("--build-seconds",type=float,default=0.0,help="How long the stubbed build takes.")
+        p.add_argument("--speed",type=float,default=1.0,help="How many times faster than the capture to replay it.")
+        p.add_argument("--sourcedir",default="",help="Folder with the session's real pictures.")
+        p.add_argument("--synthetic",default="1600x1200.jpg",help="Size and type of synthetic pictures, e.g. 6000x4000.tif.")
+    args = parser.parse_args(argv)
+    if args.command == "record":
+        if args.from_mtimes:
+            session = CaptureSession.fromFolder(args.folder,args.name)
+        else:
+            token = CancellationToken()
+            print("Recording. Press ctrl+c to stop.")
+            try:
+                session = CaptureSession.record(args.folder,token,name=args.name)
+            except KeyboardInterrupt:
+                return 1
+        session.save(args.session)
+        print(f"Recorded {len(session.files)} pictures over {session.getDuration():.1f}s.")
+        return 0
+    session = CaptureSession.load(args.session)
+    workdir = args.workdir if getattr(args,"workdir","") else tempfile.mkdtemp(prefix="capturereplay")
+    size, ext = os.path.splitext(args.synthetic)
+    width, height = (int(v) for v in size.split("x"))
+    synthetic = makeSyntheticPicture(os.path.join(workdir,f"synthetic{ext}"),width,height)
+    if args.command == "replay":
+        arrived = session.replay(args.listendir,args.speed,args.sourcedir,synthetic)
+        print(f"Replayed {len(arrived)} files.")
+        return 0
+    report = runBenchmark(session,workdir,args.speed,args.sourcedir,synthetic,timeout=args.timeout,buildseconds=args.build_seconds)
+    if args.report:
+        with open(args.report,'w',encoding="utf-8") as f:
+            json.dump(report,f,indent=1)
+    print(f"{report['session']} at {report['speed']}x: {report['processed']} of {report['files']} pictures processed in "
+          f"{report['seconds']:.1f}s, at most {report['max_depth']} waiting.")
+    if report["latency_ms"]:
+        print("Arrival to processed and masked: mean {mean} ms, p50 {p50} ms, p95 {p95} ms, max {max} ms".format(**report["latency_ms"]))
+    print(f"Manifest to build start: {report['manifest_to_build_s']}s")
+    return 0 if report["manifest_to_build_s"] is not None else 1
+
+if __name__=="__main__":
+    sys.exit(main())
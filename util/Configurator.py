@@ -31,6 +31,14 @@ class Configurator():
         except KeyError as ke:
             getLogger(__name__).error(ke)
             return None
+    def getPropertyOrDefault(self,section,keyname,default=None):
+        """Like getProperty, but returns default without logging an error when the section or key isn't in config.json.
+        Used for settings that older config files may not have."""
+        try:
+            val = self._config[section][keyname]
+        except KeyError:
+            return default
+        return default if val is None or val == "" else val
     def revertToTemplate(self):
         self._cfgfile = self.loadFrom(self._template)
     
@@ -23,6 +23,7 @@ class ErrorCodes(Enum):
     BBOX_SIZE_MISMATCH = 18
     REPLACE_IMAGES_FAILURE=19
     FAILURE_TO_REMOVE_FILE = 20
+    CANCELLED = 21
 
     @classmethod
     def getFriendlyStrings(cls):
@@ -46,7 +47,8 @@ class ErrorCodes(Enum):
                 "Invalid chunk specified for multichunk operation.",
                 "Bounding box size mismatch.",
                 "Failure to replace images in chunk.",
-                "Failure to remove file or folder."]
+                "Failure to remove file or folder.",
+                "Stopped before finishing."]
     @classmethod
     def numToFriendlyString(cls, num): 
         if isinstance(num, ErrorCodes):
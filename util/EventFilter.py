@@ -0,0 +1,70 @@
+import os
+import threading
+import time
+from util.Configurator import Configurator
+
+#suffixes of files the pipeline writes while it is still working on them, which are renamed into place when they're finished.
+WORKING_SUFFIXES = [".partial",".partial.json",".tmp"]
+
+
+def getPipelineOwnedPaths()->list:
+    """Returns the folders the pipeline writes its own output to, from config.json: the scratch folder, the project folders, the
+    droplet output, the work queue and the artifact cache. Any of them can end up inside a watched folder."""
+    config = Configurator.getConfig()
+    paths = [config.getPropertyOrDefault("watcher","temp_scratch",""),
+             config.getPropertyOrDefault("watcher","project_base",""),
+             config.getPropertyOrDefault("processing","Droplet_Output",""),
+             config.getPropertyOrDefault("workqueue","queue_dir",""),
+             config.getPropertyOrDefault("cache","artifact_cache_dir","")]
+    return [p for p in paths if p]
+
+
+class EventFilter():
+    """Decides which filesystem events a watcher acts on. Events for files under folders the pipeline writes to itself, and for
+    files it is still writing, are dropped, and repeated events for the same file within window seconds of each other, which some
+    SMB servers send several of for a single write, are coalesced into the first. A file that really is written again within the
+    window is picked up by the watcher's next reconciliation.
+
+    Parameters:
+    -----------
+    ignored: a list of folders whose files are ignored. Defaults to getPipelineOwnedPaths().
+    window: seconds within which repeated events for a file are coalesced.
+    """
+
+    def __init__(self, ignored:list=None, window:float=2.0):
+        roots = ignored if ignored is not None else getPipelineOwnedPaths()
+        self.ignored = [os.path.normcase(os.path.abspath(r)) for r in roots]
+        self.window = window
+        self._lock = threading.Lock()
+        self._seen = {} #path -> time of the last event acted on.
+        self._lastpurge = time.monotonic()
+        self.dropped = 0
+
+    @staticmethod
+    def fromConfig():
+        return EventFilter(window=float(Configurator.getConfig().getPropertyOrDefault("watcher","coalesce_window_s",2.0)))
+
+    def isOwned(self, path)->bool:
+        """returns: true if the file is in a folder the pipeline writes to, or is one the pipeline is still writing."""
+        path = os.path.normcase(os.path.abspath(path))
+        if any(path.endswith(s) for s in WORKING_SUFFIXES):
+            return True
+        return any(path == root or path.startswith(root+os.sep) for root in self.ignored)
+
+    def accept(self, path)->bool:
+        """returns: true if the watcher should act on an event for this file, false if it should be dropped."""
+        if self.isOwned(path):
+            self.dropped += 1
+            return False
+        key = os.path.normcase(os.path.abspath(path))
+        now = time.monotonic()
+        with self._lock:
+            if now-self._lastpurge > self.window*10:
+                self._seen = {k:t for k,t in self._seen.items() if now-t < self.window}
+                self._lastpurge = now
+            last = self._seen.get(key)
+            if last is not None and now-last < self.window:
+                self.dropped += 1
+                return False
+            self._seen[key] = now
+        return True
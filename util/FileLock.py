@@ -0,0 +1,112 @@
+import os
+import socket
+import time
+import uuid
+from pathlib import Path
+
+
+class FileLockTimeout(Exception):
+    """Raised when a FileLock can't be acquired in time."""
+
+
+class FileLock():
+    """A lock shared between processes, and between machines on a network drive, made by exclusively creating a lock file.
+    A lock file older than stale seconds is assumed to have been left behind by a process that died, and is broken. It is broken by
+    renaming it to a name of our own first, so that two processes breaking the same stale lock can't delete a fresh one that
+    a third process made in between. The lock file holds the host, pid and a token unique to this lock, and release only removes
+    it if it still holds them.
+
+    Use it as a context manager:
+        with FileLock(Path(queuedir,"queue.lock")):
+            ...
+
+    Parameters:
+    -----------
+    path: the lock file.
+    timeout: how long to wait for the lock, in seconds, before raising FileLockTimeout.
+    stale: how old, in seconds, a lock file has to be before it's broken.
+    """
+
+    def __init__(self, path:Path, timeout:float=30.0, stale:float=60.0):
+        self.path = Path(path)
+        self.timeout = timeout
+        self.stale = stale
+        self._held = False
+        self._owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}"
+
+    def acquire(self):
+        deadline = time.monotonic()+self.timeout
+        #the folder the lock protects may not have been made yet, e.g. the build queue's on a new machine.
+        os.makedirs(self.path.parent,exist_ok=True)
+        while True:
+            try:
+                fd = os.open(self.path,os.O_CREAT|os.O_EXCL|os.O_WRONLY)
+                with os.fdopen(fd,'w',encoding="utf-8") as f:
+                    f.write(self._owner)
+                self._held = True
+                return
+            except FileExistsError:
+                if self._breakStale():
+                    continue
+            if time.monotonic() > deadline:
+                raise FileLockTimeout(f"Timed out waiting for {self.path}")
+            time.sleep(0.05)
+
+    def _readOwner(self, path:Path)->str:
+        try:
+            with open(path,'r',encoding="utf-8") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _breakStale(self)->bool:
+        """Breaks the lock file if it's stale.
+
+        returns: true if the lock file was broken, or had gone already, so it's worth trying to make it again straight away.
+        """
+        try:
+            if time.time()-os.path.getmtime(self.path) <= self.stale:
+                return False
+        except OSError:
+            return True #someone else released or broke it in the meantime.
+        owner = self._readOwner(self.path)
+        breaking = Path(self.path.parent,f".{self.path.name}.breaking-{uuid.uuid4().hex}")
+        try:
+            os.rename(self.path,breaking)
+        except OSError:
+            return True
+        #between the check and the rename another process may have broken the stale lock and taken a fresh one, in which case
+        #the file we got isn't the one we looked at and goes back where it was.
+        try:
+            stale = time.time()-os.path.getmtime(breaking) > self.stale and self._readOwner(breaking) == owner
+        except OSError:
+            stale = False
+        if not stale:
+            try:
+                os.link(breaking,self.path)
+            except OSError:
+                pass
+        try:
+            os.remove(breaking)
+        except OSError:
+            pass
+        return stale
+
+    def release(self):
+        if self._held:
+            self._held = False
+            #if the lock was broken as stale while it was held, the file there now belongs to someone else.
+            if self._readOwner(self.path) != self._owner:
+                return
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
@@ -0,0 +1,145 @@
+import os
+import threading
+import time
+from queue import Queue
+from util.Cancellation import CancellationToken
+from util.PipelineLogging import getLogger
+
+
+class FileStabilityTracker():
+    """Works out when files that are being written into a watched folder are finished, so that the watcher can act on them.
+
+    The watcher's event handler calls track() for every file that is created or moved into the folder, and closed() when the
+    filesystem reports that a writer closed the file (watchdog sends these on linux, via inotify's close-write). A single timer thread
+    checks the size and modification time of every pending file at once: a file is ready once they haven't changed for settle
+    seconds, or, if a close-write was seen, as soon as they haven't changed since the close. Ready files are passed to onready
+    or, if there isn't one, put on the ready queue for the watcher's workers to pick up. No thread ever sleeps on a single file, so the time from a file
+    finishing to it being ready doesn't grow with the number of files in flight.
+
+    A file counts towards getPendingCount from the moment it is tracked until onready returns or, for files put on the ready queue,
+    until the worker that took it calls ready.task_done(), so code waiting for the tracker to empty never sees a file that is
+    between the tracker and whatever it was handed to as finished.
+
+    Parameters:
+    -----------
+    onready: an optional callable taking the path of a file that is ready. It's called on the tracker's thread, so it should be quick.
+    settle: how long, in seconds, a file's size and modification time have to stay the same before it's ready.
+    interval: how often, in seconds, pending files are checked.
+    token: stops the tracker.
+    """
+
+    def __init__(self, onready=None, settle:float=0.5, interval:float=0.1, token:CancellationToken=None):
+        self.onready = onready
+        self.settle = settle
+        self.interval = interval
+        self.token = token if token is not None else CancellationToken()
+        self.ready = Queue()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pending = {} #path -> [stat, time of last change, stat at close or None]
+        self._inflight = 0 #files that are ready but haven't been handed on yet.
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run,daemon=True,name="FileStabilityTracker")
+            self._thread.start()
+
+    def stop(self):
+        self.token.cancel("File stability tracker stopped.")
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    @staticmethod
+    def _stat(path:str)->tuple:
+        try:
+            st = os.stat(path)
+            return st.st_size, st.st_mtime_ns
+        except OSError:
+            return None
+
+    def track(self, path:str):
+        """Starts watching a file, or notes that a file that is already being watched changed."""
+        path = str(path)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._pending.get(path)
+            if entry is None:
+                self._pending[path] = [FileStabilityTracker._stat(path),now,None]
+            else:
+                entry[1] = now
+                entry[2] = None
+        self._wake.set()
+
+    def closed(self, path:str):
+        """Notes that a writer closed a file. If the file is being tracked, it's ready at the next check unless it changes again.
+        Files that aren't being tracked, because they were already handed on, are ignored."""
+        path = str(path)
+        stat = FileStabilityTracker._stat(path)
+        with self._lock:
+            entry = self._pending.get(path)
+            if entry is None:
+                return
+            entry[2] = stat
+        self._wake.set()
+
+    def getPendingCount(self)->int:
+        """returns: the number of files being watched, being handed on, or waiting on the ready queue or in a worker that took
+        them off it."""
+        with self._lock:
+            count = len(self._pending)+self._inflight
+        with self.ready.all_tasks_done:
+            return count+self.ready.unfinished_tasks
+
+    def _check(self):
+        now = time.monotonic()
+        readypaths = []
+        with self._lock:
+            paths = list(self._pending.keys())
+        for path in paths:
+            stat = FileStabilityTracker._stat(path)
+            with self._lock:
+                entry = self._pending.get(path)
+                if entry is None:
+                    continue
+                if stat is None:
+                    #deleted or renamed away before it was finished.
+                    del self._pending[path]
+                    continue
+                if stat != entry[0]:
+                    entry[0] = stat
+                    entry[1] = now
+                    if entry[2] is not None and entry[2] != stat:
+                        entry[2] = None
+                    if entry[2] is None:
+                        continue
+                isready = stat[0] > 0 and (entry[2] == stat or now-entry[1] >= self.settle)
+                if isready:
+                    del self._pending[path]
+                    self._inflight+=1
+                    readypaths.append(path)
+        for path in readypaths:
+            getLogger(__name__).debug("%s is ready.",path)
+            try:
+                if self.onready is None:
+                    self.ready.put(path)
+                else:
+                    self.onready(path)
+            except Exception as e:
+                getLogger(__name__).error("Handling %s failed: %s",path,e)
+            finally:
+                with self._lock:
+                    self._inflight-=1
+
+    def _run(self):
+        while not self.token.isCancelled():
+            with self._lock:
+                idle = len(self._pending) == 0
+            if idle:
+                #nothing to check, so sleep until a file arrives.
+                self._wake.wait(1)
+                self._wake.clear()
+                continue
+            self._check()
+            self.token.wait(self.interval)
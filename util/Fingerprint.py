@@ -0,0 +1,109 @@
+"""Functions for cheaply telling whether a set of files has changed, based on their names, sizes and modification times."""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+
+def _statEntry(path:Path)->list:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return [str(path),None,None]
+    return [str(path),st.st_size,st.st_mtime_ns]
+
+def fingerprintPaths(paths:list)->str:
+    """Fingerprints a list of files and directories. Directories are walked, so a file added to, removed from, or changed
+    in a directory changes the fingerprint of that directory.
+
+    Parameters:
+    -----------
+    paths: a list of paths to files or directories. Paths that don't exist are recorded as missing.
+
+    returns: a hex digest.
+    """
+    entries = []
+    for p in sorted(str(p) for p in paths):
+        p = Path(p)
+        if p.is_dir():
+            for root, dirs, files in os.walk(p):
+                dirs.sort()
+                for f in sorted(files):
+                    entries.append(_statEntry(Path(root,f)))
+        else:
+            entries.append(_statEntry(p))
+    return hashlib.sha1(json.dumps(entries).encode("utf-8")).hexdigest()
+
+def contentHash(path:Path, samplesize:int=1<<20)->str:
+    """A fast hash of a file's contents. Files larger than three samples are hashed from a sample at the start, middle and end
+    of the file plus the file size, which is enough to tell camera frames apart without reading 30MB per file.
+
+    Parameters:
+    -----------
+    path: the file to hash.
+    samplesize: the number of bytes in each sample.
+
+    returns: a hex digest.
+    """
+    size = os.path.getsize(path)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(size).encode("utf-8"))
+    with open(path,'rb') as f:
+        if size <= samplesize*3:
+            h.update(f.read())
+        else:
+            for offset in (0,size//2,size-samplesize):
+                f.seek(offset)
+                h.update(f.read(samplesize))
+    return h.hexdigest()
+
+def fingerprintFile(path:Path, usecontenthash:bool=False)->list:
+    """Fingerprints a single file by size and modification time, or by size and a fast content hash. The content hash
+    survives the file being copied to another folder or machine, which changes its mtime.
+
+    returns: a list which can be serialized to json or passed to fingerprintParams.
+    """
+    st = os.stat(path)
+    if usecontenthash:
+        return [st.st_size,contentHash(path)]
+    return [st.st_size,st.st_mtime_ns]
+
+def fingerprintParams(params)->str:
+    """Fingerprints a json serializable structure of parameters. Values that are not json serializable, like Paths or
+    Enums, are turned into strings.
+
+    returns: a hex digest.
+    """
+    return hashlib.sha1(json.dumps(params,sort_keys=True,default=str).encode("utf-8")).hexdigest()
+
+def getStampPath(output:Path)->Path:
+    """returns: the hidden file next to an output that records the fingerprint of what made it."""
+    output = Path(output)
+    return Path(output.parent,f".{output.name}.fingerprint")
+
+def readStamp(output:Path)->str:
+    """returns: the fingerprint recorded for an output by writeStamp, or None if the output or its record is missing."""
+    output = Path(output)
+    if not output.exists():
+        return None
+    try:
+        return getStampPath(output).read_text(encoding="utf-8").strip()
+    except OSError:
+        return None
+
+def writeStamp(output:Path, key:str):
+    """Records the fingerprint of the inputs and settings an output was made from, so that it can be told apart from one made
+    from a different file of the same name or with different settings."""
+    stamp = getStampPath(output)
+    tmp = Path(stamp.parent,f"{stamp.name}.tmp")
+    tmp.write_text(key,encoding="utf-8")
+    os.replace(tmp,stamp)
+
+def clearStamp(output:Path):
+    """Removes an output and the fingerprint recorded for it."""
+    for p in (Path(output),getStampPath(output)):
+        try:
+            os.remove(p)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,86 @@
+"""Measures how long the pipeline's entry points take to import, using python's -X importtime, and checks that none of them
+pull in the heavy SDKs that tasks.TaskRegistry is meant to load lazily. Run it from the repository root after changing imports:
+
+    python util/ImportBenchmark.py
+    python util/ImportBenchmark.py photogrammetryScripts --budget-ms 400
+
+It exits with 1 if a module imports one of the lazily loaded SDKs or goes over its budget, and with 2 if a module can't be
+imported at all."""
+import argparse
+import subprocess
+import sys
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).parent.parent.absolute()
+DEFAULT_MODULES = ["photogrammetryScripts","photogrammetryPipeline","tasks.TaskRegistry"]
+#packages that should only load once a task, or a watcher, that needs them is created.
+LAZY_PACKAGES = ["Metashape","inference_sdk","rawpy","lensfunpy","cv2","watchdog"]
+
+def measureImportTime(modulename:str)->tuple:
+    """Imports a module in a fresh interpreter with -X importtime.
+
+    Parameters:
+    -----------
+    modulename: the dotted name of the module to import.
+
+    returns: returncode, entries, stderr where entries is a list of (selfus, cumulativeus, depth, name) in the order python reported them.
+    """
+    proc = subprocess.run([sys.executable,"-X","importtime","-c",f"import {modulename}"],
+                          cwd=REPO_ROOT,capture_output=True,text=True,check=False)
+    entries = []
+    errors = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:"):
+            errors.append(line)
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue #the header line
+        name = fields[2].rstrip()
+        depth = (len(name)-len(name.lstrip()))//2
+        entries.append((int(fields[0]),int(fields[1]),depth,name.strip()))
+    return proc.returncode, entries, "\n".join(errors)
+
+def summarize(modulename:str, entries:list, top:int)->dict:
+    """Works out the total import time of a module, its slowest imports, and any lazily loaded packages it pulled in.
+
+    returns: a dictionary with the keys module, total_ms, slowest and lazy_loaded.
+    """
+    total = 0
+    for _, cumulative, _, name in entries:
+        if name == modulename:
+            total = cumulative
+    slowest = sorted(entries,key=lambda e:e[0],reverse=True)[:top]
+    lazyloaded = sorted({name.split(".")[0] for _,_,_,name in entries if name.split(".")[0] in LAZY_PACKAGES})
+    return {"module":modulename,
+            "total_ms":total/1000.0,
+            "slowest":[(name,selfus/1000.0) for selfus,_,_,name in slowest],
+            "lazy_loaded":lazyloaded}
+
+def main(argv=None)->int:
+    parser = argparse.ArgumentParser(prog="ImportBenchmark",description="Summarize python -X importtime for the pipeline entry points.")
+    parser.add_argument("modules",nargs="*",default=DEFAULT_MODULES,help="Modules to import. Defaults to the command line entry points.")
+    parser.add_argument("--budget-ms",type=float,default=0.0,help="Fail if any module takes longer than this to import. 0 for no budget.")
+    parser.add_argument("--top",type=int,default=10,help="How many of the slowest imports to list for each module.")
+    args = parser.parse_args(argv)
+    status = 0
+    for modulename in args.modules:
+        returncode, entries, errors = measureImportTime(modulename)
+        if returncode != 0:
+            print(f"{modulename}: could not be imported.\n{errors}")
+            status = max(status,2)
+            continue
+        summary = summarize(modulename,entries,args.top)
+        print(f"{modulename}: {summary['total_ms']:.1f} ms")
+        for name, ms in summary["slowest"]:
+            print(f"    {ms:8.1f} ms  {name}")
+        if summary["lazy_loaded"]:
+            print(f"    FAIL: imports {', '.join(summary['lazy_loaded'])} at load time.")
+            status = max(status,1)
+        if args.budget_ms > 0 and summary["total_ms"] > args.budget_ms:
+            print(f"    FAIL: over the budget of {args.budget_ms:.1f} ms.")
+            status = max(status,1)
+    return status
+
+if __name__=="__main__":
+    sys.exit(main())
@@ -1,9 +1,14 @@
 from enum import Enum
+from collections import deque
 from datetime import datetime,timedelta
+import contextlib
+import contextvars
 import functools
+import itertools
+import threading
+import time
 from util import PipelineLogging
-
-from uuid import uuid4
+from util.Configurator import Configurator
 
 class Statistic_Event_Types(Enum):
     EVENT_TAKE_PHOTO = 0
@@ -25,61 +30,119 @@ class Statistic_Event_Types(Enum):
                                 "Align Chunks",
                                 "Build Orthomosaic"]
         return pretty_event_strings[value]
-    
+
     @classmethod
     def getIteratable(cls):
         return[cls.EVENT_TAKE_PHOTO,cls.EVENT_CONVERT_PHOTO,cls.EVENT_BUILD_MASK,cls.EVENT_BUILD_MODEL,cls.EVENT_SNAPSHOT,cls.EVENT_ALIGN_CHUNKS,cls.EVENT_BUILD_ORTHOMOSAIC]
 
 
+#span ids are unique for the life of the process, so a span left current by a destroyed InstrumentationStatistics can't be
+#mistaken for one of the next.
+_SPAN_IDS = itertools.count(1)
+#the span that spans started on this thread, or in this asyncio task, nest under.
+_CURRENT_SPAN = contextvars.ContextVar("current_span",default=None)
+
+def currentSpan()->int:
+    """returns: the id of the span that new spans nest under, or None."""
+    return _CURRENT_SPAN.get()
+
+def propagateSpan(func):
+    """Wraps func so that, when it is called on another thread, such as a worker of a thread pool, the spans it starts nest under
+    the span that is current where propagateSpan was called."""
+    parent = _CURRENT_SPAN.get()
+    @functools.wraps(func)
+    def run(*args,**kwargs):
+        token = _CURRENT_SPAN.set(parent)
+        try:
+            return func(*args,**kwargs)
+        finally:
+            _CURRENT_SPAN.reset(token)
+    return run
+
 
 class Statistics_Timed_Event():
-    def __init__(self, type:Statistic_Event_Types):
-        self._start =0
-        self._end = 0
+    """One timed span. Times are time.perf_counter_ns() readings, so they aren't thrown off when the wall clock is changed.
+
+    Parameters:
+    -----------
+    type: the Statistic_Event_Types of the span, or None for a span, such as a task, that only groups others.
+    parent: the id of the span this one nests under, or None.
+    name: an optional name, e.g. of the task or picture.
+    startns: when it started. Defaults to now.
+    """
+    __slots__ = ("id","parent","type","name","startns","endns")
+
+    def __init__(self, type:Statistic_Event_Types, parent:int=None, name:str=None, startns:int=None):
+        self.id = next(_SPAN_IDS)
+        self.parent = parent
         self.type = type
-        self.id = uuid4()
-        self.start()
-
-    def start(self,t:datetime=None):
-        if not t:
-            self._start = datetime.now()
-        else:
-            self._start = t
-    def end(self,t:datetime=None):
-        if t is None:
-            self._end = datetime.now()
-        else:
-            self._end = t
+        self.name = name
+        self.startns = startns if startns is not None else time.perf_counter_ns()
+        self.endns = None
+
     def isCompleted(self):
-        return self._start and self._end
-    def getDuration(self):
-        return self._end-self._start
+        return self.endns is not None
+
+    def getDurationNs(self)->int:
+        return self.endns-self.startns
+
+    def getDuration(self)->timedelta:
+        return timedelta(microseconds=self.getDurationNs()/1000)
+
+    def toDict(self)->dict:
+        return {"id":self.id,"parent":self.parent,"type":self.type.name if self.type is not None else None,"name":self.name,
+                "start_ns":self.startns,"duration_ns":self.getDurationNs() if self.isCompleted() else None}
+
 
 class InstrumentationStatistics():
+    """Times the stages of a build for the report logged at the end of it. Safe to record into from any thread.
+
+    Each timed span is kept only while it is open. When it ends, its duration is added to the totals for its type, which are all
+    logReport needs, and it joins a list of the last instrumentation->max_spans finished spans, which getSpans returns, so a watcher
+    that runs for weeks uses no more memory than one that just started. Spans started inside span() or a timed function nest under
+    it, and propagateSpan carries that over to worker threads. Use InstrumentationStatistics.getStatistics().
+    """
 
     _STATISTICS = None
-    
-    def __init__(self):
-        self.events={}
-        self.completed = {}
+    _LOCK = threading.Lock()
+
+    def __init__(self, maxspans:int=None):
+        if maxspans is None:
+            maxspans = int(Configurator.getConfig().getPropertyOrDefault("instrumentation","max_spans",4096))
+        self._lock = threading.Lock()
+        self.events = {} #id -> open Statistics_Timed_Event
+        self.maxopen = max(1,maxspans)
+        self.finished = deque(maxlen=max(1,maxspans))
+        self.totals = {} #type name -> [count, total ns]
+        #wall clock times given by other computers, like the photography times in a manifest, are placed on the perf_counter
+        #timeline from a single reading of both clocks.
+        self._wallns = time.time_ns()
+        self._perfns = time.perf_counter_ns()
+
+    def _toPerfNs(self, t)->int:
+        if isinstance(t,str):
+            t = datetime.strptime(t,"%Y-%m-%d %H:%M:%S.%f")
+        if isinstance(t,datetime):
+            return self._perfns+int(t.timestamp()*1e9)-self._wallns
+        return None
 
     def logReport(self):
         logger = PipelineLogging.getLogger(__name__)
         accumulatedtime = timedelta(0)
         phototime = timedelta(0)
+        with self._lock:
+            totals = {k:list(v) for k,v in self.totals.items()}
         for s in Statistic_Event_Types.getIteratable():
-            if s.name in self.completed.keys():
-                arrayofevents = self.completed[s.name]
-                totaltime = timedelta(0)
-                for e in arrayofevents:
-                    totaltime += e.getDuration()
-                ave = totaltime/len(arrayofevents)
-                #if we are building with the ortery, most of the masking and  conversion time overlaps with the  
+            if s.name in totals.keys():
+                count, totalns = totals[s.name]
+                totaltime = timedelta(microseconds=totalns/1000)
+                ave = totaltime/count
+                #if we are building with the ortery, most of the masking and  conversion time overlaps with the
                 #photo taking time, so don't count it in the total.
-                if s.name is Statistic_Event_Types.EVENT_TAKE_PHOTO.name:
+                if s is Statistic_Event_Types.EVENT_TAKE_PHOTO:
                     phototime = totaltime
                     accumulatedtime+=phototime
-                elif s.name is Statistic_Event_Types.EVENT_BUILD_MASK.name or s.name is Statistic_Event_Types.EVENT_CONVERT_PHOTO.name:
+                elif s is Statistic_Event_Types.EVENT_BUILD_MASK or s is Statistic_Event_Types.EVENT_CONVERT_PHOTO:
                     phototime-=totaltime
                     if phototime < timedelta(0):
                         accumulatedtime -= phototime
@@ -89,51 +152,101 @@ class InstrumentationStatistics():
                             totaltime,ave)
         logger.info("Total build time: %s",accumulatedtime)
 
-    def timeEventStart(self,type:Statistic_Event_Types,starttime = None): 
-        evt = Statistics_Timed_Event(type)
-        if starttime:
-            if isinstance(starttime,str):
-                starttime = datetime.strptime(starttime,"%Y-%m-%d %H:%M:%S.%f")
-            if isinstance(starttime,datetime):
-                evt.start(starttime)
-        self.events[evt.id] = evt
+    def timeEventStart(self,type:Statistic_Event_Types,starttime = None,parent:int=None,name:str=None)->int:
+        """Starts a span.
+
+        Parameters:
+        -----------
+        type: what is being timed.
+        starttime: an optional wall clock time it started instead of now, as a datetime or a string like 2025-01-31 13:45:00.000000.
+        parent: the id of the span it nests under. Defaults to the current span.
+        name: an optional name for it.
+
+        returns: the id of the span, for timeEventEnd.
+        """
+        evt = Statistics_Timed_Event(type,parent if parent is not None else _CURRENT_SPAN.get(),name,
+                                     self._toPerfNs(starttime) if starttime else None)
+        stale = None
+        with self._lock:
+            self.events[evt.id] = evt
+            if len(self.events) > self.maxopen:
+                #a span that was never ended, say because the code timing it raised, is dropped rather than kept forever.
+                stale = next(iter(self.events))
+                del self.events[stale]
+        if stale is not None:
+            PipelineLogging.getLogger(__name__).debug("Dropped span %s, which was never ended.",stale)
         return evt.id
-    
-    def timeEventEnd(self,id,endtime=None):
-        evt = self.events[id]
-        if endtime:
-            if isinstance(endtime,str):
-                endtime = datetime.strptime(endtime,"%Y-%m-%d %H:%M:%S.%f")
-            if isinstance(endtime,datetime):
-                evt.end(endtime)
-        else:
-            evt.end()
-        if evt.type.name not in self.completed.keys(): #using the string for the key for readability
-            self.completed[evt.type.name] = []
-        self.completed[evt.type.name].append(evt)
-
-
-
-    
+
+    def timeEventEnd(self,id,endtime=None)->int:
+        """Ends a span and adds it to the totals.
+
+        Parameters:
+        -----------
+        id: the id from timeEventStart.
+        endtime: an optional wall clock time it ended instead of now.
+
+        returns: its duration in nanoseconds, or None if there is no such open span.
+        """
+        endns = (self._toPerfNs(endtime) if endtime else None) or time.perf_counter_ns()
+        with self._lock:
+            evt = self.events.pop(id,None)
+            if evt is None:
+                return None
+            evt.endns = endns
+            self.finished.append(evt)
+            if evt.type is not None:
+                total = self.totals.setdefault(evt.type.name,[0,0]) #using the string for the key for readability
+                total[0] += 1
+                total[1] += evt.getDurationNs()
+        return evt.getDurationNs()
+
+    @contextlib.contextmanager
+    def span(self, type:Statistic_Event_Types=None, name:str=None):
+        """A context manager that times what runs inside it as a span, under which the spans started inside it nest.
+
+        returns: the id of the span.
+        """
+        sid = self.timeEventStart(type,name=name)
+        token = _CURRENT_SPAN.set(sid)
+        try:
+            yield sid
+        finally:
+            _CURRENT_SPAN.reset(token)
+            self.timeEventEnd(sid)
+
+    def getSpans(self)->list:
+        """returns: the most recently finished spans, oldest first, as dictionaries with the keys id, parent, type, name, start_ns
+        and duration_ns."""
+        with self._lock:
+            return [e.toDict() for e in self.finished]
+
+    def getTotals(self)->dict:
+        """returns: a dictionary of event type name to (count, total nanoseconds) of every span of that type that has finished."""
+        with self._lock:
+            return {k:tuple(v) for k,v in self.totals.items()}
+
     @staticmethod
     def getStatistics():
-        if not InstrumentationStatistics._STATISTICS:
-            InstrumentationStatistics._STATISTICS = InstrumentationStatistics()
-        return InstrumentationStatistics._STATISTICS
-    
+        stats = InstrumentationStatistics._STATISTICS
+        if stats is None:
+            with InstrumentationStatistics._LOCK:
+                if InstrumentationStatistics._STATISTICS is None:
+                    InstrumentationStatistics._STATISTICS = InstrumentationStatistics()
+                stats = InstrumentationStatistics._STATISTICS
+        return stats
+
     @staticmethod
     def destroyStatistics():
-        InstrumentationStatistics._STATISTICS = None
+        with InstrumentationStatistics._LOCK:
+            InstrumentationStatistics._STATISTICS = None
 
         #decorator for wrapping functions in timed event start and end.
 def timed(event_type:Statistic_Event_Types):
     def decorator_timed(func_to_time):
         @functools.wraps(func_to_time)
         def wraped_timed(*args,**kwargs):
-            eid = InstrumentationStatistics.getStatistics().timeEventStart(event_type)
-            ret = func_to_time(*args,**kwargs)
-            InstrumentationStatistics.getStatistics().timeEventEnd(eid)
-            return ret
+            with InstrumentationStatistics.getStatistics().span(event_type,func_to_time.__qualname__):
+                return func_to_time(*args,**kwargs)
         return wraped_timed
     return decorator_timed
-    
+
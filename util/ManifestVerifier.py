@@ -0,0 +1,130 @@
+import os
+import threading
+import time
+from pathlib import Path
+from util.buildManifest import ManifestTail, STREAM_SUFFIX
+from util.Cancellation import CancellationToken
+from util.PipelineLogging import getLogger
+
+
+class ManifestVerifier():
+    """Checks the pictures of a capture while it is still coming in, by tailing the .jsonl manifests the sender streams to the
+    network drive. Each picture is checked against the size, and if there is one the checksum, in its record as soon as the record
+    appears, and pictures that check out are passed to onverified so that work on them can start. By the time the capture's
+    _manifest.txt arrives every picture has been checked, so verifyManifest only has to look up the results.
+
+    Parameters:
+    -----------
+    onverified: an optional callable taking the path of each picture that checked out.
+    checksums: if false, only sizes are checked.
+    interval: seconds between polls of the manifests.
+    token: stops the verifier.
+    """
+    #how long to wait for a picture named in a record to show up, since the network drive can show the record first.
+    MISSING_GRACE = 30.0
+
+    def __init__(self, onverified=None, checksums:bool=True, interval:float=0.5, token:CancellationToken=None):
+        self.onverified = onverified
+        self.checksums = checksums
+        self.interval = interval
+        self.token = token if token is not None else CancellationToken()
+        self._lock = threading.Lock()
+        self._tails = {} #path of the manifest -> [ManifestTail, project, pending records]
+        self._results = {} #project -> {name: true if the picture checked out}
+        self._closed = set()
+        self._thread = None
+
+    @staticmethod
+    def isStreamManifest(path)->bool:
+        return str(path).endswith(STREAM_SUFFIX)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run,daemon=True,name="ManifestVerifier")
+            self._thread.start()
+
+    def stop(self):
+        self.token.cancel("Manifest verifier stopped.")
+        if self._thread is not None:
+            self._thread.join()
+
+    def watch(self, path):
+        """Starts tailing a .jsonl manifest. Manifests that are already being tailed are ignored."""
+        path = str(path)
+        with self._lock:
+            if path not in self._tails:
+                self._tails[path] = [ManifestTail(path),Path(path).name[:-len(STREAM_SUFFIX)],[]]
+
+    def getResults(self, project:str)->dict:
+        """returns: a dictionary of picture name to true if it checked out or false if it didn't, for the pictures of a project that
+        have been checked so far."""
+        with self._lock:
+            return dict(self._results.get(project,{}))
+
+    def isClosed(self, project:str)->bool:
+        """returns: true once the project's session has ended and every picture in it has been checked."""
+        with self._lock:
+            return project in self._closed
+
+    def _verify(self, directory:Path, record:dict)->bool:
+        """returns: true or false for a checked picture, None if the picture isn't there yet."""
+        path = Path(directory,record["name"])
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return None
+        if record.get("size") is not None and size != record["size"]:
+            getLogger(__name__).error("%s is %d bytes, but the manifest says %d.",path,size,record["size"])
+            return False
+        if self.checksums and record.get("checksum"):
+            from transfer.TransferEngine import checksumFile
+            checksum = checksumFile(path)
+            if checksum != record["checksum"]:
+                getLogger(__name__).error("%s doesn't match its checksum in the manifest.",path)
+                return False
+        return True
+
+    def _poll(self, manifest:str, entry:list):
+        tail, project, pending = entry
+        now = time.monotonic()
+        for record in tail.poll():
+            if record.get("type") == "session":
+                project = entry[1] = record.get("project",project)
+                pending.clear()
+                with self._lock:
+                    self._results[project] = {}
+                    self._closed.discard(project)
+            elif record.get("type") == "file":
+                pending.append((record,now))
+        directory = Path(manifest).parent
+        stillpending = []
+        for record, seen in pending:
+            ok = self._verify(directory,record)
+            if ok is None and now-seen < ManifestVerifier.MISSING_GRACE:
+                stillpending.append((record,seen))
+                continue
+            if ok is None:
+                getLogger(__name__).error("%s is in the manifest for %s, but never arrived.",record["name"],project)
+                ok = False
+            with self._lock:
+                self._results.setdefault(project,{})[record["name"]] = ok
+            #files sent alongside a picture, like masks made on the sender, are used by the build but not processed themselves.
+            if ok and self.onverified is not None and not record.get("of"):
+                try:
+                    self.onverified(str(Path(directory,record["name"])))
+                except Exception as e:
+                    getLogger(__name__).error("Handling %s failed: %s",record["name"],e)
+        entry[2] = stillpending
+        if tail.closed and not stillpending:
+            with self._lock:
+                self._closed.add(project)
+                del self._tails[manifest]
+            getLogger(__name__).info("Finished checking the pictures for %s.",project)
+
+    def _run(self):
+        while not self.token.isCancelled():
+            with self._lock:
+                tails = list(self._tails.items())
+            for manifest, entry in tails:
+                self._poll(manifest,entry)
+            self.token.wait(self.interval)
@@ -0,0 +1,276 @@
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from util.Cancellation import CancellationToken
+from util.Configurator import Configurator
+from util.PipelineLogging import getLogger
+
+#bytes of memory used at the peak of an operation, per pixel of the picture it works on. These are rough and meant to be tuned
+#against the rss figures that MemoryBudget reports in the run report.
+BYTES_PER_PIXEL = {
+    "raw_convert":12,   #16 bit bayer data, rawpy's 16 bit working copy and the 8 bit rgb result.
+    "tif_convert":10,   #the decoded tif, possibly 16 bits per channel, plus the 8 bit rgb copy.
+    "copy":0,
+    "threshold_mask":6, #the bgr picture, its grayscale copy and the mask.
+    "ai_mask":8,        #the picture, the encoded upload and the mask.
+    "droplet_mask":1,   #photoshop does the work in its own process.
+    "reference":15,     #the rgb picture, the bgr copy, the gray copy and the brightness adjusted result.
+}
+#used when a picture's dimensions can't be read from its header.
+DEFAULT_PIXELS = 24_000_000
+RAW_EXTENSIONS = [".CR2",".NEF",".DNG"]
+
+def getImagePixels(path:Path)->int:
+    """Returns the number of pixels in a picture, reading only its header. RAW files are estimated from their size, since
+    compressed RAW files take roughly a byte per pixel."""
+    path = Path(path)
+    try:
+        if path.suffix.upper() in RAW_EXTENSIONS:
+            return max(os.path.getsize(path),1)
+        from PIL import Image
+        with Image.open(path) as im:
+            return im.width*im.height
+    except Exception:
+        return DEFAULT_PIXELS
+
+def estimateImageBytes(path:Path, operation:str)->int:
+    """Estimates the peak memory an operation needs for a picture.
+
+    Parameters:
+    -----------
+    path: the picture.
+    operation: a key in BYTES_PER_PIXEL.
+
+    returns: bytes.
+    """
+    perpixel = BYTES_PER_PIXEL.get(operation,0)
+    if perpixel == 0:
+        return 0
+    return getImagePixels(path)*perpixel
+
+def getRss()->int:
+    """Returns the resident set size of this process in bytes, or None if it can't be read here."""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    if sys.platform.startswith("linux"):
+        try:
+            with open("/proc/self/statm",'r') as f:
+                return int(f.read().split()[1])*os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError):
+            return None
+    if sys.platform == "win32":
+        import ctypes
+        from ctypes import wintypes
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [("cb",wintypes.DWORD),("PageFaultCount",wintypes.DWORD),("PeakWorkingSetSize",ctypes.c_size_t),
+                        ("WorkingSetSize",ctypes.c_size_t),("QuotaPeakPagedPoolUsage",ctypes.c_size_t),
+                        ("QuotaPagedPoolUsage",ctypes.c_size_t),("QuotaPeakNonPagedPoolUsage",ctypes.c_size_t),
+                        ("QuotaNonPagedPoolUsage",ctypes.c_size_t),("PagefileUsage",ctypes.c_size_t),
+                        ("PeakPagefileUsage",ctypes.c_size_t)]
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(process,ctypes.byref(counters),counters.cb):
+            return counters.WorkingSetSize
+        return None
+    #macos has no cheap way to read the current rss without psutil, so fall back to the peak.
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def getPhysicalMemory()->int:
+    """Returns the total physical memory of the machine in bytes, or None if it can't be read here."""
+    try:
+        import psutil
+        return psutil.virtual_memory().total
+    except ImportError:
+        pass
+    if sys.platform == "win32":
+        import ctypes
+        class MEMORYSTATUSEX(ctypes.Structure):
+            _fields_ = [("dwLength",ctypes.c_ulong),("dwMemoryLoad",ctypes.c_ulong),("ullTotalPhys",ctypes.c_ulonglong),
+                        ("ullAvailPhys",ctypes.c_ulonglong),("ullTotalPageFile",ctypes.c_ulonglong),
+                        ("ullAvailPageFile",ctypes.c_ulonglong),("ullTotalVirtual",ctypes.c_ulonglong),
+                        ("ullAvailVirtual",ctypes.c_ulonglong),("ullAvailExtendedVirtual",ctypes.c_ulonglong)]
+        status = MEMORYSTATUSEX()
+        status.dwLength = ctypes.sizeof(status)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return status.ullTotalPhys
+        return None
+    try:
+        return os.sysconf("SC_PAGE_SIZE")*os.sysconf("SC_PHYS_PAGES")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def _mb(nbytes)->float:
+    return None if nbytes is None else round(nbytes/(1024*1024),1)
+
+
+class MemoryBudget():
+    """Admission control for work that loads whole pictures into memory. Each batch item reserves its estimated peak memory before
+    it starts and gives it back when it's done. An item waits while the reservations already running plus its own would go over
+    the budget, so adding workers, or running conversion and masking at the same time, can't push the machine into swap
+    while metashape is also running. An item is always let in when nothing else is running, so one picture bigger than the whole
+    budget still gets processed.
+
+    Reservations are reentrant per thread: a reservation made while the same thread already holds one, like masking a picture
+    inside its conversion's reservation, only waits on what other threads hold. Otherwise it would wait on its own caller forever.
+
+    While anything is reserved, a background thread samples the process's rss so the estimates can be checked against what
+    was actually used. Use MemoryBudget.getBudget() rather than constructing one.
+
+    Parameters:
+    -----------
+    budget: the budget in bytes. 0 means no limit.
+    sampleinterval: seconds between rss samples.
+    """
+    _instance = None
+    _instancelock = threading.Lock()
+
+    @staticmethod
+    def getBudget():
+        with MemoryBudget._instancelock:
+            if MemoryBudget._instance is None:
+                config = Configurator.getConfig()
+                budgetmb = float(config.getPropertyOrDefault("memory","budget_mb",0))
+                if budgetmb <= 0:
+                    #default to half the machine, leaving the rest for metashape and the os.
+                    physical = getPhysicalMemory()
+                    budget = physical//2 if physical else 0
+                else:
+                    budget = int(budgetmb*1024*1024)
+                MemoryBudget._instance = MemoryBudget(budget,float(config.getPropertyOrDefault("memory","sample_interval_s",0.25)))
+            return MemoryBudget._instance
+
+    def __init__(self, budget:int, sampleinterval:float=0.25):
+        self.budget = budget
+        self.sampleinterval = sampleinterval
+        self._cond = threading.Condition()
+        self._inuse = 0
+        self._running = 0
+        self._active = {} #operation -> number of reservations running
+        self._held = threading.local() #bytes and reservations held by the current thread, so nested reservations don't wait on it
+        self._stats = {}
+        self.peakestimate = 0
+        self.peakrss = None
+        self.baselinerss = getRss()
+        self.waits = 0
+        self.waittime = 0.0
+        self._sampler = None
+
+    def getInUse(self)->int:
+        with self._cond:
+            return self._inuse
+
+    def _startSampler(self):
+        if self._sampler is None:
+            self._sampler = threading.Thread(target=self._sample,daemon=True,name="MemoryBudgetSampler")
+            self._sampler.start()
+
+    def _sample(self):
+        while True:
+            with self._cond:
+                while self._running == 0:
+                    self._cond.wait()
+            rss = getRss()
+            if rss is not None:
+                with self._cond:
+                    self._recordRss(rss)
+            time.sleep(self.sampleinterval)
+
+    def _recordRss(self, rss:int):
+        #call with the lock held.
+        if self.peakrss is None or rss > self.peakrss:
+            self.peakrss = rss
+        for operation in self._active:
+            stat = self._stats[operation]
+            if stat["peak_rss"] is None or rss > stat["peak_rss"]:
+                stat["peak_rss"] = rss
+                stat["estimate_in_use_at_peak_rss"] = self._inuse
+
+    @contextmanager
+    def reserve(self, nbytes:int, operation:str="unknown", token:CancellationToken=None):
+        """Waits until nbytes fit in the budget, holds them while the with block runs, then gives them back.
+
+        Parameters:
+        -----------
+        nbytes: the estimated peak memory of the work.
+        operation: what the work is, for the report.
+        token: if it's cancelled while waiting, the wait ends and the block runs anyway, so that the caller's own cancellation
+        check decides what to do.
+        """
+        start = time.perf_counter()
+        waited = False
+        heldbytes = getattr(self._held,"bytes",0)
+        heldcount = getattr(self._held,"count",0)
+        with self._cond:
+            while self.budget > 0 and self._running > heldcount and self._inuse-heldbytes+nbytes > self.budget:
+                if CancellationToken.check(token):
+                    break
+                waited = True
+                self._cond.wait(0.5)
+            self._inuse += nbytes
+            self._running += 1
+            self._active[operation] = self._active.get(operation,0)+1
+            stat = self._stats.setdefault(operation,{"items":0,"estimate_total":0,"estimate_max":0,"peak_rss":None,
+                                                     "estimate_in_use_at_peak_rss":0})
+            stat["items"] += 1
+            stat["estimate_total"] += nbytes
+            stat["estimate_max"] = max(stat["estimate_max"],nbytes)
+            self.peakestimate = max(self.peakestimate,self._inuse)
+            if waited:
+                self.waits += 1
+                self.waittime += time.perf_counter()-start
+            self._startSampler()
+            self._cond.notify_all()
+        self._held.bytes = heldbytes+nbytes
+        self._held.count = heldcount+1
+        try:
+            yield
+        finally:
+            self._held.bytes = heldbytes
+            self._held.count = heldcount
+            rss = getRss()
+            with self._cond:
+                if rss is not None:
+                    self._recordRss(rss)
+                self._inuse -= nbytes
+                self._running -= 1
+                self._active[operation] -= 1
+                if self._active[operation] == 0:
+                    del self._active[operation]
+                self._cond.notify_all()
+
+    def getStats(self)->dict:
+        """returns: the budget, the peak of the estimates in use against the peak rss, and, per operation, the estimates against
+        the highest rss seen while that operation was running. All sizes are in MB."""
+        with self._cond:
+            operations = {}
+            for operation, stat in self._stats.items():
+                operations[operation] = {"items":stat["items"],
+                                         "estimate_mean_mb":_mb(stat["estimate_total"]/max(stat["items"],1)),
+                                         "estimate_max_mb":_mb(stat["estimate_max"]),
+                                         "peak_rss_mb":_mb(stat["peak_rss"]),
+                                         "estimate_in_use_at_peak_rss_mb":_mb(stat["estimate_in_use_at_peak_rss"])}
+            return {"budget_mb":_mb(self.budget) if self.budget else None,
+                    "baseline_rss_mb":_mb(self.baselinerss),
+                    "peak_estimate_mb":_mb(self.peakestimate),
+                    "peak_rss_mb":_mb(self.peakrss),
+                    "waits":self.waits,
+                    "wait_s":round(self.waittime,3),
+                    "operations":operations}
+
+    def logStats(self):
+        stats = self.getStats()
+        getLogger(__name__).info("Memory: budget %s MB, peak estimate %s MB over a baseline of %s MB, peak rss %s MB, %s waits.",
+                                 stats["budget_mb"],stats["peak_estimate_mb"],stats["baseline_rss_mb"],stats["peak_rss_mb"],
+                                 stats["waits"])
+        for operation, s in stats["operations"].items():
+            getLogger(__name__).info("Memory: %s, %s items, estimated %s MB each, at most %s MB; peak rss %s MB with %s MB reserved.",
+                                     operation,s["items"],s["estimate_mean_mb"],s["estimate_max_mb"],s["peak_rss_mb"],
+                                     s["estimate_in_use_at_peak_rss_mb"])
@@ -1,7 +1,6 @@
 from pathlib import Path
 from os import mkdir
 from util.PipelineLogging import getLogger
-import Metashape
 #provides a singleton wrapper around a metashape document so that multiple tasks can access it.
 class MetashapeFileSingleton():
     _METASHAPE_FILE = None
@@ -10,6 +9,7 @@ class MetashapeFileSingleton():
         self._projdir = Path(projectdir)
         self._projname = projectname
         if doc is None:
+            import Metashape #imported here so that scripts which never open a document don't load the Metashape SDK.
             if not self._projdir.exists():
                 mkdir(self._projdir)
             self._metashapedoc = Metashape.Document()
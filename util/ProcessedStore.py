@@ -0,0 +1,96 @@
+import json
+import os
+import threading
+from datetime import datetime
+from pathlib import Path
+from util.Configurator import Configurator
+from util.PipelineLogging import getLogger
+
+
+def getStorePath()->Path:
+    """Returns the processed file store configured in config.json->watcher->state_file, by default watcher_state.jsonl in
+    watcher->temp_scratch, so that purging the scratch folder forgets what was processed along with the results."""
+    config = Configurator.getConfig()
+    path = config.getPropertyOrDefault("watcher","state_file","")
+    return Path(path) if path else Path(config.getProperty("watcher","temp_scratch"),"watcher_state.jsonl")
+
+
+class ProcessedStore():
+    """An on-disk record of the files the recipient watcher has finished with, so that after a restart it can tell which of the
+    files in its folder still need work. Each file is keyed by its path, and remembered with its size and modification time, so a
+    file that is written again counts as new. Records are appended one json object per line, so recording a file doesn't rewrite
+    the store, and the store is compacted when it is loaded, dropping files that no longer exist.
+
+    Parameters:
+    -----------
+    path: the jsonl file to keep the store in. See getStorePath.
+    """
+
+    def __init__(self, path:Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self.entries = {}
+        lines = 0
+        if self.path.exists():
+            try:
+                with open(self.path,'r',encoding="utf-8") as f:
+                    for line in f:
+                        lines += 1
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            #a line cut short by a crash.
+                            continue
+                        self.entries[record["path"]] = record
+            except OSError as e:
+                getLogger(__name__).warning("Could not read the processed file store %s, starting a new one. %s",self.path,e)
+                self.entries = {}
+        self.entries = {k:v for k,v in self.entries.items() if os.path.exists(k)}
+        if lines > len(self.entries):
+            self.compact()
+
+    @staticmethod
+    def _key(path)->str:
+        return os.path.normcase(os.path.abspath(path))
+
+    def compact(self):
+        """Rewrites the store with one line per file."""
+        with self._lock:
+            os.makedirs(self.path.parent,exist_ok=True)
+            tmppath = Path(self.path.parent,f"{self.path.name}.tmp")
+            with open(tmppath,'w',encoding="utf-8") as f:
+                for record in self.entries.values():
+                    f.write(json.dumps(record)+"\n")
+            os.replace(tmppath,self.path)
+
+    def record(self, path, kind:str):
+        """Records that a file has been processed.
+
+        Parameters:
+        -----------
+        path: the file.
+        kind: what was done with it, e.g. image or build.
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        record = {"path":ProcessedStore._key(path),"size":st.st_size,"mtime_ns":st.st_mtime_ns,"kind":kind,
+                  "time":datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")}
+        with self._lock:
+            self.entries[record["path"]] = record
+            os.makedirs(self.path.parent,exist_ok=True)
+            with open(self.path,'a',encoding="utf-8") as f:
+                f.write(json.dumps(record)+"\n")
+
+    def isProcessed(self, path)->bool:
+        """Returns true if the file was processed and hasn't changed since."""
+        with self._lock:
+            record = self.entries.get(ProcessedStore._key(path))
+        if record is None:
+            return False
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        return st.st_size == record["size"] and st.st_mtime_ns == record["mtime_ns"]
@@ -0,0 +1,147 @@
+import os
+import threading
+import time
+from queue import Queue, Empty, Full
+from util.Cancellation import CancellationToken
+from util.PipelineLogging import getLogger
+
+
+class ProcessingLanes():
+    """Runs the work the recipient watcher does for each file that arrives, off of the watcher's own threads.
+
+    Pictures go into a bounded image lane drained by a pool of workers, so several pictures are developed and masked at once
+    and a burst from the camera waits in the queue rather than piling up in memory. Manifests go into a separate build lane with
+    a single worker, so a build never holds up the pictures of the next capture. Before a build starts, the build lane waits for
+    the pictures that were queued before its manifest to be finished, since the build needs them, but not for pictures of the
+    next capture that arrive after. A picture submitted twice, say by the file watcher and by the manifest verifier, is only
+    processed once, unless it has been written again in between. A manifest submitted again while its build is queued or
+    running, say by the watcher's reconcile, is ignored the same way.
+
+    Parameters:
+    -----------
+    imagefunc: a callable taking the path of a picture.
+    buildfunc: a callable taking the path of a manifest.
+    isbuild: a callable that returns true for paths that belong in the build lane.
+    workers: the number of image workers.
+    queuesize: how many pictures can wait in the image lane before submit blocks.
+    token: stops the lanes. Work that has started is allowed to finish.
+    """
+
+    def __init__(self, imagefunc, buildfunc, isbuild, workers:int=2, queuesize:int=64, token:CancellationToken=None):
+        self.imagefunc = imagefunc
+        self.buildfunc = buildfunc
+        self.isbuild = isbuild
+        self.workers = max(1,workers)
+        self.token = token if token is not None else CancellationToken()
+        self.images = Queue(maxsize=max(1,queuesize))
+        self.builds = Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._inflight = set() #sequence numbers of pictures queued or being processed.
+        self._submitted = {} #path of each picture submitted -> its modification time then.
+        self._builds = {} #path of each manifest queued or being built -> its modification time when it was submitted.
+        self.processed = 0
+        self.failed = 0
+        self.busytime = 0.0
+
+    def start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self._imageWorker,daemon=True,name=f"ImageLane-{i}")
+            t.start()
+            self._threads.append(t)
+        t = threading.Thread(target=self._buildWorker,daemon=True,name="BuildLane")
+        t.start()
+        self._threads.append(t)
+
+    def stop(self):
+        self.token.cancel("Processing lanes stopped.")
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+    def submit(self, path:str)->bool:
+        """Queues a file. Blocks while the image lane is full.
+
+        returns: false if the lanes were stopped before the file could be queued.
+        """
+        key = os.path.normcase(os.path.abspath(path))
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if self.isbuild(path):
+            with self._lock:
+                if mtime is not None and self._builds.get(key) == mtime:
+                    return True
+                self._builds[key] = mtime
+                self.builds.put((self._seq,path,key,mtime))
+            return True
+        with self._lock:
+            if mtime is not None and self._submitted.get(key) == mtime:
+                return True
+            self._submitted[key] = mtime
+            self._seq += 1
+            seq = self._seq
+            self._inflight.add(seq)
+        while not self.token.isCancelled():
+            try:
+                self.images.put((seq,path),timeout=0.5)
+                return True
+            except Full:
+                continue
+        with self._lock:
+            self._inflight.discard(seq)
+            self._submitted.pop(key,None)
+        return False
+
+    def getBacklog(self)->int:
+        """returns: the number of pictures queued or being processed."""
+        with self._lock:
+            return len(self._inflight)
+
+    def _waitingFor(self, mark:int)->bool:
+        with self._lock:
+            return any(seq <= mark for seq in self._inflight)
+
+    def _imageWorker(self):
+        while not self.token.isCancelled():
+            try:
+                seq, path = self.images.get(timeout=0.5)
+            except Empty:
+                continue
+            start = time.perf_counter()
+            ok = True
+            try:
+                self.imagefunc(path)
+            except Exception as e:
+                ok = False
+                getLogger(__name__).error("Could not process %s: %s",path,e)
+            finally:
+                with self._lock:
+                    self._inflight.discard(seq)
+                    self.processed += 1
+                    self.failed += 0 if ok else 1
+                    self.busytime += time.perf_counter()-start
+                self.images.task_done()
+
+    def _buildWorker(self):
+        while not self.token.isCancelled():
+            try:
+                mark, path, key, mtime = self.builds.get(timeout=0.5)
+            except Empty:
+                continue
+            #the manifest arrives after its pictures, so every picture queued before it has to be finished first.
+            while self._waitingFor(mark):
+                if self.token.wait(0.2):
+                    return
+            getLogger(__name__).info("Starting the build for %s with %d pictures processed so far.",path,self.processed)
+            try:
+                self.buildfunc(path)
+            except Exception as e:
+                getLogger(__name__).error("Build for %s failed: %s",path,e)
+            finally:
+                #a finished build is in the processed file store, so submitting it again from here on is up to the caller.
+                with self._lock:
+                    if self._builds.get(key) == mtime:
+                        del self._builds[key]
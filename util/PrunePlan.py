@@ -0,0 +1,87 @@
+import re
+import threading
+from pathlib import Path
+from util.Configurator import Configurator
+
+#ortery pictures are named ending in their frame number, counting from zero.
+FRAME_PATTERN = re.compile(r"[a-zA-Z]*_*(\d+)$")
+
+
+class PrunePlan():
+    """Which of the Ortery's frames are kept for photogrammetry and which are pruned, worked out once from
+    config.json->ortery, so that deciding about a picture is a lookup rather than arithmetic on the config.
+
+    The Ortery takes pics_per_revolution pictures with each camera in turn, but some angles, like 90 degrees, need far fewer. For a
+    camera that keeps at least half its pictures, the pictures to drop are spread evenly around the revolution, otherwise the
+    pictures to keep are. Either way, exactly pics_per_cam of them are kept. Frames of cameras that aren't configured are kept.
+    Use PrunePlan.getPlan() for the plan of the current config.
+
+    Parameters:
+    -----------
+    picsperrevolution: the number of pictures each camera takes, ortery->pics_per_revolution.
+    picspercam: a dictionary of camera number, counting from 1, as a string, to the number of pictures to keep, ortery->pics_per_cam.
+    """
+    _plan = None
+    _planlock = threading.Lock()
+
+    @staticmethod
+    def getPlan():
+        """returns: the plan for the current config, which is only rebuilt if ortery->pics_per_revolution or pics_per_cam changed."""
+        config = Configurator.getConfig()
+        perrev = config.getProperty("ortery","pics_per_revolution")
+        percam = config.getProperty("ortery","pics_per_cam")
+        with PrunePlan._planlock:
+            plan = PrunePlan._plan
+            if plan is None or plan.picsperrevolution != perrev or plan.picspercam != percam:
+                plan = PrunePlan._plan = PrunePlan(perrev,percam)
+            return plan
+
+    def __init__(self, picsperrevolution:int, picspercam:dict):
+        self.picsperrevolution = int(picsperrevolution)
+        self.picspercam = dict(picspercam)
+        self.numcams = max([int(k) for k in self.picspercam.keys()],default=0)
+        #one byte per frame of every configured camera, 1 if it is kept.
+        self.keep = bytearray(self.numcams*self.picsperrevolution)
+        n = self.picsperrevolution
+        for cam in range(1,self.numcams+1):
+            expected = min(max(int(self.picspercam.get(str(cam),n)),0),n)
+            offset = (cam-1)*n
+            if expected >= n:
+                self.keep[offset:offset+n] = b"\x01"*n
+                continue
+            drop = n-expected
+            for j in range(n):
+                if drop/n < 0.5:
+                    kept = ((j+1)*drop)//n == (j*drop)//n
+                else:
+                    kept = ((j+1)*expected)//n != (j*expected)//n
+                self.keep[offset+j] = 1 if kept else 0
+
+    @staticmethod
+    def getFrameNumber(filename)->int:
+        """returns: the frame number at the end of a file's name, or None if it doesn't end in one."""
+        m = FRAME_PATTERN.match(Path(filename).stem)
+        return int(m.group(1)) if m is not None else None
+
+    def keepsFrame(self, framenum:int)->bool:
+        return framenum >= len(self.keep) or framenum < 0 or self.keep[framenum] == 1
+
+    def shouldPrune(self, filename)->bool:
+        """returns: true if the picture should be left out. Pictures not named the way the Ortery names them are never pruned."""
+        framenum = PrunePlan.getFrameNumber(filename)
+        return framenum is not None and not self.keepsFrame(framenum)
+
+    def getKeptFrames(self, cam:int)->list:
+        """returns: the positions in the revolution, counting from 1, of the pictures of a camera that are kept."""
+        offset = (cam-1)*self.picsperrevolution
+        return [j+1 for j in range(self.picsperrevolution) if self.keepsFrame(offset+j)]
+
+    def describe(self)->str:
+        """returns: a line for each camera showing which pictures of its revolution are kept (x) and pruned (.)."""
+        lines = []
+        for cam in range(1,self.numcams+1):
+            offset = (cam-1)*self.picsperrevolution
+            row = "".join("x" if self.keepsFrame(offset+j) else "." for j in range(self.picsperrevolution))
+            lines.append(f"Camera {cam:>2}: {row} {len(self.getKeptFrames(cam))} of {self.picsperrevolution}, "
+                         f"frames {offset}-{offset+self.picsperrevolution-1}")
+        return "\n".join(lines)
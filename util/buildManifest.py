@@ -1,5 +1,7 @@
 
 import json
+import os
+import threading
 from datetime import datetime
 import argparse
 from os import listdir
@@ -7,23 +9,46 @@ from pathlib import *
 
 import util
 
+STREAM_SUFFIX = "_manifest.jsonl"
+
 class Manifest:
     """Class that manages the manifest written to the disk by the listen and send script on the ortery computer. Adds files to an
     internal list and writes them to disk when asked."""
-    def __init__(self, projectname, maskmode):
+    def __init__(self, projectname, maskmode, stages:dict=None):
         self.sentfiles = []
+        self.checksums = {}
+        self.derived = {} #files sent alongside the pictures, such as masks made on the sender, path -> name of their picture.
+        self.stages = dict(stages) if stages else {} #work done on the sender before sending, see getSenderStages.
         self.projectname = projectname
         self.maskmode = maskmode
         self.starttime = datetime.now()
         self.endtime = None
-    def addFile(self, filepath):
+    def addFile(self, filepath, checksum:str=None, size:int=None):
         """Adds a file to the manifest.
         
         Parameters:
         ---------
         filepath: the full path of the file to add.
+        checksum: the checksum the transfer engine computed while sending the file, e.g. blake2b:<hex>, if it computed one.
+        size: the size of the file in bytes. Only the StreamingManifest records it.
         """
         self.sentfiles.append(filepath)
+        if checksum:
+            self.checksums[filepath] = checksum
+    def addDerivedFile(self, filepath, of, checksum:str=None, size:int=None):
+        """Adds a file that was sent alongside a picture rather than as one, like a mask made on the sender or the raw file of a
+        picture that was converted on the sender.
+
+        Parameters:
+        ---------
+        filepath: the path of the file relative to the network drive, e.g. Masks/IMG_1.png.
+        of: the name of the picture in the manifest it belongs to.
+        checksum: the checksum the transfer engine computed while sending the file.
+        size: the size of the file in bytes. Only the StreamingManifest records it.
+        """
+        self.derived[filepath] = of
+        if checksum:
+            self.checksums[filepath] = checksum
     def finalize(self, outputdir):
         """Writes the manifest to disk.
         
@@ -40,11 +65,113 @@ class Manifest:
                           "photo_end_time":datetime.strftime(self.endtime,"%Y-%m-%d %H:%M:%S.%f")
                       }
         }
+        if self.checksums:
+            outputjson[self.projectname]["checksums"] = self.checksums
+        if self.stages:
+            outputjson[self.projectname]["stages"] = self.stages
+        if self.derived:
+            outputjson[self.projectname]["derived"] = self.derived
         filenametowrite = PurePath(outputdir,f"{self.projectname}_manifest.txt")
         with open(filenametowrite,'w',encoding='utf-8') as f:
             json.dump(outputjson,f)
         return Path(filenametowrite)
     
+class StreamingManifest(Manifest):
+    """A manifest that is also written as it grows, one json record per line, to <projectname>_manifest.jsonl in a folder that the
+    recipient can see, usually the network drive. The first record opens the session, each picture gets a record with its size
+    and checksum as soon as it has landed, and finalize adds a record that closes the session. Nothing is ever rewritten, so a
+    crash of the sender loses at most the record being written, and the recipient can tail the file to check pictures while
+    the capture is still going on. finalize still writes the usual _manifest.txt, which is what starts the build.
+
+    Parameters:
+    ----------
+    projectname: the name of the project.
+    maskmode: the masking mode for the build.
+    streamdir: the folder to write the .jsonl manifest in.
+    stages: the work done on the sender before sending, if any.
+    """
+    def __init__(self, projectname, maskmode, streamdir, stages:dict=None):
+        super().__init__(projectname, maskmode, stages)
+        self.streampath = Path(streamdir,f"{projectname}{STREAM_SUFFIX}")
+        self._lock = threading.Lock()
+        #a new session replaces the .jsonl manifest of an earlier one with the same name, as finalize does with the _manifest.txt.
+        self._append({"type":"session","project":projectname,"maskmode":maskmode,"stages":self.stages,
+                      "photo_start_time":datetime.strftime(self.starttime,"%Y-%m-%d %H:%M:%S.%f")},'w')
+
+    def _append(self, record:dict, mode:str='a'):
+        line = json.dumps(record)+"\n"
+        with self._lock:
+            with open(self.streampath,mode,encoding='utf-8') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def addFile(self, filepath, checksum:str=None, size:int=None):
+        """Adds a file to the manifest and appends its record to the .jsonl manifest.
+
+        Parameters:
+        ---------
+        filepath: the name of the file, as it is on the network drive.
+        checksum: the checksum the transfer engine computed while sending the file, if it computed one.
+        size: the size of the file in bytes.
+        """
+        super().addFile(filepath, checksum, size)
+        self._append({"type":"file","name":filepath,"size":size,"checksum":checksum,
+                      "time":datetime.strftime(datetime.now(),"%Y-%m-%d %H:%M:%S.%f")})
+
+    def addDerivedFile(self, filepath, of, checksum:str=None, size:int=None):
+        super().addDerivedFile(filepath, of, checksum, size)
+        self._append({"type":"file","name":filepath,"of":of,"size":size,"checksum":checksum,
+                      "time":datetime.strftime(datetime.now(),"%Y-%m-%d %H:%M:%S.%f")})
+
+    def finalize(self, outputdir):
+        manifestpath = super().finalize(outputdir)
+        self._append({"type":"end","count":len(self.sentfiles),
+                      "photo_end_time":datetime.strftime(self.endtime,"%Y-%m-%d %H:%M:%S.%f")})
+        return manifestpath
+
+
+class ManifestTail():
+    """Reads the records of a .jsonl manifest as they are appended. Only complete lines are read, so a record the sender is
+    still writing is picked up on a later poll.
+
+    Parameters:
+    ----------
+    path: the .jsonl manifest.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.offset = 0
+        self.closed = False
+
+    def poll(self)->list:
+        """returns: the records appended since the last poll."""
+        try:
+            with open(self.path,'rb') as f:
+                if os.fstat(f.fileno()).st_size < self.offset:
+                    #the sender started a new session with the same name.
+                    self.offset = 0
+                    self.closed = False
+                f.seek(self.offset)
+                data = f.read()
+        except OSError:
+            return []
+        end = data.rfind(b"\n")
+        if end < 0:
+            return []
+        self.offset += end+1
+        records = []
+        for line in data[:end].splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            records.append(record)
+            if record.get("type") == "end":
+                self.closed = True
+        return records
+
+
 def generate_manifest(jobname:str,directory:str ,mode:int):
     """Generates a manifest based on a file full of folders. 
     
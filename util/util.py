@@ -7,8 +7,11 @@ import shutil
 import os
 import re
 import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 from util.Configurator import Configurator
+from util.PipelineLogging import getLogger
 
 class ColorChannelConstants(Enum):
     NUMPY_BLUE=0
@@ -103,6 +106,74 @@ def copy_file_to_dest(sourcefiles:list,destpath:str, deleteoriginal=False):
         except shutil.Error as e:
             print(e)
             #swallow it and keep the original.
+
+def stage_files_to_dest(sourcefiles:list, destpath:str, deleteoriginal=True)->dict:
+    """Puts files into a folder as cheaply as the filesystem allows. When a file is on the same volume as destpath, it is renamed
+    into place if it is being moved, or hard linked if the original is kept, which takes no time no matter how big the file is.
+    Files on another volume, or on a filesystem without hard links, are copied, several at a time, using config.json->
+    scheduler->io_workers streams. Files already in destpath are replaced.
+
+    Parameters:
+    --------------
+    * sourcefiles: a list of the files to stage. [list of files]
+    * destpath: a string path to stage them to.
+    * deleteoriginal: if true, the files are moved, otherwise they are copied or linked.
+
+    returns: a dictionary with the number of files and bytes that were renamed, linked and copied, the number that failed, and the
+    seconds it took.
+    """
+    start = time.perf_counter()
+    os.makedirs(destpath,exist_ok=True)
+    destdevice = os.stat(destpath).st_dev
+    stats = {"renamed":0,"renamed_bytes":0,"linked":0,"linked_bytes":0,"copied":0,"copied_bytes":0,"failed":0}
+    tocopy = []
+    for f in sourcefiles:
+        dest = os.path.join(destpath,os.path.basename(f))
+        try:
+            st = os.stat(f)
+            if st.st_dev != destdevice:
+                tocopy.append((f,dest,st.st_size))
+            elif deleteoriginal:
+                os.replace(f,dest)
+                stats["renamed"] += 1
+                stats["renamed_bytes"] += st.st_size
+            else:
+                if os.path.lexists(dest):
+                    os.remove(dest)
+                os.link(f,dest)
+                stats["linked"] += 1
+                stats["linked_bytes"] += st.st_size
+        except OSError as e:
+            if os.path.exists(f):
+                #some filesystems, like FAT and a few network shares, can't hard link, so copy instead.
+                tocopy.append((f,dest,os.path.getsize(f)))
+            else:
+                getLogger(__name__).error("Could not stage %s: %s",f,e)
+                stats["failed"] += 1
+    def copy(job):
+        f, dest, size = job
+        try:
+            shutil.copy2(f,dest)
+            if deleteoriginal:
+                os.remove(f)
+            return size
+        except OSError as e:
+            getLogger(__name__).error("Could not stage %s: %s",f,e)
+            return None
+    if tocopy:
+        workers = int(Configurator.getConfig().getPropertyOrDefault("scheduler","io_workers",4))
+        with ThreadPoolExecutor(max_workers=max(1,min(workers,len(tocopy)))) as pool:
+            for size in pool.map(copy,tocopy):
+                if size is None:
+                    stats["failed"] += 1
+                else:
+                    stats["copied"] += 1
+                    stats["copied_bytes"] += size
+    stats["seconds"] = round(time.perf_counter()-start,3)
+    getLogger(__name__).info("Staged %d files in %s in %.2fs: %d MB renamed, %d MB linked, %d MB copied, %d failed.",
+                            len(sourcefiles),destpath,stats["seconds"],stats["renamed_bytes"]//(1024*1024),
+                            stats["linked_bytes"]//(1024*1024),stats["copied_bytes"]//(1024*1024),stats["failed"])
+    return stats
             
 def get_camera_lens_profile(cameraprofile,lensprofile):
     """Gets the appropriate model and make information from the config file for ther specified camera profile. May be deprecated now that we are no longer
@@ -129,44 +200,15 @@ def get_camera_lens_profile(cameraprofile,lensprofile):
 
 def should_prune(filename: str)->bool:
     """Takes a file name and figures out based on the number in it whether the picture should be sent or not and added to the manifest or not. It assumes files are named ending in a number and that
-    this is sequential based on when the camera took the picture.
+    this is sequential based on when the camera took the picture. The decision is looked up in the PrunePlan for the current config.
     Parameters
     -----------------
     filename: The filename in question.
 
     returns: True or false based on whether the file ought to be omitted.
     """
-    config = Configurator.getConfig()
-    shouldprune = False
-    numinround = config.getProperty("ortery","pics_per_revolution")
-    picspercam = config.getProperty("ortery","pics_per_cam")
-    numcams = len(picspercam.keys())
-    basename_with_ext = os.path.split(filename)[1]
-    fn = os.path.splitext(basename_with_ext)[0]
-    try:
-        t = re.match(r"[a-zA-Z]*_*(\d+)$",fn)
-        filenum = int(t.group(1)) #ortery counts from zero.
-        camnum = int(filenum/numinround)+1
-        picinround = filenum%(numinround)+1
-        expected = picspercam[str(camnum)]
-        print(f"{fn} is pic number {picinround} of camera {camnum}. The expected number in this round is {expected}")
-        if expected < numinround:
-            invert = False
-            if (numinround-expected)/numinround <0.5:
-                divisor = round(numinround/(numinround-expected))
-            else:
-                divisor = round(numinround/expected)
-                invert = True
-            if (picinround %divisor==0) and invert is False:
-                shouldprune=True
-            elif (picinround % divisor != 0) and invert is True:
-                shouldprune = True
-            
-    except AttributeError:
-        print(f"Filename {fn} were not in format expected: [a-zA-Z]*_*\\d+$.xxx . Forgoing pruning.")
-        shouldprune = False
-
-    return shouldprune
+    from util.PrunePlan import PrunePlan
+    return PrunePlan.getPlan().shouldPrune(filename)
 
 def cmd_test_prune(args):
 
@@ -0,0 +1,316 @@
+"""An asyncio version of the watchers in photogrammetryWatchers, for running the recipient or the sender as a long-lived daemon.
+
+Filesystem events still come from a watchdog observer, but they are handed to an event loop, where every file becomes a coroutine:
+files waiting their turn, and requests to the inference server, wait on the loop instead of each holding a thread, and the CPU
+bound work, developing raw files and drawing masks, runs in a pool sized like the scheduler's CPU pool. Copies to the network
+drive, and the manifest and processed file store writes, which fsync, still take a thread of the I/O pool, daemon->io_concurrency,
+while they run. Settings come from config.json->daemon, and everything else from the same settings the threaded watchers use."""
+
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from watchdog.events import FileSystemEventHandler
+import photogrammetryScripts as phscripts
+from photogrammetryWatchers import Watcher, WatcherRecipientHandler, WatcherSenderHandler, getSenderStages
+from tasks.BaseTask import ResourceClass
+from tasks.TaskScheduler import getConfiguredLimits
+from transfer.TransferEngine import TransferEngine
+from util.Cancellation import CancellationToken
+from util.Configurator import Configurator
+from util.EventFilter import EventFilter
+from util.FileStabilityTracker import FileStabilityTracker
+from util.ManifestVerifier import ManifestVerifier
+from util.MemoryBudget import MemoryBudget, estimateImageBytes
+from util.ProcessedStore import ProcessedStore, getStorePath
+from util.PipelineLogging import getLogger
+from util.buildManifest import Manifest, StreamingManifest
+from util.util import MaskingOptions
+
+
+class EventBridge(FileSystemEventHandler):
+    """Hands the watchdog observer's events to the daemon's event loop. It runs on the observer's thread, so it only queues them."""
+
+    def __init__(self, loop:asyncio.AbstractEventLoop, queue:asyncio.Queue):
+        super().__init__()
+        self.loop = loop
+        self.queue = queue
+
+    def on_any_event(self, event):
+        if not event.is_directory:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait,event)
+
+
+class AsyncWatcher(Watcher):
+    """A Watcher that runs on an asyncio event loop. It is used the same way: run() blocks until stop() is called from another
+    thread or Ctrl+C is pressed. On the recipient, builds still wait for the pictures that arrived before their manifest, and on
+    the sender, stopping finishes the transfers in flight and then sends the manifest.
+
+    Parameters:
+    -----------
+    watchdir: the folder to watch.
+    isSender: true to run the listen and send side, false to run the recipient.
+    projectname: the name of the capture, on the sender.
+    """
+
+    def __init__(self, watchdir:str, isSender=False, projectname=""):
+        super().__init__(watchdir,isSender,projectname)
+        config = Configurator.getConfig()
+        self.ioconcurrency = int(config.getPropertyOrDefault("daemon","io_concurrency",64))
+        self.inferenceconcurrency = int(config.getPropertyOrDefault("daemon","inference_concurrency",8))
+        self.loop = None
+        self._stopevent = None
+        self._tasks = set()
+        self._images = set() #image tasks, which builds wait for.
+        self._submitted = {} #path -> modification time when it was handed on, so each version of a file is handled once.
+        self._handoffs = 0 #files the tracker has handed to the loop that haven't been dispatched yet.
+        self._handofflock = threading.Lock()
+        self.maskai = None
+
+    def stop(self):
+        super().stop()
+        if self.loop is not None and self._stopevent is not None:
+            self.loop.call_soon_threadsafe(self._stopevent.set)
+
+    def run(self):
+        try:
+            asyncio.run(self._main())
+        except KeyboardInterrupt:
+            self.token.cancel("Watcher stopped from the keyboard.")
+        self._stopped = True
+
+    def _spawn(self, coro, image:bool=False)->asyncio.Task:
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        if image:
+            self._images.add(task)
+            task.add_done_callback(self._images.discard)
+        return task
+
+    async def _inPool(self, pool:ThreadPoolExecutor, func, *args):
+        return await self.loop.run_in_executor(pool,func,*args)
+
+    def _isNew(self, path:str)->bool:
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return False
+        key = os.path.normcase(os.path.abspath(path))
+        if self._submitted.get(key) == mtime:
+            return False
+        self._submitted[key] = mtime
+        return True
+
+    async def _dispatchEvents(self, events:asyncio.Queue, tracker:FileStabilityTracker, eventfilter:EventFilter, verifier:ManifestVerifier):
+        wants = WatcherSenderHandler.wants if self.isSender else WatcherRecipientHandler.wants
+        while True:
+            event = await events.get()
+            if event.event_type in ["created","modified","moved"]:
+                path = event.dest_path if event.event_type=="moved" else event.src_path
+                if verifier is not None and ManifestVerifier.isStreamManifest(path):
+                    verifier.watch(path)
+                elif event.event_type != "modified" and wants(path) and eventfilter.accept(path):
+                    tracker.track(path)
+            elif event.event_type=="closed":
+                tracker.closed(event.src_path)
+
+    def _handOff(self, ready:asyncio.Queue, path:str):
+        """Called on the tracker's thread with a file that is ready. The file is counted until it has been dispatched, so that a
+        drain doesn't finish while it is on its way to the loop."""
+        with self._handofflock:
+            self._handoffs+=1
+        self.loop.call_soon_threadsafe(ready.put_nowait,path)
+
+    def getHandoffCount(self)->int:
+        with self._handofflock:
+            return self._handoffs
+
+    async def _dispatchReady(self, ready:asyncio.Queue, handle):
+        while True:
+            path = await ready.get()
+            try:
+                if self._isNew(path):
+                    handle(path)
+            finally:
+                #handle has spawned the task for the file by now, which the drain waits on instead.
+                with self._handofflock:
+                    self._handoffs-=1
+
+    #recipient
+
+    def _convert(self, path:str)->str:
+        operation = "raw_convert" if path.upper().endswith(".CR2") else "tif_convert"
+        with MemoryBudget.getBudget().reserve(estimateImageBytes(path,operation),operation,self.token):
+            return WatcherRecipientHandler.convert_image_file(path)
+
+    async def _infer(self, processedfile:str)->dict:
+        async with self._inferencelimit:
+            if hasattr(self.maskai.client,"infer_async"):
+                return await self.maskai.client.infer_async(processedfile)
+            return await self._inPool(self.iopool,self.maskai.client.infer,processedfile)
+
+    async def _processImage(self, path:str):
+        try:
+            processedfile = await self._inPool(self.cpupool,self._convert,path)
+            if processedfile is None:
+                return
+            if not await self._inPool(self.iopool,WatcherRecipientHandler.copy_sender_mask,path):
+                mode = WatcherRecipientHandler.get_mask_mode()
+                if mode == MaskingOptions.MASK_AI and self.maskai is not None:
+                    prediction = await self._infer(processedfile)
+                    await self._inPool(self.cpupool,self.maskai.drawMask,Path(processedfile),prediction)
+                elif mode != MaskingOptions.NOMASKS.value:
+                    await self._inPool(self.cpupool,WatcherRecipientHandler.mask_image_file,processedfile,mode)
+            await self._inPool(self.iopool,self.store.record,path,"image")
+        except Exception as e:
+            getLogger(__name__).error("Could not process %s: %s",path,e)
+
+    async def _buildAfterImages(self, path:str):
+        #the manifest arrives after its pictures, so every picture that arrived before it has to be finished first.
+        pending = [t for t in self._images if not t.done()]
+        if pending:
+            await asyncio.wait(pending)
+        async with self._buildlock:
+            getLogger(__name__).info("Starting the build for %s.",path)
+            try:
+                await self._inPool(self.buildpool,self._build,path)
+            except Exception as e:
+                getLogger(__name__).error("Build for %s failed: %s",path,e)
+
+    def _handleRecipient(self, path:str):
+        if WatcherRecipientHandler.is_manifest(path):
+            self._spawn(self._buildAfterImages(path))
+        else:
+            self._spawn(self._processImage(path),image=True)
+
+    async def _connectInference(self):
+        """Connects to the inference server once, if the watcher masks with AI, so each picture only makes its request."""
+        if WatcherRecipientHandler.get_mask_mode() != MaskingOptions.MASK_AI:
+            return
+        from tasks.MaskingTasks import MaskAI
+        config = Configurator.getConfig()
+        scratchdir = config.getProperty("watcher","temp_scratch")
+        processedpath = os.path.join(scratchdir,"processed")
+        os.makedirs(processedpath,exist_ok=True)
+        maskai = MaskAI({"maskoption":MaskingOptions.MASK_AI,"input":processedpath,
+                         "output":os.path.join(scratchdir,config.getProperty("photogrammetry","mask_path"))})
+        try:
+            if await self._inPool(self.iopool,maskai.setup):
+                await self._inPool(self.iopool,maskai.connect)
+                self.maskai = maskai
+        except Exception as e:
+            getLogger(__name__).error("Could not connect to the inference server, masking one picture at a time instead: %s",e)
+
+    #sender
+
+    async def _sendPicture(self, path:str):
+        try:
+            tosend = await self._inPool(self.cpupool,self.handler.prepare,path)
+        except Exception as e:
+            getLogger(__name__).error("Could not prepare %s to be sent: %s",path,e)
+            return
+        #a picture's files go in order, so that its mask is there before it.
+        for f, _, subdir, source in sorted(tosend,key=lambda t: t[1]):
+            async with self._transferlimit:
+                result = await self._inPool(self.iopool,self.engine.copyFile,f,Path(self.netdrive,subdir),self.sendtoken)
+            result["subdir"] = subdir
+            result["source"] = source
+            #the streaming manifest fsyncs each record, so it is written from the pool rather than the loop.
+            await self._inPool(self.iopool,WatcherSenderHandler.record_transfer,self.manifest,result)
+
+    async def _drain(self, tracker:FileStabilityTracker):
+        timeout = float(Configurator.getConfig().getPropertyOrDefault("transfer","drain_timeout_s",600))
+        deadline = time.monotonic()+timeout
+        getLogger(__name__).info("Finishing %d transfers before sending the manifest.",len(self._tasks)+tracker.getPendingCount())
+        while tracker.getPendingCount()+self.getHandoffCount() > 0 and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        pending = [t for t in self._tasks if not t.done()]
+        if pending:
+            _, notdone = await asyncio.wait(pending,timeout=max(0.0,deadline-time.monotonic()))
+            if notdone:
+                getLogger(__name__).warning("Gave up waiting for %d transfers.",len(notdone))
+
+    async def _main(self):
+        self.loop = asyncio.get_running_loop()
+        self._stopevent = asyncio.Event()
+        if self.token.isCancelled():
+            return
+        config = Configurator.getConfig()
+        settle = float(config.getPropertyOrDefault("watcher","settle_seconds",0.5))
+        cpuworkers = max(1,getConfiguredLimits().get(ResourceClass.CPU_POOL,1))
+        self.cpupool = ThreadPoolExecutor(max_workers=cpuworkers,thread_name_prefix="DaemonCPU")
+        self.iopool = ThreadPoolExecutor(max_workers=max(1,self.ioconcurrency),thread_name_prefix="DaemonIO")
+        self.buildpool = ThreadPoolExecutor(max_workers=1,thread_name_prefix="DaemonBuild")
+        self._buildlock = asyncio.Lock()
+        self._inferencelimit = asyncio.Semaphore(max(1,self.inferenceconcurrency))
+        events = asyncio.Queue()
+        ready = asyncio.Queue()
+        onready = lambda p: self._handOff(ready,p)
+        streaming = bool(config.getPropertyOrDefault("watcher","streaming_manifest",True))
+        verifier = None
+        if not self.isSender:
+            tracker = FileStabilityTracker(onready,settle=settle,token=self.token)
+            self.store = ProcessedStore(getStorePath())
+            if streaming:
+                verifier = ManifestVerifier(onready,bool(config.getPropertyOrDefault("transfer","checksum",True)),token=self.token)
+                verifier.start()
+            phscripts.VERIFIER = verifier
+            await self._connectInference()
+            handle = self._handleRecipient
+        else:
+            self.netdrive = config.getProperty("watcher","networkdrive")
+            stages = getSenderStages()
+            if streaming:
+                #opening the streamed manifest writes its first record to the network drive.
+                self.manifest = await self._inPool(self.iopool,StreamingManifest,self.projectname,self.maskmode,self.netdrive,stages)
+            else:
+                self.manifest = Manifest(self.projectname,self.maskmode,stages)
+            #the sender's pictures keep moving after the user finishes, until they have all been sent, so they get their own token.
+            self.sendtoken = CancellationToken()
+            tracker = FileStabilityTracker(onready,settle=settle,token=self.sendtoken)
+            self.engine = TransferEngine.fromConfig()
+            self._transferlimit = asyncio.Semaphore(self.engine.streams)
+            self.handler = WatcherSenderHandler(tracker,None,stages)
+            handle = lambda p: self._spawn(self._sendPicture(p))
+        phscripts.STOP_TOKEN = self.token
+        tracker.start()
+        dispatchers = [asyncio.ensure_future(self._dispatchEvents(events,tracker,EventFilter.fromConfig(),verifier)),
+                       asyncio.ensure_future(self._dispatchReady(ready,handle))]
+        self.observer.schedule(EventBridge(self.loop,events),self.watched_dir,recursive=True)
+        self.observer.start()
+        reconcileinterval = float(config.getPropertyOrDefault("watcher","reconcile_interval_s",300))
+        finished = False
+        try:
+            getLogger(__name__).info("Waiting for pictures to process.")
+            if not self.isSender:
+                await self._inPool(self.iopool,self._reconcile,tracker)
+            while not self.token.isCancelled():
+                try:
+                    await asyncio.wait_for(self._stopevent.wait(),reconcileinterval if reconcileinterval > 0 and not self.isSender else None)
+                except asyncio.TimeoutError:
+                    await self._inPool(self.iopool,self._reconcile,tracker)
+            finished = True
+        finally:
+            getLogger(__name__).info("Watcher stopping.")
+            self.observer.stop()
+            await self._inPool(None,self.observer.join)
+            if self.isSender and finished:
+                await self._drain(tracker)
+            await self._inPool(None,tracker.stop)
+            if verifier is not None:
+                await self._inPool(None,verifier.stop)
+            if self.isSender:
+                self.sendtoken.cancel("Watcher stopped.")
+            for task in dispatchers+list(self._tasks):
+                task.cancel()
+            await asyncio.gather(*dispatchers,*self._tasks,return_exceptions=True)
+            #work already running in the pools finishes, work that hasn't started is dropped.
+            for pool in [self.cpupool,self.iopool,self.buildpool]:
+                pool.shutdown(wait=True,cancel_futures=True)
+        if self.isSender:
+            manifestpath = self.manifest.finalize(".").resolve()
+            getLogger(__name__).info("Sending manifest %s",manifestpath)
+            self.engine.copyFile(manifestpath,self.netdrive)